@@ -59,6 +59,25 @@ ROOT_URLCONF = "django_test.urls"
 
 ASGI_APPLICATION = "django_test.asgi.application"
 
+# Channel layer for the frame fan-out (socket_test/fanout.py). The in-memory one only reaches
+# consumers in the same process, set CHANNEL_LAYER=unix to go through `manage.py runchannelhub`
+# so one `manage.py runproducer` can feed every Daphne worker on this machine.
+CHANNEL_HUB_SOCKET = os.environ.get("CHANNEL_HUB_SOCKET", "/tmp/stream_channel_hub.sock")
+if os.environ.get("CHANNEL_LAYER") == "unix":
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "socket_test.channel_layers.UnixSocketChannelLayer",
+            "CONFIG": {"path": CHANNEL_HUB_SOCKET, "capacity": 10},
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+            "CONFIG": {"capacity": 10},
+        },
+    }
+
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
@@ -23,6 +23,7 @@ from test_app.views import media_image
 from django.conf import settings
 from django.conf.urls.static import static
 from stream.views import mediapipe, camera_feed
+from socket_test.views import stream_metrics
 
 urlpatterns = [
     path("admin/", admin.site.urls),
@@ -32,5 +33,6 @@ urlpatterns = [
     path('stream/', include('stream.urls')),
     path('mediapipe/', mediapipe, name='mediapipe'),
     path('camera_feed/', camera_feed, name='camera_feed'),
+    path('metrics/', stream_metrics, name='metrics'),
     re_path(r'^(?P<filename>[\w\-]+\.(jpg|png|gif|ico|mp4))$',media_image, name='media_image'),
 ]
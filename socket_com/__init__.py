@@ -0,0 +1,8 @@
+"""
+The standalone UDP streaming scripts (server.py, client.py) and the modules they share with
+the Django app.
+
+The scripts are run from this directory and import their modules by bare name (`import fec`),
+Django imports the same files as `socket_com.fec`. So none of the modules here import from the
+rest of the project or from each other through the package; keep it that way when adding one.
+"""
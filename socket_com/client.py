@@ -1,3 +1,4 @@
+import asyncio
 import socket
 import cv2
 import struct
@@ -6,9 +7,23 @@ import os
 import numpy as np
 import time
 from threading import Thread
-from queue import Queue
+from queue import Full, Queue
 import signal
 
+from metrics import metrics, serve_metrics
+from clock_sync import (
+    ClockSync,
+    SYNC_BURST,
+    SYNC_INTERVAL,
+    SYNC_RESPONSE,
+    pack_sync_request,
+    unpack_sync_response,
+)
+from congestion import RECEIVER_REPORT_INTERVAL, ReceiverStats
+from jitter_buffer import JitterBuffer
+from frame_packets import FLAG_RETRANSMIT, HEADER_SIZE, Reassembler, frame_nonce, unpack_header
+from nack import NACK_DELAY, NackTracker, pack_nack
+
 try:
     from Crypto.Cipher import AES
 
@@ -20,6 +35,15 @@ except ImportError:
 
 # Global flag for clean shutdown, kinda
 RUNNING = True
+SERVER_ADDR = ("localhost", 9999)
+METRICS_PORT = 9101  # GET http://localhost:9101/ for per stage latency percentiles
+PLAYOUT_PERCENTILE = 0.95  # of recent frame delays to play at, lower for less latency, higher for fewer late frames
+MAX_FPS = 0  # frames per second the server sends us at most, 0 is whatever it captures
+KEY_RETRY_INTERVAL = 1.0  # the key exchange is one UDP packet, it's sent again until frames come
+CONNECT_TIMEOUT = 20
+STREAM_TIMEOUT = 5.0  # seconds without a frame before we take it the server dropped us (its CLIENT_TIMEOUT)
+TERMINATE = b"TERMINATE"
+RESET = b"RESET"  # the server has no session for us, or refused our key
 
 
 def display_frames(frame_queue):
@@ -30,6 +54,7 @@ def display_frames(frame_queue):
             start_time = time.time()
             cv2.imshow("Stream", frame)
             display_time = (time.time() - start_time) * 1000
+            metrics.record("display", display_time / 1000)
             print(f"Display time: {display_time:.2f} ms")
             if cv2.waitKey(1) & 0xFF == ord("q"):
                 break
@@ -38,22 +63,308 @@ def display_frames(frame_queue):
     cv2.destroyAllWindows()
 
 
+def send_clock_sync(sock, clock):
+    request_id, t1 = clock.make_request()
+    try:
+        sock.send(pack_sync_request(request_id, t1))
+    except Exception as e:
+        print(f"Error sending clock sync: {e}")
+
+
 def signal_handler(sig, frame):
     """Handle Ctrl+C for clean shutdown"""
     global RUNNING
     RUNNING = False
 
 
+class StreamClient:
+    """
+    Receives one stream. Packets are read on the event loop into a reused buffer and copied
+    once, straight into their frame's slot; decrypt and decode of the newest complete frame
+    run in a worker thread so reception never stops for them. Decoded frames wait in the
+    jitter buffer until their playout time.
+
+    When the server drops us (it timed out, or restarted) there's a new key exchange with a
+    fresh AES key, its sessions count frames from 0 and a key must never see a nonce twice.
+    """
+
+    def __init__(self, sock, pub_key, frame_queue, playout_percentile=PLAYOUT_PERCENTILE):
+        self.sock = sock
+        self.pub_key = pub_key
+        self.frame_queue = frame_queue
+        self.playout_percentile = playout_percentile
+        # Frame timestamps are on the server's clock, so the latency and the stale frame check
+        # only mean something once we know its offset from ours. A few exchanges as soon as the
+        # server has our key, then one every SYNC_INTERVAL to follow the drift.
+        self.clock = ClockSync()
+        self.complete_event = asyncio.Event()
+        self.jitter_event = asyncio.Event()
+        self.decode_skipped = 0
+        self.rekeys = 0
+        self.rekey(time.time())
+
+    def rekey(self, now):
+        """New AES key and IV, and nothing left over from the previous session"""
+        # unique keys per every connection because why not
+        self.aes_key = os.urandom(32)
+        self.iv = os.urandom(16)
+        # the power of symmetric asymmetric encryption
+        enc_aes_key = rsa.encrypt(self.aes_key, self.pub_key)
+        self.key_exchange = struct.pack("Q", len(enc_aes_key)) + enc_aes_key + self.iv + struct.pack("<H", MAX_FPS)
+        self.connected = False
+        self.keyed_at = self.last_key_sent = self.last_frame_at = now
+        self.reassembler = Reassembler()
+        self.newest_sequence = -1  # highest sequence any packet came with
+        # Loss, jitter and the delay trend go back to the server every RECEIVER_REPORT_INTERVAL,
+        # it sizes the FEC and picks the bitrate on them
+        self.stats = ReceiverStats(now)
+        # Frames play at their timestamp + a delay that follows the network's jitter
+        self.jitter = JitterBuffer(self.playout_percentile)
+        # What FEC can't rebuild gets NACKed while there's still time for the resend to arrive
+        self.nacks = NackTracker()
+        self.complete = None  # newest complete FrameSlot the decoder hasn't taken yet
+
+    def send_keys(self, now):
+        self.send(self.key_exchange, "keys")
+        self.last_key_sent = now
+
+    def reconnect(self, now, reason):
+        print(f"{reason}, keying again.")
+        self.rekeys += 1
+        self.rekey(now)
+        self.send_keys(now)
+
+    async def receive(self):
+        loop = asyncio.get_running_loop()
+        receive_buffer = bytearray(65535)
+        receive_view = memoryview(receive_buffer)
+        while RUNNING:
+            try:
+                size = await loop.sock_recv_into(self.sock, receive_buffer)
+            except ConnectionRefusedError:
+                continue  # nobody on the server port (yet), the key exchange keeps trying
+            except Exception as e:
+                print(f"Error receiving packet: {e}")
+                continue
+            try:
+                if not self.on_packet(receive_view[:size]):
+                    return
+            except Exception as e:
+                print(f"Error handling packet: {e}")
+
+    def on_packet(self, data):
+        """Takes one datagram, False once the server ended the stream"""
+        now = time.time()
+        header = unpack_header(data)
+        if header is None:
+            if data == TERMINATE:
+                print("Server terminated the stream.")
+                return False
+            if data == RESET:
+                # Ignored right after keying, it answers control packets sent before that
+                if now - self.keyed_at > KEY_RETRY_INTERVAL:
+                    self.reconnect(now, "Server has no session for us")
+                return True
+            if data[: len(SYNC_RESPONSE)] == SYNC_RESPONSE:
+                _, t1, t2, t3 = unpack_sync_response(data)
+                self.clock.on_response(t1, t2, t3, now)
+                return True
+            # some corrupted packets were shorter than the header, have to look into why that is
+            print(f"Unknown packet ({len(data)} bytes), skipping.")
+            return True
+        if not self.connected:
+            self.connected = True
+            # The server has a session for us now, sync requests before this were dropped
+            for _ in range(SYNC_BURST):
+                send_clock_sync(self.sock, self.clock)
+
+        flags, index, seq, timestamp, frame_size, total_packets, parity, _ = header
+
+        # Counted before any of the checks below, those drop packets the network did deliver.
+        # Resent packets aren't, the reports are about the network, not what's left after NACKs.
+        if not flags & FLAG_RETRANSMIT:
+            self.stats.on_packet(len(data))
+            if index == 0:
+                self.stats.on_first_packet(timestamp, now)
+        if seq > self.newest_sequence:
+            self.stats.on_frame(total_packets + parity)
+            self.newest_sequence = seq
+
+        # Drop stale frames. Only once they're past the playout delay by a margin, a frame that's
+        # just late still completes and tells the jitter buffer to wait longer.
+        sent_at = self.clock.to_local(timestamp)
+        if now - sent_at > self.jitter.max_frame_age:
+            # Still tells the buffer how late frames are, or it couldn't catch up with a slower network
+            self.jitter.too_old(seq, sent_at, now)
+            print(f"Frame {seq} too old, skipping.")
+            return True
+
+        # Packets go in by index, lost ones are rebuilt from the parity packets when possible
+        slot = self.reassembler.add(header, data[HEADER_SIZE:], now)
+        if slot is None:
+            if seq in self.reassembler.frames:
+                self.nacks.on_packet(seq, sent_at, now, flags & FLAG_RETRANSMIT)
+            return True
+        self.nacks.forget(seq, completed=True)
+        metrics.record("receive", now - slot.first_packet_at)
+        # The decoder only ever wants the newest frame, one it didn't get to yet is dropped
+        if self.complete is not None:
+            self.decode_skipped += 1
+        self.complete = slot
+        self.complete_event.set()
+        return True
+
+    async def maintain(self, receive_task):
+        """
+        Key exchange until frames come, then clock sync, receiver reports, NACKs and expiry of
+        lost frames, and a new key exchange if the frames stop
+        """
+        last_sync = last_report = time.time()
+        # Short ticks, a missing frame tail is only noticed when the packets stop
+        while RUNNING and not receive_task.done():
+            await asyncio.sleep(NACK_DELAY)
+            now = time.time()
+            if not self.connected:
+                if now - self.keyed_at > CONNECT_TIMEOUT:
+                    print("No stream from the server, giving up.")
+                    break
+                if now - self.last_key_sent > KEY_RETRY_INTERVAL:
+                    self.send_keys(now)
+                continue  # the server drops (and resets) anything else before it has our key
+            if now - self.last_frame_at > STREAM_TIMEOUT:
+                self.reconnect(now, f"No frames for {STREAM_TIMEOUT:.0f} s")
+                continue
+            if now - last_sync > SYNC_INTERVAL:
+                send_clock_sync(self.sock, self.clock)
+                last_sync = now
+            if now - last_report > RECEIVER_REPORT_INTERVAL:
+                self.send(self.stats.take_report(now), "receiver report")
+                last_report = now
+            self.reassembler.expire(now)
+            for nack_seq, missing in self.nacks.due(self.reassembler.frames, self.clock.delay,
+                                                    self.jitter.max_frame_age, now):
+                self.send(pack_nack(nack_seq, missing), "NACK")
+        receive_task.cancel()
+
+    def send(self, data, what):
+        try:
+            self.sock.send(data)
+        except Exception as e:
+            print(f"Error sending {what}: {e}")
+
+    async def decode(self):
+        loop = asyncio.get_running_loop()
+        while RUNNING:
+            await self.complete_event.wait()
+            self.complete_event.clear()
+            slot, self.complete = self.complete, None
+            if slot is None:
+                continue
+            jitter = self.jitter
+            frame = await loop.run_in_executor(None, self.decode_frame, slot, self.aes_key, self.iv)
+            # A frame of the previous session (keyed again while it decoded) doesn't go in the new buffer
+            if frame is not None and jitter is self.jitter:
+                self.last_frame_at = time.time()
+                sent_at = self.clock.to_local(slot.timestamp)
+                if self.jitter.push(slot.sequence, sent_at, (slot.sequence, sent_at, frame), time.time()):
+                    self.jitter_event.set()
+                else:
+                    print(f"Frame {slot.sequence} missed its playout time, skipping.")
+
+    async def play(self):
+        """Hands frames to the display thread at their playout times"""
+        while RUNNING:
+            now = time.time()
+            entry = self.jitter.pop(now)
+            if entry is not None:
+                self.show(*entry)
+                continue
+            due = self.jitter.next_playout()
+            self.jitter_event.clear()
+            try:
+                await asyncio.wait_for(self.jitter_event.wait(), min(max(due - now, 0.0), 0.5) if due else 0.5)
+            except asyncio.TimeoutError:
+                pass
+
+    def show(self, seq, sent_at, frame):
+        try:
+            self.frame_queue.put_nowait(
+                frame
+            )  # insert the frame into the frame queue to be used by the spawned thread
+        except Full:
+            pass  # display fell behind, it has newer frames than it can show anyway
+        latency = (time.time() - sent_at) * 1000
+        metrics.record("end_to_end", latency / 1000)
+        print(f"Frame {seq} played, Latency: {latency:.2f} ms, Playout delay: {self.jitter.playout_delay * 1000:.2f} ms")
+
+    def decode_frame(self, slot, aes_key, iv):
+        """The decoded image of a complete frame, None if it didn't decrypt or decode"""
+        seq = slot.sequence
+        encrypted_frame = slot.frame()
+
+        # Decrypt frame, in place in the frame's buffer
+        decrypt_start = time.time()
+        if USE_PYCRYPTODOME:
+            aes = AES.new(aes_key, AES.MODE_GCM, nonce=frame_nonce(iv, seq))
+            tag = encrypted_frame[-16:]
+            encrypted_frame = encrypted_frame[:-16]
+            try:
+                aes.decrypt_and_verify(encrypted_frame, tag, output=encrypted_frame)
+            except ValueError:
+                print(f"Frame {seq} decryption failed, skipping.")
+                return None
+            decrypted = encrypted_frame
+        else:
+            aes = pyaes.AESModeOfOperationCBC(aes_key, iv=iv)
+            decrypted = b""
+            for i in range(0, len(encrypted_frame), 16):
+                decrypted += aes.decrypt(bytes(encrypted_frame[i : i + 16]))
+            pad_len = decrypted[-1]
+            if pad_len <= 16:
+                decrypted = decrypted[:-pad_len]
+        decrypt_time = (time.time() - decrypt_start) * 1000
+        metrics.record("decrypt", decrypt_time / 1000)
+
+        # Decode frame using opencv, have to look up if there exist better options
+        decode_start = time.time()
+        frame = cv2.imdecode(np.frombuffer(decrypted, dtype=np.uint8), 1)
+        decode_time = (time.time() - decode_start) * 1000
+        metrics.record("decode", decode_time / 1000)
+
+        if frame is not None:
+            print(
+                f"Frame {seq} size: {slot.frame_size} bytes, Packets: {slot.total} ({slot.recovered} recovered), Decrypt: {decrypt_time:.2f} ms, Decode: {decode_time:.2f} ms"
+            )
+        return frame
+
+    async def run(self):
+        self.send_keys(time.time())
+        receive_task = asyncio.ensure_future(self.receive())
+        decode_task = asyncio.ensure_future(self.decode())
+        play_task = asyncio.ensure_future(self.play())
+        await self.maintain(receive_task)
+        decode_task.cancel()
+        play_task.cancel()
+        await asyncio.gather(receive_task, decode_task, play_task, return_exceptions=True)
+        self.send(TERMINATE, "terminate")
+
+    def print_stats(self):
+        reassembler, nacks = self.reassembler, self.nacks
+        print(f"Clock sync: {self.clock.get_stats()}, keyed again {self.rekeys} times")
+        print(f"Frames complete: {reassembler.completed}, {reassembler.frames_recovered} of them thanks to FEC "
+              f"({reassembler.packets_recovered} packets rebuilt), {nacks.frames_repaired} after NACKing "
+              f"({nacks.packets_nacked} packets NACKed), {reassembler.timed_out} timed out, "
+              f"{reassembler.evicted} pushed out by newer frames, {self.decode_skipped} not decoded in time")
+        print(f"Playout: {self.jitter.get_stats()}")
+        print(f"Jitter: {self.stats.jitter * 1000:.2f} ms, delay trend: {self.stats.trend() * 1000:.2f} ms/s")
+
+
 def client_program():
     global RUNNING
     signal.signal(
         signal.SIGINT, signal_handler
     )  # tried fixing the thread issue, didn't work this way. TODO: fix this
 
-    # Generate AES key and IV/nonce, unique keys per every connection because why not
-    aes_key = os.urandom(32)
-    iv = os.urandom(16)
-
     # Load server public key, have to look up how this usually happens
     try:
         with open("server_public copy.pem", "rb") as f:
@@ -62,26 +373,15 @@ def client_program():
         print("Error: server_public.pem not found.")
         return
 
-    # the power of symmetric asymmetric encryption
-    enc_aes_key = rsa.encrypt(aes_key, pub_key)
-
-    # UDP socket setup
+    # UDP socket setup, connected so only the server's packets come in
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     client_socket.setsockopt(
         socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024
     )  # 4MB buffer
-    client_socket.settimeout(20)  # initial timeout
-    server_addr = ("localhost", 9999)
+    client_socket.connect(SERVER_ADDR)
+    client_socket.setblocking(False)
 
-    # Send keys
-    try:
-        client_socket.sendto(
-            struct.pack("Q", len(enc_aes_key)) + enc_aes_key + iv, server_addr
-        )
-    except Exception as e:
-        print(f"Error sending keys: {e}")
-        client_socket.close()
-        return
+    serve_metrics(METRICS_PORT)
 
     # Start display thread. The thread was used to both simplicity and because I wanted to see if spawning a thread still gave low latency
     frame_queue = Queue(maxsize=3)  # Buffer for 1080p
@@ -90,108 +390,14 @@ def client_program():
     )  # nice way to handle streams, thank you to the kind stackoverflow guy who blessed me with this
     display_thread.start()
 
-    # Video reception loop, I may need to spawn a thread just for this
-    packets = {}
-    last_sequence = -1
-    client_socket.settimeout(0.75)  # Reset timeout after sending keys
-    while RUNNING:
-        try:
-            data, _ = client_socket.recvfrom(65535)
-            if data == b"TERMINATE":
-                break
-
-            # Validate packet size (some corrupted packets had less than 20 bytes, have to look into why that is)
-            if len(data) < 20:
-                print(f"Packet too small ({len(data)} bytes), skipping.")
-                continue
-
-            # Parse header
-            header = data[:20]
-            packet_data = data[20:]
-            try:
-                timestamp, seq, total_packets, frame_size = struct.unpack(
-                    "dIII", header
-                )
-            except struct.error as e:
-                print(f"Error unpacking header: {e}")
-                continue
-
-            # Drop stale frames, this has to be made dynamic probably
-            if time.time() - timestamp > 0.03:
-                print(f"Frame {seq} too old, skipping.")
-                continue
-
-            # Store packets and the sequence in a dictionary, I'm just simulating tcp at this point without the packet recalls
-            if seq not in packets:
-                packets[seq] = []
-            packets[seq].append(packet_data)
-
-            # Check if frame is complete
-            if len(packets[seq]) == total_packets:
-                encrypted_frame = b"".join(packets[seq])
-                if len(encrypted_frame) != frame_size:
-                    print(
-                        f"Frame {seq} incomplete (got {len(encrypted_frame)} bytes, expected {frame_size}), skipping."
-                    )
-                    del packets[
-                        seq
-                    ]  # I may need to come up with a better way to handle this.
-                    continue
-
-                # Decrypt frame
-                decrypt_start = time.time()
-                if USE_PYCRYPTODOME:
-                    aes = AES.new(aes_key, AES.MODE_GCM, nonce=iv)
-                    tag = encrypted_frame[-16:]
-                    encrypted_frame = encrypted_frame[:-16]
-                    try:
-                        decrypted = aes.decrypt_and_verify(encrypted_frame, tag)
-                    except ValueError:
-                        print(f"Frame {seq} decryption failed, skipping.")
-                        del packets[seq]
-                        continue
-                else:
-                    aes = pyaes.AESModeOfOperationCBC(aes_key, iv=iv)
-                    decrypted = b""
-                    for i in range(0, len(encrypted_frame), 16):
-                        decrypted += aes.decrypt(encrypted_frame[i : i + 16])
-                    pad_len = decrypted[-1]
-                    if pad_len <= 16:
-                        decrypted = decrypted[:-pad_len]
-                decrypt_time = (time.time() - decrypt_start) * 1000
-
-                # Decode frame using opencv, have to look up if there exist better options
-                decode_start = time.time()
-                frame = cv2.imdecode(np.frombuffer(decrypted, dtype=np.uint8), 1)
-                decode_time = (time.time() - decode_start) * 1000
-
-                if frame is not None:
-                    frame_queue.put(
-                        frame
-                    )  # insert the frame into the frame queue to be used by the spawned thread
-                    latency = (time.time() - timestamp) * 1000
-                    print(
-                        f"Frame {seq} size: {frame_size} bytes, Packets: {total_packets}, Decrypt: {decrypt_time:.2f} ms, Decode: {decode_time:.2f} ms, Latency: {latency:.2f} ms"
-                    )
-
-                del packets[seq]
-                last_sequence = seq
-
-            # Clean up old packets
-            for old_seq in list(packets.keys()):
-                if old_seq < last_sequence - 1:
-                    del packets[old_seq]
-
-        except socket.timeout:
-            continue
-        except Exception as e:
-            print(f"Error receiving packet: {e}")
-            continue
-
-    client_socket.close()
-    RUNNING = False
-    frame_queue.put(None)
-    display_thread.join()
+    client = StreamClient(client_socket, pub_key, frame_queue)
+    try:
+        asyncio.run(client.run())
+    finally:
+        client.print_stats()
+        client_socket.close()
+        RUNNING = False
+        display_thread.join()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,128 @@
+"""
+NTP style clock synchronisation, so timestamps taken on another machine can be compared
+with our own clock. The side that wants the other's time sends a request stamped with its
+send time t1, the other side answers with its receive time t2 and reply time t3, and t4 is
+when the answer came back:
+
+    offset = ((t2 - t1) + (t3 - t4)) / 2      remote clock minus local clock
+    delay  = (t4 - t1) - (t3 - t2)            network round trip
+
+Samples with the lowest delay have the least asymmetric queuing in them, so those are trusted
+most (like NTP's clock filter). Over a longer history the offset is fitted against local time
+to also get the drift between the two clocks.
+"""
+
+import struct
+import threading
+import time
+from collections import deque
+
+# UDP control packets, [4 byte tag][payload]
+SYNC_REQUEST = b"SYNC"   # + request id (Q), t1 (d)
+SYNC_RESPONSE = b"SYNR"  # + request id (Q), t1 (d), t2 (d), t3 (d)
+REQUEST_FORMAT = "<Qd"
+RESPONSE_FORMAT = "<Qddd"
+
+SYNC_BURST = 5          # exchanges right after connecting, to get a good first estimate
+SYNC_INTERVAL = 2.0     # seconds between exchanges after that
+FILTER_SAMPLES = 8      # the best offset is picked from this many recent samples
+DRIFT_SAMPLES = 64      # history the drift is fitted over
+MIN_DRIFT_SPAN = 10.0   # seconds of history needed before trusting a drift estimate
+
+
+class ClockSync:
+    """Offset and drift of a remote clock, from request/response timestamp exchanges"""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.recent = deque(maxlen=FILTER_SAMPLES)  # (local time, offset, delay)
+        self.history = deque(maxlen=DRIFT_SAMPLES)  # filtered (local time, offset)
+        self.offset = 0.0  # remote - local, at reference_time
+        self.reference_time = 0.0
+        self.drift = 0.0  # seconds of offset change per second
+        self.delay = None
+        self.samples = 0
+
+    @property
+    def synced(self):
+        return self.samples > 0
+
+    def make_request(self):
+        """(request id, t1) for a new exchange"""
+        with self.lock:
+            self.next_id += 1
+            return self.next_id, self.clock()
+
+    def on_response(self, t1, t2, t3, t4=None):
+        """Feeds one finished exchange. t1 and t4 are local times, t2 and t3 remote ones."""
+        t4 = self.clock() if t4 is None else t4
+        delay = (t4 - t1) - (t3 - t2)
+        if delay < 0:
+            return  # clocks stepped in the middle of the exchange, not usable
+        offset = ((t2 - t1) + (t3 - t4)) / 2
+
+        with self.lock:
+            self.samples += 1
+            self.recent.append((t4, offset, delay))
+            # Lowest delay sample of the recent ones is the best estimate right now
+            best_time, best_offset, best_delay = min(self.recent, key=lambda s: s[2])
+            self.delay = best_delay
+            if not self.history or self.history[-1][0] != best_time:
+                self.history.append((best_time, best_offset))
+            self._fit()
+
+    def _fit(self):
+        times = [t for t, _ in self.history]
+        offsets = [o for _, o in self.history]
+        latest_time, latest_offset = self.history[-1]
+        if times[-1] - times[0] < MIN_DRIFT_SPAN:
+            self.offset, self.reference_time, self.drift = latest_offset, latest_time, 0.0
+            return
+
+        # Least squares line through (time, offset)
+        mean_t = sum(times) / len(times)
+        mean_o = sum(offsets) / len(offsets)
+        variance = sum((t - mean_t) ** 2 for t in times)
+        covariance = sum((t - mean_t) * (o - mean_o) for t, o in zip(times, offsets))
+        self.drift = covariance / variance if variance else 0.0
+        self.offset = mean_o
+        self.reference_time = mean_t
+
+    def offset_at(self, local_time=None):
+        local_time = self.clock() if local_time is None else local_time
+        with self.lock:
+            return self.offset + self.drift * (local_time - self.reference_time)
+
+    def to_local(self, remote_time):
+        """A timestamp from the remote clock on our clock"""
+        return remote_time - self.offset_at()
+
+    def to_remote(self, local_time):
+        """One of our timestamps on the remote clock"""
+        return local_time + self.offset_at(local_time)
+
+    def get_stats(self):
+        return {
+            "synced": self.synced,
+            "offset_ms": self.offset_at() * 1000,
+            "drift_ppm": self.drift * 1e6,
+            "rtt_ms": self.delay * 1000 if self.delay is not None else None,
+            "samples": self.samples,
+        }
+
+
+def pack_sync_request(request_id, t1):
+    return SYNC_REQUEST + struct.pack(REQUEST_FORMAT, request_id, t1)
+
+
+def pack_sync_response(request, received_at, clock=time.time):
+    """Answer to a SYNC packet, t3 is taken as late as possible"""
+    request_id, t1 = struct.unpack_from(REQUEST_FORMAT, request, len(SYNC_REQUEST))
+    return SYNC_RESPONSE + struct.pack(RESPONSE_FORMAT, request_id, t1, received_at, clock())
+
+
+def unpack_sync_response(packet):
+    """(request id, t1, t2, t3)"""
+    return struct.unpack_from(RESPONSE_FORMAT, packet, len(SYNC_RESPONSE))
@@ -0,0 +1,202 @@
+"""
+Receiver driven congestion control for the UDP stream, loosely after WebRTC's GCC.
+
+The client sends a receiver report every RECEIVER_REPORT_INTERVAL: packets received and
+expected, bytes received, RFC 3550 inter-arrival jitter and the trend of the one-way delay.
+The delay samples are the transit times of each frame's first packet (it leaves right at
+the frame's timestamp, before any pacing), taken as arrival time minus the raw server
+timestamp. The unknown clock offset is the same in all of them, so the slope of a line
+through the last TREND_WINDOW samples is how fast a queue is building up somewhere.
+
+The server's BandwidthEstimator turns the reports into a target bitrate: a delay growing
+faster than OVERUSE_TREND cuts it to below what actually got through, a steady delay lets
+it grow, and heavy loss cuts it too. The encoding ladder and the pacer follow the target,
+so the stream backs off before it fills the buffers of a link it shares with others.
+"""
+
+import struct
+from collections import deque
+
+RECEIVER_REPORT = b"RRPT"  # + received (I), expected (I), bytes (I), interval (d), jitter (d), delay trend (d)
+RECEIVER_REPORT_FORMAT = "<IIIddd"
+RECEIVER_REPORT_INTERVAL = 0.2  # seconds
+
+TREND_WINDOW = 20        # frames the delay trend is fitted over
+MIN_TREND_SAMPLES = 5
+
+INITIAL_BITRATE = 20e6   # bits per second
+MIN_BITRATE = 0.5e6
+MAX_BITRATE = 100e6
+OVERUSE_TREND = 0.01     # seconds of delay gained per second, more than that is a queue filling
+OVERUSE_REPORTS = 2      # reports in a row before acting on it, one can be noise
+DECREASE_FACTOR = 0.85   # of the receive rate, on overuse
+INCREASE_PER_SECOND = 0.15
+MAX_OVER_RECEIVE_RATE = 1.5  # the target can't run off while the encoder sends less than it
+HIGH_LOSS = 0.1
+LOW_LOSS = 0.02
+LOSS_INCREASE = 1.05     # per report with low loss
+RATE_SMOOTHING = 0.3     # EWMA weight of a report's receive rate
+PACING_FACTOR = 2.5      # the pacer may send this much faster than the target while a frame goes out
+
+UPGRADE_HEADROOM = 0.6   # frames this far under budget try the next better rung of the ladder
+LADDER_DOWN_FRAMES = 3   # frames in a row over budget before a step down, one big frame is just a busy scene
+LADDER_UP_FRAMES = 30    # frames in a row well under budget before a step up, about a second
+
+
+class ReceiverStats:
+    """Client side counts and delay samples for the receiver reports"""
+
+    def __init__(self, now):
+        self.received = 0
+        self.expected = 0
+        self.bytes = 0
+        self.started = now
+        self.jitter = 0.0
+        self.last_transit = None
+        self.samples = deque(maxlen=TREND_WINDOW)  # (arrival, transit)
+
+    def on_frame(self, packets):
+        self.expected += packets
+
+    def on_packet(self, size):
+        self.received += 1
+        self.bytes += size
+
+    def on_first_packet(self, timestamp, now):
+        """First packet of a frame, `timestamp` straight from the header (the server's clock)"""
+        transit = now - timestamp
+        if self.last_transit is not None:
+            self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16
+        self.last_transit = transit
+        self.samples.append((now, transit))
+
+    def trend(self):
+        """Slope of the transit times, seconds of delay per second"""
+        if len(self.samples) < MIN_TREND_SAMPLES:
+            return 0.0
+        mean_t = sum(t for t, _ in self.samples) / len(self.samples)
+        mean_d = sum(d for _, d in self.samples) / len(self.samples)
+        variance = sum((t - mean_t) ** 2 for t, _ in self.samples)
+        covariance = sum((t - mean_t) * (d - mean_d) for t, d in self.samples)
+        return covariance / variance if variance else 0.0
+
+    def take_report(self, now):
+        report = RECEIVER_REPORT + struct.pack(RECEIVER_REPORT_FORMAT, self.received, self.expected,
+                                               min(self.bytes, 0xFFFFFFFF), now - self.started,
+                                               self.jitter, self.trend())
+        self.received = self.expected = self.bytes = 0
+        self.started = now
+        return report
+
+
+def unpack_receiver_report(packet):
+    """(received, expected, bytes, interval, jitter, delay trend)"""
+    return struct.unpack_from(RECEIVER_REPORT_FORMAT, packet, len(RECEIVER_REPORT))
+
+
+class BandwidthEstimator:
+    """Server side target bitrate of one client, the lower of a delay based and a loss based one"""
+
+    def __init__(self, initial=INITIAL_BITRATE):
+        self.delay_target = initial
+        self.loss_target = initial
+        self.receive_rate = None  # bits per second that made it, smoothed
+        self.loss = 0.0
+        self.jitter = 0.0
+        self.trend = 0.0
+        self.signal = "normal"
+        self.overuse_reports = 0
+        self.decreases = 0
+        self.last_report = None
+
+    @property
+    def target(self):
+        return min(max(min(self.delay_target, self.loss_target), MIN_BITRATE), MAX_BITRATE)
+
+    def on_report(self, received, expected, received_bytes, interval, jitter, trend, now):
+        elapsed = min(now - self.last_report, 1.0) if self.last_report is not None else 0.0
+        self.last_report = now
+        self.jitter, self.trend = jitter, trend
+        if interval > 0:
+            rate = received_bytes * 8 / interval
+            self.receive_rate = rate if self.receive_rate is None else \
+                self.receive_rate + RATE_SMOOTHING * (rate - self.receive_rate)
+        if expected > 0:
+            self.loss = max(0.0, 1.0 - received / expected)
+
+        # Delay based: back off while a queue grows, grow while the delay holds, wait while it drains
+        if trend > OVERUSE_TREND:
+            self.overuse_reports += 1
+            self.signal = "overuse" if self.overuse_reports >= OVERUSE_REPORTS else self.signal
+        else:
+            self.overuse_reports = 0
+            self.signal = "underuse" if trend < -OVERUSE_TREND else "normal"
+        if self.signal == "overuse":
+            if self.receive_rate:
+                self.delay_target = min(self.delay_target, DECREASE_FACTOR * self.receive_rate)
+                self.decreases += 1
+        elif self.signal == "normal":
+            self.delay_target *= (1 + INCREASE_PER_SECOND) ** elapsed
+        if self.receive_rate:
+            self.delay_target = min(self.delay_target, max(MAX_OVER_RECEIVE_RATE * self.receive_rate, MIN_BITRATE))
+
+        # Loss based: FEC and NACKs cover a little loss, a lot means the link is full anyway
+        if expected > 0:
+            if self.loss > HIGH_LOSS:
+                self.loss_target = self.target * (1 - 0.5 * self.loss)
+                self.decreases += 1
+            elif self.loss < LOW_LOSS:
+                self.loss_target = min(self.loss_target * LOSS_INCREASE, MAX_BITRATE)
+
+    @property
+    def pacing_rate(self):
+        """Bytes per second the pacer may send at"""
+        return self.target / 8 * PACING_FACTOR
+
+    def frame_budget(self, frame_interval):
+        """Bytes a frame may have to stay at the target"""
+        return self.target / 8 * frame_interval
+
+    def get_stats(self):
+        return {
+            "target_mbps": self.target / 1e6,
+            "receive_mbps": self.receive_rate / 1e6 if self.receive_rate is not None else None,
+            "loss": self.loss,
+            "jitter_ms": self.jitter * 1000,
+            "trend_ms_per_s": self.trend * 1000,
+            "signal": self.signal,
+            "decreases": self.decreases,
+        }
+
+
+class EncodingLadder:
+    """
+    Encoder settings from best to worst, one step down after LADDER_DOWN_FRAMES frames in a
+    row went over their budget and one up after LADDER_UP_FRAMES were well under it, so it
+    doesn't flip between two rungs on every frame. Stepping down is quicker, that's where
+    the queues build up. JPEG frames don't depend on each other, so a step can happen on any frame.
+    """
+
+    def __init__(self, rungs):
+        self.rungs = rungs
+        self.index = 0
+        self.over = 0   # frames in a row over budget
+        self.under = 0  # frames in a row well under it
+        self.changes = 0
+
+    @property
+    def current(self):
+        return self.rungs[self.index]
+
+    def on_frame(self, size, budget):
+        self.over = self.over + 1 if size > budget else 0
+        self.under = self.under + 1 if size < budget * UPGRADE_HEADROOM else 0
+        if self.over >= LADDER_DOWN_FRAMES and self.index < len(self.rungs) - 1:
+            self._step(1)
+        elif self.under >= LADDER_UP_FRAMES and self.index > 0:
+            self._step(-1)
+
+    def _step(self, direction):
+        self.index += direction
+        self.over = self.under = 0
+        self.changes += 1
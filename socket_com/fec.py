@@ -0,0 +1,65 @@
+"""
+Forward error correction for the UDP frame packets, so a lost packet doesn't throw the whole
+frame away and there's no round trip to ask for it again.
+
+After the data packets of a frame the server sends `parity` XOR packets. Parity j covers the
+data packets j, j + parity, j + 2 * parity, ... so the groups are interleaved and a burst of up
+to `parity` consecutive lost packets (what Wi-Fi usually does) still costs at most one packet
+per group. A group with exactly one packet missing is rebuilt from the rest of it, which
+the client's reassembler does in place (frame_packets.FrameSlot).
+
+The parity ratio follows the loss in the client's receiver reports (congestion.py), see
+FecController.
+"""
+
+import math
+
+import numpy as np
+
+MIN_FEC_RATIO = 0.05   # parity per data packet with no measured loss, a little insurance
+MAX_FEC_RATIO = 0.5
+LOSS_HEADROOM = 4.0    # ratio = loss * this, XOR only fixes one loss per group
+LOSS_SMOOTHING = 0.3   # EWMA weight of a new receiver report
+
+
+def parity_count(data_packets, ratio):
+    if ratio <= 0 or data_packets == 0:
+        return 0
+    return min(max(math.ceil(data_packets * ratio), 1), data_packets)
+
+
+def make_parity(payload, packet_size, parity):
+    """
+    The parity packets of a payload that is sent in packet_size chunks. The last chunk is
+    zero padded, so every parity packet is packet_size long.
+    """
+    if parity == 0:
+        return []
+    data_packets = -(-len(payload) // packet_size)
+    padded = np.zeros(data_packets * packet_size, dtype=np.uint8)
+    padded[:len(payload)] = np.frombuffer(payload, dtype=np.uint8)
+    chunks = padded.reshape(data_packets, packet_size)
+    return [np.bitwise_xor.reduce(chunks[j::parity], axis=0).tobytes() for j in range(parity)]
+
+
+class FecController:
+    """Parity ratio for the server, from the loss in the client's receiver reports unless fixed"""
+
+    def __init__(self, ratio=None):
+        self.fixed_ratio = ratio
+        self.loss = 0.0
+        self.reports = 0
+
+    def on_loss_report(self, received, expected):
+        if expected <= 0:
+            return
+        loss = max(0.0, 1.0 - received / expected)
+        self.loss = loss if not self.reports else self.loss + LOSS_SMOOTHING * (loss - self.loss)
+        self.reports += 1
+
+    @property
+    def ratio(self):
+        if self.fixed_ratio is not None:
+            return self.fixed_ratio
+        return min(max(self.loss * LOSS_HEADROOM, MIN_FEC_RATIO), MAX_FEC_RATIO)
+
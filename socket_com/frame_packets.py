@@ -0,0 +1,333 @@
+"""
+How frames travel as UDP packets: the packet header, and the client's reassembly.
+
+Packet layout (little endian), followed by the payload:
+    [1 byte version][1 byte flags][2 bytes packet index][4 bytes frame sequence][8 bytes timestamp]
+    [4 bytes frame size][2 bytes data packets][2 bytes parity packets][2 bytes packet size]
+
+Data packet i carries bytes i * packet_size onwards of the encrypted frame, parity packets
+(see fec.py) have indices from data_packets up. The version byte is never an ASCII letter,
+so data packets can't be mistaken for the control packets (SYNC, NACK, ...) on the same socket.
+
+On the server FrameSender sends a frame without copying it: the headers are packed into one
+reused buffer and every datagram goes out as a scatter/gather sendmsg of a header slice and a
+memoryview of the ciphertext. On Linux, bursts of packets go out as a single sendmsg with UDP
+GSO (the kernel cuts them into datagrams), elsewhere it's one sendmsg per packet. A token
+bucket spreads each frame's bursts over part of the frame interval instead of dumping ~100
+packets at once into switch and receiver buffers. The pauses are asyncio sleeps, so one event
+loop can stream to many clients at once.
+
+The reassembler writes every payload straight into its slot of a buffer allocated for the
+frame on its first packet, tracks what arrived in a bitmap and hands out the finished frame
+as a memoryview of that buffer, so nothing is joined or copied again. Incomplete frames time
+out, and only MAX_FRAMES_IN_FLIGHT frames are kept at once.
+"""
+
+import asyncio
+import errno
+import socket
+import struct
+import sys
+import time
+
+import numpy as np
+
+PACKET_VERSION = 1
+HEADER_FORMAT = "<BBHIdIHHH"
+HEADER = struct.Struct(HEADER_FORMAT)
+HEADER_SIZE = HEADER.size
+FLAG_RETRANSMIT = 0x01  # resent after a NACK, see nack.py
+
+MAX_FRAMES_IN_FLIGHT = 4
+FRAME_TIMEOUT = 0.1  # seconds from a frame's first packet until it's given up on
+MAX_FRAME_BYTES = 32 * 1024 * 1024  # frames claiming to be bigger are garbage
+
+
+PACING_SHARE = 0.3        # part of the frame interval a frame's packets are spread over, the
+                          # server only encodes the next frame after that so keep it well under 1
+PACING_BURST_PACKETS = 16  # packets that may go out back to back, also the GSO batch size
+MAX_PACING_GAP = 0.0015   # bursts shrink to keep the pauses between them this short, down to single
+                          # packets, below that rate the pauses grow (nack.NackTracker waits for them)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)  # Linux, not in the socket module before 3.12
+UDP_MAX_SEGMENTS = 64     # kernel limit of datagrams per GSO send
+GSO_MAX_BYTES = 65000
+GSO_UNSUPPORTED = (errno.EINVAL, errno.EIO, errno.ENOPROTOOPT, errno.EOPNOTSUPP)  # old kernel or NIC
+
+
+def frame_nonce(iv, sequence):
+    """AES-GCM nonce of a frame, unique per frame of a session"""
+    return iv[:8] + struct.pack("<Q", sequence)
+
+
+def pack_header(index, sequence, timestamp, frame_size, data_packets, parity, packet_size, flags=0):
+    return HEADER.pack(PACKET_VERSION, flags, index, sequence, timestamp,
+                       frame_size, data_packets, parity, packet_size)
+
+
+def unpack_header(packet):
+    """
+    (flags, index, sequence, timestamp, frame size, data packets, parity, packet size),
+    None when it isn't a data packet of this version
+    """
+    if len(packet) < HEADER_SIZE or packet[0] != PACKET_VERSION:
+        return None
+    return struct.unpack_from(HEADER_FORMAT, packet)[1:]
+
+
+class TokenBucketPacer:
+    """
+    Lets `burst` bytes out back to back, after that only `rate` bytes per second. A send may
+    take the bucket below zero, the next one waits until it's paid back.
+    """
+
+    def __init__(self, burst):
+        self.burst = burst
+        self.rate = None  # bytes per second, None doesn't pace
+        self.tokens = burst
+        self.last = time.perf_counter()
+        self.waited = 0.0
+
+    def delay(self, size):
+        """Seconds to wait before sending `size` bytes, which are taken from the bucket"""
+        now = time.perf_counter()
+        if self.rate is None:
+            self.last = now
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + max(now - self.last, 0.0) * self.rate)
+        delay = 0.0
+        if self.tokens < 0:
+            delay = -self.tokens / self.rate
+            self.tokens = 0.0
+            self.waited += delay
+        self.last = now + delay
+        self.tokens -= size
+        return delay
+
+
+class FrameSender:
+    """
+    Sends frames as header + payload datagrams to one client, see the module docstring.
+    One send_frame at a time (the header buffer is shared), resend() can run in between.
+    The socket may be non-blocking, packets that don't fit in its buffer are dropped.
+    """
+
+    def __init__(self, sock, addr, packet_size=1400, use_gso=None):
+        self.sock = sock
+        self.addr = addr
+        self.packet_size = packet_size
+        self.segment_size = HEADER_SIZE + packet_size
+        self.can_sendmsg = hasattr(sock, "sendmsg")  # not on Windows
+        self.use_gso = self.can_sendmsg and sys.platform.startswith("linux") if use_gso is None else use_gso
+        self.batch_packets = min(PACING_BURST_PACKETS, UDP_MAX_SEGMENTS, GSO_MAX_BYTES // self.segment_size)
+        self.pacer = TokenBucketPacer(PACING_BURST_PACKETS * self.segment_size)
+        self.headers = bytearray()
+        self.syscalls = 0
+        self.dropped = 0
+
+    def packetize(self, payload, parity_packets=()):
+        """
+        Memoryview slices of the payload plus the parity packets, in packet index order.
+        Nothing is copied, the views keep the payload alive (for the retransmit buffer).
+        """
+        view = memoryview(payload)
+        packets = [view[i:i + self.packet_size] for i in range(0, len(view), self.packet_size)]
+        return packets + [memoryview(p) for p in parity_packets]
+
+    async def send_frame(self, sequence, timestamp, packets, frame_size, data_packets, duration=None,
+                         max_rate=None):
+        """
+        Sends packetize() output, paced over `duration` seconds if given but no faster than
+        `max_rate` bytes per second. Returns the number of send syscalls it took.
+        """
+        parity = len(packets) - data_packets
+        if len(self.headers) < len(packets) * HEADER_SIZE:
+            self.headers = bytearray(len(packets) * HEADER_SIZE)
+        headers = memoryview(self.headers)
+        for i in range(len(packets)):
+            HEADER.pack_into(self.headers, i * HEADER_SIZE, PACKET_VERSION, 0, i, sequence, timestamp,
+                             frame_size, data_packets, parity, self.packet_size)
+
+        total = sum(len(p) for p in packets) + len(packets) * HEADER_SIZE
+        batch_packets = self.batch_packets
+        rate = None
+        if duration:
+            rate = min(total / duration, max_rate) if max_rate else total / duration
+            # Smaller bursts at low rates, so the packets go out evenly instead of in a few
+            # bursts with long pauses between them
+            batch_packets = max(1, min(batch_packets, int(rate * MAX_PACING_GAP) // self.segment_size))
+        self.pacer.burst = batch_packets * self.segment_size
+        self.pacer.rate = rate
+
+        syscalls = 0
+        batch = []
+        for i, packet in enumerate(packets):
+            batch.append((headers[i * HEADER_SIZE:(i + 1) * HEADER_SIZE], packet))
+            # A GSO send cuts at segment_size, so only the last datagram of a batch may be short
+            if (len(batch) == batch_packets or len(packet) < self.packet_size
+                    or i == len(packets) - 1):
+                delay = self.pacer.delay(sum(HEADER_SIZE + len(p) for _, p in batch))
+                if delay:
+                    await asyncio.sleep(delay)
+                syscalls += self._send_batch(batch)
+                batch = []
+        self.syscalls += syscalls
+        return syscalls
+
+    def _send_batch(self, batch):
+        if self.use_gso and len(batch) > 1:
+            buffers = [buffer for pair in batch for buffer in pair]
+            try:
+                self.sock.sendmsg(buffers, [(socket.SOL_UDP, UDP_SEGMENT, struct.pack("H", self.segment_size))],
+                                  0, self.addr)
+                return 1
+            except BlockingIOError:
+                self.dropped += len(batch)
+                return 1
+            except OSError as e:
+                if e.errno not in GSO_UNSUPPORTED:
+                    print(f"Error sending packets: {e}")
+                    return 1
+                print(f"UDP GSO not available ({e}), sending packet by packet")
+                self.use_gso = False
+        for header, packet in batch:
+            self._send_one(header, packet)
+        return len(batch)
+
+    def _send_one(self, header, packet):
+        try:
+            if self.can_sendmsg:
+                self.sock.sendmsg([header, packet], [], 0, self.addr)
+            else:
+                self.sock.sendto(bytes(header) + bytes(packet), self.addr)
+        except BlockingIOError:
+            self.dropped += 1
+        except Exception as e:
+            print(f"Error sending packet: {e}")
+
+    def resend(self, sequence, timestamp, frame_size, data_packets, parity, packets):
+        """Sends the (index, packet) pairs a NACK asked for again, flagged as retransmissions"""
+        for index, packet in packets:
+            header = pack_header(index, sequence, timestamp, frame_size, data_packets, parity,
+                                 self.packet_size, FLAG_RETRANSMIT)
+            self._send_one(header, packet)
+        return len(packets)
+
+
+class FrameSlot:
+    """Buffer and arrival bitmap of one frame being received"""
+
+    def __init__(self, sequence, timestamp, frame_size, data_packets, parity, packet_size, now):
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.frame_size = frame_size
+        self.total = data_packets
+        self.parity = parity
+        self.packet_size = packet_size
+        # Zeroed, so packets that never arrive (and the last one's padding) XOR as nothing in FEC
+        self.buffer = bytearray(data_packets * packet_size)
+        self.chunks = np.frombuffer(self.buffer, dtype=np.uint8).reshape(data_packets, packet_size)
+        self.received = 0  # bitmap of the data packets that are in
+        self.count = 0
+        self.parity_packets = {}
+        self.recovered = 0
+        self.first_packet_at = now
+        self.last_packet_at = now
+
+    @property
+    def complete(self):
+        return self.count == self.total
+
+    def missing(self):
+        return [i for i in range(self.total) if not self.received >> i & 1]
+
+    def add(self, index, payload, now):
+        self.last_packet_at = now
+        if index < self.total:
+            if self.received >> index & 1 or len(payload) > self.packet_size:
+                return
+            offset = index * self.packet_size
+            self.buffer[offset:offset + len(payload)] = payload
+            self.received |= 1 << index
+            self.count += 1
+        elif index < self.total + self.parity and len(payload) <= self.packet_size:
+            self.parity_packets[index - self.total] = bytes(payload)
+        if not self.complete and self.count + len(self.parity_packets) >= self.total:
+            self._recover()
+
+    def _recover(self):
+        # A group with one packet missing: parity XOR everything that's there is the missing packet,
+        # and the missing slot is still zero so it can just be part of the XOR
+        for j, parity in self.parity_packets.items():
+            group = range(j, self.total, self.parity)
+            missing = [i for i in group if not self.received >> i & 1]
+            if len(missing) != 1:
+                continue
+            rebuilt = np.bitwise_xor.reduce(self.chunks[j::self.parity], axis=0)
+            rebuilt[:len(parity)] ^= np.frombuffer(parity, dtype=np.uint8)
+            self.chunks[missing[0]] = rebuilt
+            self.received |= 1 << missing[0]
+            self.count += 1
+            self.recovered += 1
+
+    def frame(self):
+        """The reassembled frame, a view of the buffer"""
+        return memoryview(self.buffer)[:self.frame_size]
+
+
+class Reassembler:
+    """
+    Frames being received, by sequence. A frame that completes is handed out once, frames
+    older than the newest finished one are dropped (they'd be shown out of order), and when
+    more than max_frames are in flight the oldest goes.
+    """
+
+    def __init__(self, max_frames=MAX_FRAMES_IN_FLIGHT, timeout=FRAME_TIMEOUT):
+        self.max_frames = max_frames
+        self.timeout = timeout
+        self.frames = {}  # sequence -> FrameSlot
+        self.last_done = -1  # newest sequence handed out or given up on
+        self.completed = 0
+        self.frames_recovered = 0
+        self.packets_recovered = 0
+        self.timed_out = 0
+        self.evicted = 0
+        self.late_packets = 0
+
+    def add(self, header, payload, now):
+        """Takes one data packet, returns its FrameSlot if that made the frame complete"""
+        _, index, sequence, timestamp, frame_size, data_packets, parity, packet_size = header
+        if sequence <= self.last_done:
+            self.late_packets += 1
+            return None
+
+        slot = self.frames.get(sequence)
+        if slot is None:
+            if (data_packets == 0 or packet_size == 0 or frame_size > data_packets * packet_size
+                    or data_packets * packet_size > MAX_FRAME_BYTES):
+                return None
+            while len(self.frames) >= self.max_frames:
+                del self.frames[min(self.frames)]
+                self.evicted += 1
+            slot = self.frames[sequence] = FrameSlot(sequence, timestamp, frame_size, data_packets,
+                                                     parity, packet_size, now)
+        slot.add(index, payload, now)
+        if not slot.complete:
+            return None
+
+        self.completed += 1
+        if slot.recovered:
+            self.frames_recovered += 1
+            self.packets_recovered += slot.recovered
+        self.discard(sequence)
+        return slot
+
+    def discard(self, sequence):
+        """Done with this frame, drops it and every older one still in flight"""
+        self.last_done = max(self.last_done, sequence)
+        for old in [s for s in self.frames if s <= sequence]:
+            del self.frames[old]
+
+    def expire(self, now):
+        for sequence in [s for s, slot in self.frames.items() if now - slot.first_packet_at > self.timeout]:
+            del self.frames[sequence]
+            self.timed_out += 1
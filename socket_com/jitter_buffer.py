@@ -0,0 +1,114 @@
+"""
+Adaptive playout (jitter) buffer for the client. Instead of throwing away every frame older
+than a fixed cutoff, each frame is held until sent time + playout delay and then released,
+in sequence order, so frames come out at the steady intervals they were captured at even
+when the network delivers them unevenly.
+
+The playout delay follows the network: it's the PLAYOUT_PERCENTILE of how long recent frames
+took from the server's timestamp to being ready here (sent, reassembled, repaired by FEC or
+NACKs, decoded). It goes up right away when frames start coming later and comes down slowly.
+The percentile is the latency versus smoothness knob: lower plays sooner and loses the
+slower frames, higher waits for nearly all of them.
+
+Frames that are ready after their playout time (plus MAX_LATENESS) or after a newer frame
+was played are late. They still count towards the delay, and the client only gives up on a
+frame LATE_MARGIN after that (max_frame_age). The frames it gives up on count too (too_old):
+when the delay jumps by more than the margin no frame completes anymore, and without them
+the buffer would never learn that the network got slower. When the player falls behind and
+several frames are due at once, only the newest is played and the others count as dropped.
+"""
+
+import math
+from collections import deque
+
+PLAYOUT_PERCENTILE = 0.95   # of the recent frame delays the playout delay is set to
+PLAYOUT_WINDOW = 150        # frames, about 5 s at 30 fps
+INITIAL_PLAYOUT_DELAY = 0.03  # seconds, until there are delay samples
+MIN_PLAYOUT_DELAY = 0.005
+MAX_PLAYOUT_DELAY = 0.1     # frame_packets.FRAME_TIMEOUT and nack.RETRANSMIT_MAX_AGE give up around there anyway
+PLAYOUT_MARGIN = 0.002
+PLAYOUT_DECAY = 0.05        # how far the delay moves down towards a lower target per frame
+MAX_LATENESS = 0.01         # a frame ready this much after its playout time still plays, right away
+LATE_MARGIN = 0.02          # frames this far past playing still complete, so the delay can grow
+MAX_BUFFERED_FRAMES = 16
+
+
+class JitterBuffer:
+    """Frames (anything, the client puts decoded images in) by sequence, with their playout times"""
+
+    def __init__(self, percentile=PLAYOUT_PERCENTILE, window=PLAYOUT_WINDOW):
+        self.percentile = percentile
+        self.delays = deque(maxlen=window)
+        self.playout_delay = INITIAL_PLAYOUT_DELAY
+        self.frames = {}  # sequence -> (playout at, frame)
+        self.last_played = -1
+        self.last_too_old = -1
+        self.played = 0
+        self.late = 0
+        self.dropped = 0
+
+    def push(self, sequence, sent_at, frame, now):
+        """A frame that's ready to be played, `sent_at` on our clock. False if it's too late for that."""
+        self._on_delay(now - sent_at)
+        if sequence <= self.last_played or now > sent_at + self.playout_delay + MAX_LATENESS:
+            self.late += 1
+            return False
+        self.frames[sequence] = (sent_at + self.playout_delay, frame)
+        while len(self.frames) > MAX_BUFFERED_FRAMES:
+            del self.frames[min(self.frames)]
+            self.dropped += 1
+        return True
+
+    @property
+    def max_frame_age(self):
+        """Seconds after being sent a frame is given up on, its packets dropped and not NACKed"""
+        return self.playout_delay + MAX_LATENESS + LATE_MARGIN
+
+    def too_old(self, sequence, sent_at, now):
+        """A packet of a frame past max_frame_age, that the client drops. Counts once per frame."""
+        if sequence <= self.last_too_old:
+            return
+        self.last_too_old = sequence
+        self.late += 1
+        self._on_delay(now - sent_at)
+
+    def next_playout(self):
+        """Local time the next frame is due, None if there's none"""
+        if not self.frames:
+            return None
+        return self.frames[min(self.frames)][0]
+
+    def pop(self, now):
+        """The frame to play now, None if none is due. Older frames that are due too are dropped."""
+        due = [sequence for sequence, (playout_at, _) in self.frames.items() if playout_at <= now]
+        if not due:
+            return None
+        newest = max(due)
+        for sequence in [s for s in self.frames if s < newest]:
+            del self.frames[sequence]
+            self.dropped += 1
+        _, frame = self.frames.pop(newest)
+        self.last_played = newest
+        self.played += 1
+        return frame
+
+    def _on_delay(self, delay):
+        self.delays.append(delay)
+        ordered = sorted(self.delays)
+        index = min(max(math.ceil(self.percentile * len(ordered)) - 1, 0), len(ordered) - 1)
+        target = min(max(ordered[index] + PLAYOUT_MARGIN, MIN_PLAYOUT_DELAY), MAX_PLAYOUT_DELAY)
+        # Up at once, frames are being lost to it, down slowly so one quiet moment doesn't undo it
+        if target > self.playout_delay:
+            self.playout_delay = target
+        else:
+            self.playout_delay += PLAYOUT_DECAY * (target - self.playout_delay)
+
+    def get_stats(self):
+        return {
+            "playout_delay_ms": self.playout_delay * 1000,
+            "percentile": self.percentile,
+            "played": self.played,
+            "late": self.late,
+            "dropped": self.dropped,
+            "buffered": len(self.frames),
+        }
@@ -0,0 +1,164 @@
+"""
+Per stage latency histograms shared by the UDP server/client and the Django consumer.
+Recording a sample is a log and an increment under a lock, cheap enough to do for
+every frame. Snapshots give p50/p95/p99 per stage.
+"""
+
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The stages of the motion to photon path, in order
+STAGES = (
+    "capture", "convert", "encode", "encrypt", "send",
+    "receive", "decrypt", "decode", "display",
+)
+
+# Buckets grow by 5% from 1 us up to ~100 s, so percentiles are within 5%
+MIN_SECONDS = 1e-6
+GROWTH = 1.05
+BUCKETS = int(math.log(1e8) / math.log(GROWTH)) + 2
+_LOG_GROWTH = math.log(GROWTH)
+
+
+class LatencyHistogram:
+    """Log bucketed histogram of durations in seconds"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds <= MIN_SECONDS:
+            index = 0
+        else:
+            index = min(int(math.log(seconds / MIN_SECONDS) / _LOG_GROWTH) + 1, BUCKETS - 1)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, p):
+        """Upper edge of the bucket holding the p-th percentile, in seconds"""
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+            maximum = self.max
+        if not count:
+            return None
+        target = count * p / 100.0
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= target:
+                return min(MIN_SECONDS * GROWTH ** index, maximum)
+        return maximum
+
+    def snapshot(self):
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000,
+            "p50_ms": self.percentile(50) * 1000,
+            "p95_ms": self.percentile(95) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": self.max * 1000,
+        }
+
+    def merge(self, other):
+        """Adds another histogram's samples to this one"""
+        with other.lock:
+            counts = list(other.counts)
+            count, total, maximum = other.count, other.total, other.max
+        with self.lock:
+            self.counts = [a + b for a, b in zip(self.counts, counts)]
+            self.count += count
+            self.total += total
+            self.max = max(self.max, maximum)
+
+    def reset(self):
+        with self.lock:
+            self.counts = [0] * BUCKETS
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+
+
+class StageMetrics:
+    """Histograms by stage name, created on first use"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.started = time.time()
+
+    def histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(stage, LatencyHistogram())
+        return histogram
+
+    def record(self, stage, seconds):
+        self.histogram(stage).record(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        """with metrics.time("encode"): ..."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def snapshot(self):
+        # Known stages first in pipeline order, anything else after
+        names = [s for s in STAGES if s in self.histograms]
+        names += sorted(s for s in self.histograms if s not in STAGES)
+        return {
+            "uptime_s": time.time() - self.started,
+            "stages": {name: self.histograms[name].snapshot() for name in names},
+        }
+
+    def reset(self):
+        with self.lock:
+            for histogram in self.histograms.values():
+                histogram.reset()
+
+
+# Process wide registry, everything records here unless told otherwise
+metrics = StageMetrics()
+
+
+def serve_metrics(port, registry=None, host="localhost"):
+    """
+    Serves the snapshot as JSON on http://host:port/ from a daemon thread,
+    for the standalone scripts that don't run inside Django.
+    """
+    registry = registry or metrics
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(registry.snapshot()).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # don't spam the frame logs
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True, name="metrics")
+    thread.start()
+    return server
@@ -0,0 +1,153 @@
+"""
+Selective retransmission for the UDP frame packets. The client NACKs the data packets of a
+frame that are still missing once the frame's packets (and FEC parity) stopped coming, and the
+server resends just those from a short retransmit buffer. Both sides give up on a frame once
+it is too old to be shown, so on a LAN where a round trip is a fraction of a frame interval
+most losses are repaired in time, and on slow links nothing is resent for nothing.
+"""
+
+import struct
+from collections import OrderedDict
+
+NACK = b"NACK"  # + frame sequence (I), count (H), then count packet indices (H)
+NACK_FORMAT = "<IH"
+MAX_NACK_INDICES = 256  # per NACK packet, more than that and the frame is a lost cause anyway
+
+NACK_DELAY = 0.003        # seconds without packets before a frame's holes count as lost
+PACKET_GAP_FACTOR = 2.5   # or this many times the pacer's gap between packets, when that's longer
+MAX_PACKET_GAP = 0.02     # gaps longer than this are a stall or loss, not pacing
+PACKET_GAP_DECAY = 0.02   # how fast the gap estimate comes down per packet
+RENACK_RTT_FACTOR = 1.5   # NACK again if the retransmission didn't show up within this many RTTs
+
+RETRANSMIT_BUFFER_BYTES = 8 * 1024 * 1024
+RETRANSMIT_MAX_AGE = 0.1  # seconds, frames older than this aren't resent
+
+
+def pack_nack(sequence, indices):
+    indices = indices[:MAX_NACK_INDICES]
+    return NACK + struct.pack(NACK_FORMAT, sequence, len(indices)) + struct.pack(f"<{len(indices)}H", *indices)
+
+
+def unpack_nack(packet):
+    """(sequence, [packet indices])"""
+    offset = len(NACK)
+    sequence, count = struct.unpack_from(NACK_FORMAT, packet, offset)
+    offset += struct.calcsize(NACK_FORMAT)
+    return sequence, list(struct.unpack_from(f"<{count}H", packet, offset))
+
+
+class RetransmitBuffer:
+    """
+    Server side references to the packets of the last frames, by (sequence, packet index),
+    along with what's needed to rebuild their headers. Bounded by bytes and age, the oldest
+    frames go first. The server's send tasks and its NACK handling all run on one event loop,
+    so there's nothing to lock.
+    """
+
+    def __init__(self, max_bytes=RETRANSMIT_BUFFER_BYTES, max_age=RETRANSMIT_MAX_AGE):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.frames = OrderedDict()  # sequence -> (sent at, [packets], header info)
+        self.size = 0
+        self.retransmitted = 0
+        self.too_late = 0
+
+    def add(self, sequence, sent_at, packets, info=None):
+        self.frames[sequence] = (sent_at, packets, info)
+        self.size += sum(len(p) for p in packets)
+        while self.size > self.max_bytes and len(self.frames) > 1:
+            _, (_, old, _) = self.frames.popitem(last=False)
+            self.size -= sum(len(p) for p in old)
+
+    def get(self, sequence, indices, now):
+        """
+        (sent at, header info, [(index, packet)]) to resend for a NACK,
+        None if the frame is gone or too old
+        """
+        entry = self.frames.get(sequence)
+        if entry is None or now - entry[0] > self.max_age:
+            self.too_late += 1
+            return None
+        sent_at, packets, info = entry
+        resend = [(i, packets[i]) for i in indices if i < len(packets)]
+        self.retransmitted += len(resend)
+        return sent_at, info, resend
+
+
+class NackTracker:
+    """
+    Client side: decides when to NACK which packets of the frames being received.
+    Resent packets come back with frame_packets.FLAG_RETRANSMIT set.
+
+    At low bitrates the server's pacer sends single packets with longer pauses between
+    them, so the pause that counts as loss follows the largest gap seen between packets
+    of a frame. It goes up at once and comes down slowly.
+    """
+
+    def __init__(self):
+        self.frames = {}  # sequence -> [sent at (local clock), last packet at, last NACK at]
+        self.nacked = set()  # sequences something was NACKed for
+        self.packet_gap = 0.0
+        self.packets_nacked = 0
+        self.frames_repaired = 0
+
+    @property
+    def nack_delay(self):
+        return max(NACK_DELAY, self.packet_gap * PACKET_GAP_FACTOR)
+
+    def on_packet(self, sequence, sent_at, now, retransmit=False):
+        state = self.frames.get(sequence)
+        if state is None:
+            self.frames[sequence] = [sent_at, now, None]
+            return
+        if retransmit:
+            # A round trip after the rest, says nothing about the pacing
+            state[1] = now
+            return
+        gap = min(now - state[1], MAX_PACKET_GAP)
+        if gap > self.packet_gap:
+            self.packet_gap = gap
+        else:
+            self.packet_gap += PACKET_GAP_DECAY * (gap - self.packet_gap)
+        state[1] = now
+
+    def due(self, frames, rtt, max_frame_age, now):
+        """
+        [(sequence, missing data packet indices)] to NACK now. `frames` are the reassembler's
+        FrameSlots, whatever FEC could rebuild isn't missing anymore. Frames older than
+        `max_frame_age` by the time a resend could arrive aren't worth asking for.
+        """
+        rtt = rtt or 0.0
+        # Frames the reassembler finished, dropped or timed out need nothing anymore
+        for sequence in [s for s in self.frames if s not in frames]:
+            self.forget(sequence)
+        newest = max(self.frames, default=None)
+        nacks = []
+        for sequence, state in self.frames.items():
+            sent_at, last_packet, last_nack = state
+            frame = frames[sequence]
+            if frame.complete:
+                continue
+            # Not worth asking if the answer can't make it before the frame is too old
+            if now + rtt > sent_at + max_frame_age:
+                continue
+            # Packets of a newer frame mean this one's are all sent, otherwise wait for a pause
+            if sequence == newest and now - last_packet < self.nack_delay:
+                continue
+            if last_nack is not None and now - last_nack < max(rtt * RENACK_RTT_FACTOR, self.nack_delay):
+                continue
+            missing = frame.missing()[:MAX_NACK_INDICES]
+            if missing:
+                state[2] = now
+                self.nacked.add(sequence)
+                self.packets_nacked += len(missing)
+                nacks.append((sequence, missing))
+        return nacks
+
+    def forget(self, sequence, completed=False):
+        """Frame shown or given up on"""
+        self.frames.pop(sequence, None)
+        if sequence in self.nacked:
+            self.nacked.discard(sequence)
+            if completed:
+                self.frames_repaired += 1
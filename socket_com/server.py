@@ -1,3 +1,4 @@
+import asyncio
 import socket
 import cv2
 import struct
@@ -5,9 +6,16 @@ import rsa
 import time
 import os
 from threading import Thread
-from queue import Queue
 import signal
 
+from metrics import metrics, serve_metrics
+from clock_sync import SYNC_REQUEST, pack_sync_response
+from striped_jpeg import encode_striped_jpeg
+from fec import FecController, make_parity, parity_count
+from nack import NACK, RetransmitBuffer, unpack_nack
+from frame_packets import PACING_SHARE, FrameSender, frame_nonce
+from congestion import RECEIVER_REPORT, BandwidthEstimator, EncodingLadder, unpack_receiver_report
+
 try:
     from Crypto.Cipher import AES
 
@@ -19,16 +27,345 @@ except ImportError:
 
 # Global flag for shutdown, maybe I should remove the signaling
 RUNNING = True
+HOST = "localhost"
+PORT = 9999
+METRICS_PORT = 9100  # GET http://localhost:9100/ for per stage latency percentiles
+JPEG_QUALITY = 20
+USE_CONGESTION_CONTROL = True  # follow each client's receiver reports with the encoding and pacing, see congestion.py
+ENCODE_LADDER = ((JPEG_QUALITY, 1.0), (15, 1.0), (10, 1.0), (10, 0.75), (8, 0.5), (5, 0.5))  # (quality, scale), best first
+USE_FEC = True  # XOR parity packets after each frame so the client can rebuild lost packets, see fec.py
+FEC_RATIO = None  # parity packets per data packet, None follows the loss in the client's receiver reports
+PACKET_SIZE = 1400  # Larger packets for 1080p, TODO: DYNAMIC
+USE_PACING = True  # spread each frame's packets over PACING_SHARE of the frame interval instead of one burst
+CLIENT_TIMEOUT = 5.0  # seconds without a packet from a client before it's dropped, they sync every 2 s
+RATE_SLACK = 0.005  # a frame this early for a client's fps limit still goes, capture timing jitters
+TERMINATE = b"TERMINATE"
+RESET = b"RESET"  # answer to control packets from a client without a session, it sends a new key
 
 
-def capture_frames(cap, frame_queue):
-    """Thread to capture frames and put them in a queue"""
+def capture_frames(cap, capture):
+    """Thread to capture frames, only the newest one is kept for the stream loop"""
     while RUNNING and cap.isOpened():
+        capture_start = time.perf_counter()
         ret, frame = cap.read()
-        if ret:
-            frame_queue.put(frame)
-        else:
+        metrics.record("capture", time.perf_counter() - capture_start)
+        if not ret:
             break
+        capture.put(frame)
+    capture.put(None)
+
+
+class SharedCapture:
+    """Newest captured frame, handed from the capture thread to the event loop"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+        self.frame = None
+        self.closed = False
+
+    def put(self, frame):
+        # from the capture thread, None when the camera is gone
+        try:
+            self.loop.call_soon_threadsafe(self._set, frame)
+        except RuntimeError:
+            pass  # loop already closed on shutdown
+
+    def _set(self, frame):
+        if frame is None:
+            self.closed = True
+        else:
+            self.frame = frame
+        self.event.set()
+
+    async def next_frame(self, timeout=0.5):
+        """The newest frame not taken yet, None on timeout"""
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self.event.clear()
+        frame, self.frame = self.frame, None
+        return frame
+
+
+def encode_frame(frame, quality, scale):
+    # Encode frame to JPEG, in stripes on all cores for 1080p, stitched back into one JPEG
+    if scale != 1.0:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return encode_striped_jpeg(frame, quality)
+
+
+def parse_key_exchange(data):
+    """(encrypted AES key, iv, max fps or None) from a client's first packet, None if it isn't one"""
+    if len(data) < 8:
+        return None
+    enc_key_len = struct.unpack("Q", data[:8])[0]
+    enc_aes_key = data[8 : 8 + enc_key_len]
+    iv = data[8 + enc_key_len : 8 + enc_key_len + 16]
+    if not enc_aes_key or len(enc_aes_key) != enc_key_len or len(iv) != 16:
+        return None
+    rest = data[8 + enc_key_len + 16 :]
+    max_fps = struct.unpack("<H", rest[:2])[0] if len(rest) >= 2 else 0
+    return enc_aes_key, iv, max_fps or None
+
+
+class ClientSession:
+    """
+    One client: its AES key, sequence numbers, FEC, retransmit buffer, pacing, fps limit and
+    bandwidth estimate. Sessions on the same rung of the encoding ladder get the same encoded
+    frames, encrypted with their own key.
+    """
+
+    def __init__(self, sock, addr, enc_aes_key, aes_key, iv, max_fps=None):
+        self.addr = addr
+        self.enc_aes_key = enc_aes_key
+        self.aes_key = aes_key
+        self.iv = iv
+        self.min_interval = 1.0 / max_fps if max_fps else 0.0
+        self.next_frame_due = 0.0
+        self.sequence = 0
+        self.sending = False  # a frame is still being paced out, the next one skips this client
+        self.last_heard = time.time()
+        # Frame timestamps are on our clock, the client uses these to map them onto its own.
+        # The loss in receiver reports sizes the FEC, NACKs get packets that are still in the retransmit buffer resent.
+        # Resent packets carry the original timestamp (and the resent flag), so a frame that got
+        # too old on the way is dropped by the client like any other.
+        self.fec = FecController(FEC_RATIO)
+        self.retransmit = RetransmitBuffer()
+        self.sender = FrameSender(sock, addr, PACKET_SIZE)
+        # The client's receiver reports give a target bitrate, the encoding moves along the ladder
+        # to keep frames within it and the pacer sends no faster than a multiple of it
+        self.estimator = BandwidthEstimator()
+        self.ladder = EncodingLadder(ENCODE_LADDER if USE_CONGESTION_CONTROL else ENCODE_LADDER[:1])
+        self.skipped = 0
+
+    def ready(self, now):
+        if self.sending or now + RATE_SLACK < self.next_frame_due:
+            self.skipped += 1
+            return False
+        # From the later of when it was due and now, after a pause the next frame isn't due at once
+        self.next_frame_due = max(self.next_frame_due, now) + self.min_interval
+        return True
+
+    def encrypt(self, data, sequence):
+        # Straight into one buffer with room for the tag, so it's never copied to append it.
+        # Every frame gets its own nonce, GCM falls apart if one is ever used twice with a key.
+        if USE_PYCRYPTODOME:
+            aes = AES.new(self.aes_key, AES.MODE_GCM, nonce=frame_nonce(self.iv, sequence))
+            encrypted = bytearray(len(data) + 16)
+            aes.encrypt(data, output=memoryview(encrypted)[: len(data)])
+            encrypted[len(data) :] = aes.digest()
+        else:
+            # Pad for CBC
+            if len(data) % 16 != 0:
+                pad_len = 16 - (len(data) % 16)
+                data += bytes([pad_len] * pad_len)
+            aes = pyaes.AESModeOfOperationCBC(self.aes_key, iv=self.iv)
+            encrypted = b""
+            for i in range(0, len(data), 16):
+                encrypted += aes.encrypt(data[i : i + 16])
+        return encrypted
+
+    async def send_frame(self, data, frame_interval):
+        loop = asyncio.get_running_loop()
+        sequence = self.sequence
+        self.sequence += 1
+        try:
+            encrypt_start = time.time()
+            encrypted = await loop.run_in_executor(None, self.encrypt, data, sequence)
+            encrypt_time = (time.time() - encrypt_start) * 1000
+            metrics.record("encrypt", encrypt_time / 1000)
+
+            # Split into packets, memoryviews of the ciphertext plus the parity packets
+            total_packets = -(-len(encrypted) // PACKET_SIZE)
+            parity = parity_count(total_packets, self.fec.ratio) if USE_FEC else 0
+            parity_packets = []
+            if parity:
+                fec_start = time.time()
+                parity_packets = make_parity(encrypted, PACKET_SIZE, parity)
+                metrics.record("fec", time.time() - fec_start)
+            packets = self.sender.packetize(encrypted, parity_packets)
+            timestamp = time.time()
+            self.retransmit.add(sequence, timestamp, packets, (len(encrypted), total_packets, parity))
+
+            # Send packets with the versioned header from frame_packets.py: packet index, sequence, timestamp,
+            # frame size, data/parity packet counts and the packet size the client places payloads by.
+            # Parity packets come after the data ones, index >= total.
+            send_start = time.time()
+            # A client with an fps limit has longer between its frames to spread them over
+            frame_interval = max(frame_interval, self.min_interval)
+            self.ladder.on_frame(len(data), self.estimator.frame_budget(frame_interval))
+            syscalls = await self.sender.send_frame(
+                sequence, timestamp, packets, len(encrypted), total_packets,
+                frame_interval * PACING_SHARE if USE_PACING else None,
+                self.estimator.pacing_rate if USE_CONGESTION_CONTROL else None,
+            )
+            send_time = (time.time() - send_start) * 1000
+            metrics.record("send", send_time / 1000)
+            print(
+                f"{self.addr} frame {sequence} size: {len(data)} bytes, Packets: {total_packets} + {parity} parity, Encrypt: {encrypt_time:.2f} ms, Send: {send_time:.2f} ms ({syscalls} syscalls), Target: {self.estimator.target / 1e6:.1f} Mbit/s"
+            )
+        except Exception as e:
+            print(f"Error sending frame {sequence} to {self.addr}: {e}")
+        finally:
+            self.sending = False
+
+    def handle_control(self, data, received_at, transport):
+        """Clock sync requests, receiver reports and NACKs from the client"""
+        self.last_heard = received_at
+        if data.startswith(SYNC_REQUEST):
+            try:
+                transport.sendto(pack_sync_response(data, received_at), self.addr)
+            except Exception as e:
+                print(f"Error answering clock sync: {e}")
+        elif data.startswith(RECEIVER_REPORT):
+            received, expected, received_bytes, interval, jitter, trend = unpack_receiver_report(data)
+            self.fec.on_loss_report(received, expected)
+            self.estimator.on_report(received, expected, received_bytes, interval, jitter, trend, received_at)
+        elif data.startswith(NACK):
+            sequence, indices = unpack_nack(data)
+            entry = self.retransmit.get(sequence, indices, received_at)
+            if entry:
+                sent_at, (frame_size, data_packets, parity), packets = entry
+                self.sender.resend(sequence, sent_at, frame_size, data_packets, parity, packets)
+
+    def stats(self):
+        return (f"{self.sequence} frames sent, {self.skipped} skipped, retransmitted {self.retransmit.retransmitted} "
+                f"packets, {self.retransmit.too_late} NACKs came too late, send syscalls: {self.sender.syscalls}, "
+                f"{self.sender.dropped} packets dropped on a full socket buffer, "
+                f"{self.sender.pacer.waited:.2f} s spent pacing, {self.ladder.changes} encoding changes, bandwidth: {self.estimator.get_stats()}")
+
+
+class StreamServer(asyncio.DatagramProtocol):
+    """
+    Every client that sends a key exchange gets a session, and the stream until it sends
+    TERMINATE or goes quiet for CLIENT_TIMEOUT. Control packets from anyone else get a RESET,
+    so a client we dropped (or that talked to a previous run of the server) keys again.
+    """
+
+    def __init__(self, sock, priv_key):
+        self.sock = sock
+        self.priv_key = priv_key
+        self.transport = None
+        self.sessions = {}  # addr -> ClientSession
+        self.pending = set()  # addrs whose key is being decrypted
+        # Every key a session ever had. A new session starts at sequence 0 again, so a key that
+        # came back (a late or retried key exchange after the client timed out) would repeat nonces.
+        self.used_keys = set()
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        received_at = time.time()
+        session = self.sessions.get(addr)
+        if data == TERMINATE:
+            if session:
+                self.remove(addr, "disconnected")
+            return
+        if data[:4].isalpha():
+            if session:
+                session.handle_control(data, received_at, self.transport)
+            elif addr not in self.pending:
+                self.reset(addr)
+            return
+
+        # standard AES key reception, the client repeats it until frames arrive
+        key_exchange = parse_key_exchange(data)
+        if key_exchange is None or addr in self.pending:
+            return
+        if session and session.enc_aes_key == key_exchange[0]:
+            session.last_heard = received_at
+            return
+        self.pending.add(addr)
+        self.spawn(self.accept(addr, *key_exchange))
+
+    async def accept(self, addr, enc_aes_key, iv, max_fps):
+        loop = asyncio.get_running_loop()
+        try:
+            aes_key = await loop.run_in_executor(None, rsa.decrypt, enc_aes_key, self.priv_key)
+        except Exception as e:
+            print(f"Bad key from {addr}: {e}")
+            return
+        finally:
+            self.pending.discard(addr)
+        if aes_key in self.used_keys:
+            print(f"Key from {addr} was used before, ignoring it")
+            self.reset(addr)
+            return
+        self.used_keys.add(aes_key)
+        if addr in self.sessions:
+            self.remove(addr, "reconnected")
+        self.sessions[addr] = ClientSession(self.sock, addr, enc_aes_key, aes_key, iv, max_fps)
+        print(f"Connection from {addr}" + (f", up to {max_fps} fps" if max_fps else ""))
+
+    def remove(self, addr, reason):
+        session = self.sessions.pop(addr, None)
+        if session:
+            print(f"Client {addr} {reason}: {session.stats()}")
+
+    def reset(self, addr):
+        try:
+            self.transport.sendto(RESET, addr)
+        except Exception as e:
+            print(f"Error resetting {addr}: {e}")
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def stream(self, capture, frame_interval):
+        """Encodes each captured frame once per ladder rung, for the clients that are ready for one"""
+        loop = asyncio.get_running_loop()
+        while RUNNING and not capture.closed:
+            frame = await capture.next_frame()
+            if frame is None:
+                continue
+            now = time.time()
+            ready = [session for session in self.sessions.values() if session.ready(now)]
+            if not ready:
+                continue
+
+            rungs = {}
+            for session in ready:
+                rungs.setdefault(session.ladder.current, []).append(session)
+            for (quality, scale), sessions in rungs.items():
+                encode_start = time.time()
+                data = await loop.run_in_executor(None, encode_frame, frame, quality, scale)
+                encode_time = (time.time() - encode_start) * 1000
+                metrics.record("encode", encode_time / 1000)
+                if data is None:
+                    print("Failed to encode frame.")
+                    continue
+                print(f"Encoded {len(data)} bytes (quality {quality}, scale {scale}) in {encode_time:.2f} ms "
+                      f"for {len(sessions)} of {len(self.sessions)} clients")
+
+                for session in sessions:
+                    if self.sessions.get(session.addr) is session:
+                        session.sending = True
+                        self.spawn(session.send_frame(data, frame_interval))
+
+    async def reap(self):
+        """Drops clients that stopped talking to us"""
+        while RUNNING:
+            await asyncio.sleep(1.0)
+            now = time.time()
+            for addr in [a for a, s in self.sessions.items() if now - s.last_heard > CLIENT_TIMEOUT]:
+                self.remove(addr, "timed out")
+
+    def close(self):
+        print("Terminating stream.")
+        for addr in list(self.sessions):
+            try:
+                self.transport.sendto(TERMINATE, addr)
+            except:
+                pass
+            self.remove(addr, "terminated")
+        for task in self.tasks:
+            task.cancel()
 
 
 def signal_handler(sig, frame):
@@ -37,6 +374,40 @@ def signal_handler(sig, frame):
     RUNNING = False
 
 
+async def serve(cap, priv_key):
+    loop = asyncio.get_running_loop()
+
+    # UDP socket setup, our own so the frame senders can sendmsg on it next to the transport
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
+    """
+    I decided on 4MB buffer for 1080p steam.
+    TODO: make a mapping, maybe in a file or something, maybe json, which maps qualities to thes values
+    """
+    sock.bind((HOST, PORT))
+    sock.setblocking(False)
+    server = StreamServer(sock, priv_key)
+    transport, _ = await loop.create_datagram_endpoint(lambda: server, sock=sock)
+    print(f"Server listening on port {PORT}...")
+
+    # Start frame capture thread
+    capture = SharedCapture(loop)
+    capture_thread = Thread(target=capture_frames, args=(cap, capture))
+    capture_thread.start()
+
+    print("Starting video stream...")
+    frame_interval = 1.0 / (cap.get(cv2.CAP_PROP_FPS) or 30)
+    reaper = asyncio.ensure_future(server.reap())
+    try:
+        await server.stream(capture, frame_interval)
+    finally:
+        server.close()
+        reaper.cancel()
+        await asyncio.gather(reaper, *server.tasks, return_exceptions=True)
+        transport.close()
+    return capture_thread
+
+
 def server_program():
     global RUNNING
     signal.signal(signal.SIGINT, signal_handler)
@@ -47,44 +418,9 @@ def server_program():
         f.write(priv_key.save_pkcs1())
     with open("server_public.pem", "wb") as f:
         f.write(pub_key.save_pkcs1())"""
-    with open("server_public copy.pem", "rb") as f:
-        pub_key = rsa.PublicKey.load_pkcs1(f.read())
     with open("server_private copy.pem", "rb") as f:
         priv_key = rsa.PrivateKey.load_pkcs1(f.read())
 
-    # UDP socket setup
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 * 1024 * 1024)
-    """
-    I decided on 4MB buffer for 1080p steam. 
-    TODO: make a mapping, maybe in a file or something, maybe json, which maps qualities to thes values
-    """
-    sock.bind(("localhost", 9999))
-    sock.settimeout(20)  # initial timeout for connection just for convinience
-    print("Server listening on port 9999...")
-
-    # standard AES key reception
-    try:
-        data, addr = sock.recvfrom(1024)
-        enc_key_len = struct.unpack("Q", data[:8])[0]
-        enc_aes_key = data[8 : 8 + enc_key_len]
-        iv = data[8 + enc_key_len : 8 + enc_key_len + 16]
-        if not enc_aes_key or not iv:
-            print("Failed to receive key or IV.")
-            sock.close()
-            return
-        print(f"Connection from {addr}")
-    except socket.timeout:
-        print("Timeout receiving keys.")
-        sock.close()
-        return
-    except Exception as e:
-        print(f"Error receiving keys: {e}")
-        sock.close()
-        return
-
-    aes_key = rsa.decrypt(enc_aes_key, priv_key)
-
     # Video capture setup
     cap = cv2.VideoCapture(0, cv2.CAP_V4L2)
     if not cap.isOpened():
@@ -92,7 +428,6 @@ def server_program():
         cap = cv2.VideoCapture(0)
         if not cap.isOpened():
             print("Failed to open webcam.")
-            sock.close()
             return
 
     cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
@@ -100,93 +435,16 @@ def server_program():
     cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
     cap.set(cv2.CAP_PROP_FPS, 60)
 
-    # Start frame capture thread
-    frame_queue = Queue(maxsize=3)  # Buffer for 1080p
-    capture_thread = Thread(target=capture_frames, args=(cap, frame_queue))
-    capture_thread.start()
-
-    print("Starting video stream...")
-    sequence_number = 0
-    sock.settimeout(0.75)  # Reset timeout after receiving keys
-    while RUNNING and cap.isOpened():
-        try:
-            frame = frame_queue.get(timeout=0.5)
-        except:
-            continue
-
-        # Encode frame to JPEG
-        encode_start = time.time()
-        ret, buffer = cv2.imencode(".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), 20])
-        encode_time = (time.time() - encode_start) * 1000
-        if not ret:
-            print("Failed to encode frame.")
-            continue
-
-        data = buffer.tobytes()
-        # Pad for CBC
-        if not USE_PYCRYPTODOME and len(data) % 16 != 0:
-            pad_len = 16 - (len(data) % 16)
-            data += bytes([pad_len] * pad_len)
-
-        # Encrypt frame using the recieved AES key from the client, simple stuff
-        encrypt_start = time.time()
-        if USE_PYCRYPTODOME:
-            aes = AES.new(aes_key, AES.MODE_GCM, nonce=iv)
-            encrypted, tag = aes.encrypt_and_digest(data)
-            encrypted = encrypted + tag
-        else:
-            aes = pyaes.AESModeOfOperationCBC(aes_key, iv=iv)
-            encrypted = b""
-            for i in range(0, len(data), 16):
-                encrypted += aes.encrypt(data[i : i + 16])
-        encrypt_time = (time.time() - encrypt_start) * 1000
-
-        # Split into packets
-        packet_size = 1400  # Larger packets for 1080p, TODO: DYNAMIC
-        packets = [
-            encrypted[i : i + packet_size]
-            for i in range(0, len(encrypted), packet_size)
-        ]
-        total_packets = len(packets)
-        timestamp = time.time()
-
-        # Send packets with header: timestamp (8 bytes), seq (4 bytes), total packets (4 bytes), frame size (4 bytes)
-        # This is the overhead then, I can probably shorten the seq and have wrap around behaviour
-        # considering that there won't be more than a few frames in 0.03 seconds, it shouldn't inhibit much problems
-        send_start = time.time()
-        for i, packet in enumerate(packets):
-            header = struct.pack(
-                "dIII", timestamp, sequence_number, total_packets, len(encrypted)
-            )
-            try:
-                sock.sendto(header + packet, addr)
-            except Exception as e:
-                print(f"Error sending packet: {e}")
-                continue
-        send_time = (time.time() - send_start) * 1000
-
-        print(
-            f"Frame {sequence_number} size: {len(data)} bytes, Packets: {total_packets}, Encode: {encode_time:.2f} ms, Encrypt: {encrypt_time:.2f} ms, Send: {send_time:.2f} ms"
-        )
-        sequence_number += 1
-
-        if cv2.waitKey(1) & 0xFF == 13:
-            """
-            press q to exit I think
-            will make it into a button
-            """
-            RUNNING = False
-
-    print("Terminating stream.")
+    serve_metrics(METRICS_PORT)
+    capture_thread = None
     try:
-        sock.sendto(b"TERMINATE", addr)
-    except:
-        pass
-    sock.close()
-    cap.release()
-    cv2.destroyAllWindows()
-    RUNNING = False
-    capture_thread.join()
+        capture_thread = asyncio.run(serve(cap, priv_key))
+    finally:
+        RUNNING = False
+        if capture_thread:
+            capture_thread.join()
+        cap.release()
+        cv2.destroyAllWindows()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,176 @@
+"""
+JPEG encoding split across cores. cv2.imencode runs on one core, which caps big (1080p, 4K)
+frames at a low frame rate, so the frame is cut into horizontal stripes that are encoded in
+parallel on a thread pool (imencode releases the GIL). The stripes are then either
+
+- stitched into one ordinary JPEG: every stripe's entropy coded data becomes one restart
+  interval, joined with RSTn markers under the first stripe's headers. Any decoder reads it,
+  so the UDP client, the MJPEG view and the browser don't need to know, or
+- kept as independent JPEGs in a stripes message (pack_stripes), which a client decodes in
+  parallel too and draws at each stripe's y.
+
+Stripes are cut on MCU rows (16 pixels with OpenCV's default 4:2:0 subsampling) so the
+stitched restart intervals line up. Everything falls back to a single imencode when the
+frame is small or there is only one core.
+"""
+
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+# Stripes message layout (little endian):
+#   [1 byte version][1 byte stripe count][2 bytes width][2 bytes height]
+#   then per stripe: [2 bytes y][2 bytes height][4 bytes jpeg size][jpeg bytes]
+STRIPE_MESSAGE_VERSION = 1
+HEADER_FORMAT = "<BBHH"
+STRIPE_FORMAT = "<HHI"
+
+MCU_HEIGHT = 16             # 4:2:0, also a multiple of the 8 pixel MCUs of 4:4:4 and greyscale
+MIN_STRIPE_HEIGHT = 128     # thinner stripes cost more in per stripe overhead than they save
+STRIPED_MIN_PIXELS = 1280 * 720  # below this a single imencode is about as fast
+MAX_STRIPES = 16
+
+SOI, EOI, SOS, DRI, RST0 = 0xD8, 0xD9, 0xDA, 0xDD, 0xD0
+SOF_MARKERS = (0xC0, 0xC1, 0xC2)
+
+_executor = None
+
+
+def get_stripe_executor():
+    """
+    Pool for the stripes, separate from any pool the caller runs on so a worker waiting
+    for its stripes can never take the threads they need.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=min(os.cpu_count() or 4, MAX_STRIPES),
+                                       thread_name_prefix="jpeg-stripe")
+    return _executor
+
+
+def default_stripes(height):
+    return max(min(os.cpu_count() or 1, MAX_STRIPES, height // MIN_STRIPE_HEIGHT), 1)
+
+
+def stripe_bounds(height, stripes):
+    """(y, h) of each stripe, all the same height in whole MCU rows except the last one"""
+    mcu_rows = -(-height // MCU_HEIGHT)
+    stripes = max(min(stripes, mcu_rows), 1)
+    stripe_height = -(-mcu_rows // stripes) * MCU_HEIGHT
+    return [(y, min(stripe_height, height - y)) for y in range(0, height, stripe_height)]
+
+
+def encode_stripes(frame, quality, stripes=None, executor=None):
+    """
+    Encodes the frame's stripes in parallel, returns [(y, h, jpeg bytes)] or None if any failed
+    """
+    height = frame.shape[0]
+    bounds = stripe_bounds(height, stripes or default_stripes(height))
+    params = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+
+    def encode(y, h):
+        ret, buffer = cv2.imencode(".jpg", frame[y:y + h], params)
+        return buffer.tobytes() if ret else None
+
+    if len(bounds) == 1:
+        jpegs = [encode(*bounds[0])]
+    else:
+        executor = executor or get_stripe_executor()
+        jpegs = [f.result() for f in [executor.submit(encode, y, h) for y, h in bounds]]
+    if any(jpeg is None for jpeg in jpegs):
+        return None
+    return [(y, h, jpeg) for (y, h), jpeg in zip(bounds, jpegs)]
+
+
+def _split_jpeg(jpeg):
+    """
+    (headers up to SOS, SOS segment, entropy coded data, offset of the SOF segment) of a
+    baseline JPEG straight from imencode
+    """
+    if jpeg[0] != 0xFF or jpeg[1] != SOI or jpeg[-2:] != bytes((0xFF, EOI)):
+        raise ValueError("Not a complete JPEG")
+    offset = 2
+    sof = None
+    while True:
+        marker = jpeg[offset + 1]
+        length = struct.unpack_from(">H", jpeg, offset + 2)[0]
+        if marker in SOF_MARKERS:
+            sof = offset
+        elif marker == DRI:
+            raise ValueError("Stripe already has restart markers")
+        elif marker == SOS:
+            end = offset + 2 + length
+            return jpeg[:offset], jpeg[offset:end], jpeg[end:-2], sof
+        offset += 2 + length
+
+
+def stitch_stripes(stripes, width, height):
+    """
+    Joins encode_stripes() output into one JPEG, each stripe becoming a restart interval.
+    The stripes share quantisation and (standard) Huffman tables since they were encoded
+    with the same settings, so the first stripe's headers are valid for all of them.
+    """
+    if len(stripes) == 1:
+        return stripes[0][2]
+
+    headers, sos, _, sof = _split_jpeg(stripes[0][2])
+    # MCU size from the largest sampling factors in the frame header
+    components = headers[sof + 9]
+    factors = [headers[sof + 11 + 3 * i] for i in range(components)]
+    mcu_width = max(f >> 4 for f in factors) * 8
+    mcu_height = max(f & 0x0F for f in factors) * 8
+    stripe_height = stripes[0][1]
+    if stripe_height % mcu_height:
+        raise ValueError("Stripes don't end on MCU rows")
+    interval = -(-width // mcu_width) * (stripe_height // mcu_height)
+    if interval > 0xFFFF:
+        raise ValueError("Stripes too large for a restart interval")
+
+    headers = bytearray(headers)
+    struct.pack_into(">H", headers, sof + 5, height)
+    parts = [bytes(headers), struct.pack(">BBHH", 0xFF, DRI, 4, interval), sos]
+    for index, (_, _, jpeg) in enumerate(stripes):
+        if index:
+            parts.append(bytes((0xFF, RST0 + (index - 1) % 8)))
+        parts.append(_split_jpeg(jpeg)[2])
+    parts.append(bytes((0xFF, EOI)))
+    return b"".join(parts)
+
+
+def encode_striped_jpeg(frame, quality, stripes=None, executor=None):
+    """
+    Drop in for cv2.imencode(".jpg", ...) that uses several cores on big frames.
+    Returns the JPEG bytes or None if encoding failed.
+    """
+    height, width = frame.shape[:2]
+    if width * height < STRIPED_MIN_PIXELS or (stripes or default_stripes(height)) == 1:
+        ret, buffer = cv2.imencode(".jpg", frame, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+        return buffer.tobytes() if ret else None
+    encoded = encode_stripes(frame, quality, stripes, executor)
+    return stitch_stripes(encoded, width, height) if encoded else None
+
+
+def pack_stripes(width, height, stripes):
+    """Stripes message for clients that reassemble the stripes themselves"""
+    parts = [struct.pack(HEADER_FORMAT, STRIPE_MESSAGE_VERSION, len(stripes), width, height)]
+    for y, h, jpeg in stripes:
+        parts.append(struct.pack(STRIPE_FORMAT, y, h, len(jpeg)))
+        parts.append(jpeg)
+    return b"".join(parts)
+
+
+def unpack_stripes(message):
+    """(width, height, [(y, h, jpeg bytes)]) of a stripes message"""
+    version, count, width, height = struct.unpack_from(HEADER_FORMAT, message)
+    if version != STRIPE_MESSAGE_VERSION:
+        raise ValueError(f"Unknown stripes message version {version}")
+    offset = struct.calcsize(HEADER_FORMAT)
+    stripes = []
+    for _ in range(count):
+        y, h, size = struct.unpack_from(STRIPE_FORMAT, message, offset)
+        offset += struct.calcsize(STRIPE_FORMAT)
+        stripes.append((y, h, message[offset:offset + size]))
+        offset += size
+    return width, height, stripes
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# server.py and client.py import their modules by bare name, as when they run from socket_com
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
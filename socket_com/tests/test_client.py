@@ -0,0 +1,85 @@
+import asyncio
+import contextlib
+import io
+import os
+import socket
+import time
+from queue import Queue
+
+import cv2
+import numpy as np
+import rsa
+from django.test import SimpleTestCase
+
+from client import KEY_RETRY_INTERVAL, RESET, TERMINATE, StreamClient
+from server import ClientSession, parse_key_exchange
+
+
+class StreamClientTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.pub_key, cls.priv_key = rsa.newkeys(512)
+
+    def setUp(self):
+        # The "server" end is a plain socket, the client is connected to it like to the real one
+        self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server_sock.bind(("127.0.0.1", 0))
+        self.server_sock.settimeout(1.0)
+        self.client_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client_sock.connect(self.server_sock.getsockname())
+        self.client_sock.settimeout(1.0)
+        self.addCleanup(self.server_sock.close)
+        self.addCleanup(self.client_sock.close)
+        self.client = StreamClient(self.client_sock, self.pub_key, Queue())
+        output = contextlib.redirect_stdout(io.StringIO())
+        output.__enter__()
+        self.addCleanup(output.__exit__, None, None, None)
+
+    def test_reset_keys_again(self):
+        old_key = self.client.aes_key
+        # Right after keying it answers control packets sent before the server had the key
+        self.assertTrue(self.client.on_packet(RESET))
+        self.assertEqual(self.client.rekeys, 0)
+
+        self.client.keyed_at -= KEY_RETRY_INTERVAL + 0.1
+        self.client.on_packet(RESET)
+        self.assertEqual(self.client.rekeys, 1)
+        self.assertNotEqual(self.client.aes_key, old_key)
+        enc_aes_key, iv, _ = parse_key_exchange(self.server_sock.recv(65536))
+        self.assertEqual(rsa.decrypt(enc_aes_key, self.priv_key), self.client.aes_key)
+        self.assertEqual(iv, self.client.iv)
+
+    def test_terminate(self):
+        self.assertFalse(self.client.on_packet(TERMINATE))
+
+    def test_frame_from_a_server_session(self):
+        image = np.zeros((120, 160, 3), dtype=np.uint8)
+        cv2.circle(image, (80, 60), 40, (0, 200, 255), -1)
+        _, jpeg = cv2.imencode(".jpg", image)
+        session = ClientSession(self.server_sock, self.client_sock.getsockname(), b"enc",
+                                self.client.aes_key, self.client.iv)
+
+        async def send():
+            await session.send_frame(jpeg.tobytes(), 1 / 30)
+            await session.send_frame(jpeg.tobytes(), 1 / 30)
+        asyncio.run(send())
+
+        # Every packet of both frames, data and parity
+        try:
+            while True:
+                self.assertTrue(self.client.on_packet(memoryview(self.client_sock.recv(65536))))
+                if self.client.complete and self.client.complete.sequence == 1:
+                    break
+        except socket.timeout:
+            self.fail("Frame 1 never completed")
+        self.assertTrue(self.client.connected)
+        self.assertEqual(self.client.decode_skipped, 1)  # frame 0 was never picked up
+
+        slot = self.client.complete
+        frame = self.client.decode_frame(slot, self.client.aes_key, self.client.iv)
+        self.assertEqual(frame.shape, image.shape)
+        self.assertLess(np.abs(frame.astype(int) - image).mean(), 3)
+        # Another key can't read it
+        self.assertIsNone(self.client.decode_frame(slot, os.urandom(32), self.client.iv))
+        self.assertLess(time.time() - self.client.clock.to_local(slot.timestamp), 1.0)
@@ -0,0 +1,144 @@
+import asyncio
+import contextlib
+import io
+import os
+import socket
+import struct
+
+import rsa
+from django.test import SimpleTestCase
+
+import server
+from server import RATE_SLACK, RESET, TERMINATE, ClientSession, StreamServer, parse_key_exchange
+
+CLIENT = ("127.0.0.1", 40000)
+
+
+def key_exchange(pub_key, aes_key, iv, max_fps=0):
+    enc_aes_key = rsa.encrypt(aes_key, pub_key)
+    return struct.pack("Q", len(enc_aes_key)) + enc_aes_key + iv + struct.pack("<H", max_fps)
+
+
+class FakeTransport:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+
+
+class ParseKeyExchangeTests(SimpleTestCase):
+    def test_key_exchange(self):
+        iv = os.urandom(16)
+        data = struct.pack("Q", 5) + b"12345" + iv
+        self.assertEqual(parse_key_exchange(data), (b"12345", iv, None))
+        self.assertEqual(parse_key_exchange(data + struct.pack("<H", 15)), (b"12345", iv, 15))
+
+    def test_not_a_key_exchange(self):
+        self.assertIsNone(parse_key_exchange(b"SYNC"))
+        self.assertIsNone(parse_key_exchange(struct.pack("Q", 50) + b"12345"))
+        self.assertIsNone(parse_key_exchange(struct.pack("Q", 5) + b"12345" + b"short iv"))
+
+
+class ClientSessionTests(SimpleTestCase):
+    def test_fps_limit(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(sock.close)
+        session = ClientSession(sock, CLIENT, b"enc", os.urandom(32), os.urandom(16), max_fps=10)
+        self.assertTrue(session.ready(100.0))
+        self.assertFalse(session.ready(100.05))
+        # Capture timing jitters, a frame a little early still goes
+        self.assertTrue(session.ready(100.1 - RATE_SLACK / 2))
+        session.sending = True
+        self.assertFalse(session.ready(101.0))
+        self.assertEqual(session.skipped, 2)
+
+
+class StreamServerTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.pub_key, cls.priv_key = rsa.newkeys(512)
+
+    def setUp(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.sock.close)
+        self.transport = FakeTransport()
+        self.server = StreamServer(self.sock, self.priv_key)
+        self.server.connection_made(self.transport)
+        # The server narrates everything on stdout
+        output = contextlib.redirect_stdout(io.StringIO())
+        output.__enter__()
+        self.addCleanup(output.__exit__, None, None, None)
+
+    def receive(self, data, addr=CLIENT):
+        async def run():
+            self.server.datagram_received(data, addr)
+            await asyncio.gather(*self.server.tasks)
+        asyncio.run(run())
+
+    def test_sessions_per_client(self):
+        first_key, second_key = os.urandom(32), os.urandom(32)
+        self.receive(key_exchange(self.pub_key, first_key, os.urandom(16), max_fps=15))
+        self.receive(key_exchange(self.pub_key, second_key, os.urandom(16)), ("127.0.0.1", 40001))
+        self.assertEqual(len(self.server.sessions), 2)
+        session = self.server.sessions[CLIENT]
+        self.assertEqual(session.aes_key, first_key)
+        self.assertAlmostEqual(session.min_interval, 1 / 15)
+
+        self.receive(TERMINATE)
+        self.assertEqual(list(self.server.sessions), [("127.0.0.1", 40001)])
+
+    def test_repeated_key_exchange_keeps_the_session(self):
+        packet = key_exchange(self.pub_key, os.urandom(32), os.urandom(16))
+        self.receive(packet)
+        session = self.server.sessions[CLIENT]
+        session.sequence = 7
+        self.receive(packet)
+        self.assertIs(self.server.sessions[CLIENT], session)
+
+    def test_new_key_replaces_the_session(self):
+        self.receive(key_exchange(self.pub_key, os.urandom(32), os.urandom(16)))
+        new_key = os.urandom(32)
+        self.receive(key_exchange(self.pub_key, new_key, os.urandom(16)))
+        self.assertEqual(self.server.sessions[CLIENT].aes_key, new_key)
+        self.assertEqual(self.server.sessions[CLIENT].sequence, 0)
+
+    def test_key_used_before_is_refused(self):
+        aes_key = os.urandom(32)
+        self.receive(key_exchange(self.pub_key, aes_key, os.urandom(16)))
+        self.server.remove(CLIENT, "timed out")
+        # Its sequence numbers would start from 0 again and repeat nonces
+        self.receive(key_exchange(self.pub_key, aes_key, os.urandom(16)))
+        self.assertEqual(self.server.sessions, {})
+        self.assertEqual(self.transport.sent, [(RESET, CLIENT)])
+
+    def test_control_packets_without_a_session_get_a_reset(self):
+        self.receive(b"SYNC" + bytes(16))
+        self.assertEqual(self.transport.sent, [(RESET, CLIENT)])
+
+    def test_bad_key(self):
+        self.receive(struct.pack("Q", 64) + os.urandom(64) + os.urandom(16))
+        self.assertEqual(self.server.sessions, {})
+        self.assertEqual(self.server.pending, set())
+
+    def test_close_terminates_every_client(self):
+        self.receive(key_exchange(self.pub_key, os.urandom(32), os.urandom(16)))
+        self.server.close()
+        self.assertEqual(self.transport.sent, [(TERMINATE, CLIENT)])
+        self.assertEqual(self.server.sessions, {})
+
+
+class SharedCaptureTests(SimpleTestCase):
+    def test_newest_frame(self):
+        async def run():
+            capture = server.SharedCapture(asyncio.get_running_loop())
+            capture.put("old")
+            capture.put("new")
+            await asyncio.sleep(0)
+            self.assertEqual(await capture.next_frame(), "new")
+            self.assertIsNone(await capture.next_frame(timeout=0.01))
+            capture.put(None)
+            await asyncio.sleep(0)
+            self.assertTrue(capture.closed)
+        asyncio.run(run())
@@ -0,0 +1,210 @@
+import logging
+from concurrent.futures import Future
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from socket_com.metrics import metrics
+
+from .frame_sources import FrameSource
+
+logger = logging.getLogger(__name__)
+
+# Encoded frames are cached per (codec, quality, resolution), for this many recent frames
+ENCODE_CACHE_FRAMES = 2
+
+FrameCallback = Callable[[int, np.ndarray, float], None]
+
+
+class CameraBroker:
+    '''
+    Owns one frame source (a camera, the screen...) and its capture thread for the whole
+    process, and publishes every frame to all subscribers. The source is started when the
+    first subscriber attaches and stopped when the last one detaches.
+
+    It also caches encoded frames, so N viewers asking for the same
+    (codec, quality, resolution) cost a single encode.
+    '''
+
+    def __init__(self, source: FrameSource, name: str = "camera"):
+        self.source = source
+        self.name = name
+        self.capture_thread: Optional[Thread] = None
+        self.capture_ready = Event()
+        self.running = False
+        self.started = False
+        self.lock = Lock()  # guards the subscriber list, taken by the capture thread
+        self.camera_lock = Lock()  # guards starting and stopping the source
+        self.subscribers: List[FrameCallback] = []
+        self.frame_id = 0
+
+        self.cache_lock = Lock()
+        self.encode_cache: Dict[Tuple[int, tuple], Future] = {}
+        self.encode_count = 0
+        self.cache_hits = 0
+
+    def _open_camera(self):
+        '''
+        Starts the source, checks it delivers a frame and starts the capture thread.
+        '''
+        if not self.source.start():
+            return False
+        self.started = True
+
+        ret, _, _ = self.source.read()
+        if not ret:
+            logger.error(f"Failed to capture test frame from {self.name}")
+            self.source.stop()
+            self.started = False
+            return False
+
+        self.capture_ready.clear()
+        self.running = True
+        self.capture_thread = Thread(target=self._capture_frames, daemon=True)
+        self.capture_thread.start()
+
+        if not self.capture_ready.wait(timeout=5.0):
+            logger.error("Capture thread failed to start within timeout")
+            self._close_camera()
+            return False
+
+        logger.info(f"Frame source {self.name} started")
+        return True
+
+    def _close_camera(self):
+        self.running = False
+        if self.capture_thread and self.capture_thread.is_alive():
+            self.capture_thread.join(timeout=2.0)
+            if self.capture_thread.is_alive():
+                logger.warning("Capture thread did not finish within timeout")
+        self.capture_thread = None
+        self.source.stop()
+        self.started = False
+
+        with self.cache_lock:
+            self.encode_cache.clear()
+        logger.info(f"Frame source {self.name} stopped")
+
+    def _capture_frames(self):
+        '''
+        Captures frames from the source and hands them to every subscriber.
+        Subscriber callbacks run on this thread so they have to be quick.
+        '''
+        logger.info("Capture thread started")
+        self.capture_ready.set()
+
+        while self.running:
+            try:
+                with metrics.time("capture"):
+                    ret, frame, timestamp = self.source.read()
+                if not ret:
+                    logger.error(f"Failed to capture frame from {self.name}")
+                    break
+
+                self.frame_id += 1
+                with self.lock:
+                    subscribers = list(self.subscribers)
+                for callback in subscribers:
+                    try:
+                        callback(self.frame_id, frame, timestamp)
+                    except Exception as e:
+                        logger.error(f"Subscriber callback failed: {e}")
+            except Exception as e:
+                logger.error(f"Error in capture_frames: {e}")
+                break
+
+        self.running = False
+        logger.info("Capture thread ended")
+
+    def subscribe(self, callback: FrameCallback) -> bool:
+        '''
+        Attaches a subscriber, starting the source if it isn't running yet.
+        This can block while the source starts, so call it off the event loop.
+        Returns False if the source could not be started.
+        '''
+        with self.camera_lock:
+            if not self.running:
+                # Previous capture may have died on its own, clean up before reopening
+                if self.started:
+                    self._close_camera()
+                if not self._open_camera():
+                    return False
+            with self.lock:
+                if callback not in self.subscribers:
+                    self.subscribers.append(callback)
+                logger.info(f"Frame subscriber attached ({len(self.subscribers)} total)")
+            return True
+
+    def unsubscribe(self, callback: FrameCallback):
+        '''
+        Detaches a subscriber. The source is stopped when nobody is left.
+        '''
+        with self.camera_lock:
+            with self.lock:
+                if callback in self.subscribers:
+                    self.subscribers.remove(callback)
+                remaining = len(self.subscribers)
+            logger.info(f"Frame subscriber detached ({remaining} left)")
+            if not remaining and self.started:
+                self._close_camera()
+
+    def get_encoded(self, frame_id: int, key: tuple, encode: Callable[[], Optional[bytes]]) -> Optional[bytes]:
+        '''
+        Returns the encoded bytes of a frame for the given (codec, quality, resolution) key,
+        calling encode() only if no other subscriber has done so already.
+        Subscribers asking at the same time wait for the first encode instead of
+        running their own.
+        '''
+        cache_key = (frame_id, key)
+        with self.cache_lock:
+            future = self.encode_cache.get(cache_key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.encode_cache[cache_key] = future
+                # Only recent frames are worth keeping
+                for old_key in [k for k in self.encode_cache if k[0] <= frame_id - ENCODE_CACHE_FRAMES]:
+                    del self.encode_cache[old_key]
+            else:
+                self.cache_hits += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            data = encode()
+            self.encode_count += 1
+            future.set_result(data)
+            return data
+        except Exception as e:
+            future.set_result(None)
+            logger.error(f"Encode for {key} failed: {e}")
+            return None
+
+    def get_stats(self):
+        return {
+            'source': self.name,
+            'pixel_format': self.source.pixel_format,
+            'subscribers': len(self.subscribers),
+            'frame_id': self.frame_id,
+            'encodes': self.encode_count,
+            'cache_hits': self.cache_hits,
+        }
+
+
+_brokers: Dict[str, CameraBroker] = {}
+_brokers_lock = Lock()
+
+
+def get_camera_broker(name: str, create_source: Callable[[], FrameSource]) -> CameraBroker:
+    '''
+    Returns the process wide broker for a named frame source, creating it on first use.
+    create_source() is only called when the broker is created, later callers share it.
+    '''
+    with _brokers_lock:
+        broker = _brokers.get(name)
+        if broker is None:
+            broker = CameraBroker(create_source(), name)
+            _brokers[name] = broker
+        return broker
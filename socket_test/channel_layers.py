@@ -0,0 +1,356 @@
+import asyncio
+import logging
+import os
+import struct
+import time
+import uuid
+from collections import deque
+from typing import Deque, Dict, Optional, Set, Tuple
+
+import msgpack  # comes with daphne (through autobahn)
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+logger = logging.getLogger(__name__)
+
+# Wire format between the hub and the worker processes: [4 bytes big endian length][msgpack map].
+# Message bodies are packed once by the sender and passed through the hub as bytes, so the
+# hub never unpacks (or copies per viewer) the encoded frames riding in them.
+LENGTH_FORMAT = ">I"
+LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+DEFAULT_SOCKET_PATH = "/tmp/stream_channel_hub.sock"
+GROUP_BACKLOG = 2           # group messages per group waiting for one worker, older ones are dropped
+CONNECTION_CAPACITY = 1000  # direct messages waiting for one worker before new ones are dropped
+RECONNECT_INTERVAL = 1.0    # seconds between attempts when the hub isn't there
+
+
+def _pack(item) -> bytes:
+    data = msgpack.packb(item, use_bin_type=True)
+    return struct.pack(LENGTH_FORMAT, len(data)) + data
+
+
+async def _read_item(reader: asyncio.StreamReader):
+    length, = struct.unpack(LENGTH_FORMAT, await reader.readexactly(LENGTH_SIZE))
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Channel hub frame too large ({length} bytes)")
+    return msgpack.unpackb(await reader.readexactly(length), raw=False)
+
+
+def _client_id(channel: str) -> Optional[str]:
+    '''Which worker owns a process specific channel, "<prefix>.<client id>!<name>"'''
+    if "!" not in channel:
+        return None
+    return channel[:channel.find("!")].rsplit(".", 1)[-1]
+
+
+class _HubConnection:
+    '''
+    One worker process connected to the hub, with its own outbox so a slow worker only
+    ever delays itself. Group messages are limited per group: when a worker already has
+    GROUP_BACKLOG of a group's messages waiting, the oldest is dropped for the new one,
+    which is what you want for video frames.
+    '''
+
+    def __init__(self, writer: asyncio.StreamWriter, group_backlog: int, capacity: int):
+        self.writer = writer
+        self.group_backlog = group_backlog
+        self.capacity = capacity
+        self.client_id: Optional[str] = None
+        self.outbox: Deque[Tuple[Optional[str], bytes]] = deque()
+        self.pending: Dict[str, int] = {}
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.task = asyncio.create_task(self._write())
+
+    def enqueue(self, data: bytes, group: Optional[str] = None):
+        if group is not None:
+            if self.pending.get(group, 0) >= self.group_backlog:
+                for item in self.outbox:
+                    if item[0] == group:
+                        self.outbox.remove(item)
+                        self.pending[group] -= 1
+                        self.dropped += 1
+                        break
+            self.pending[group] = self.pending.get(group, 0) + 1
+        elif len(self.outbox) >= self.capacity:
+            self.dropped += 1
+            logger.warning(f"Channel hub outbox of {self.client_id} full, message dropped")
+            return
+        self.outbox.append((group, data))
+        self.ready.set()
+
+    async def _write(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.outbox:
+                    group, data = self.outbox.popleft()
+                    if group is not None:
+                        self.pending[group] -= 1
+                    self.writer.write(data)
+                    await self.writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    def close(self):
+        self.task.cancel()
+        self.writer.close()
+
+
+class ChannelHub:
+    '''
+    Routes channel layer traffic between the processes on this machine over a Unix socket,
+    see UnixSocketChannelLayer. Keeps the group memberships, and fans group messages out
+    with one copy per worker process rather than per channel. Run it with
+    `manage.py runchannelhub`.
+    '''
+
+    def __init__(self, path: str = DEFAULT_SOCKET_PATH, group_backlog: int = GROUP_BACKLOG,
+                 capacity: int = CONNECTION_CAPACITY):
+        self.path = path
+        self.group_backlog = group_backlog
+        self.capacity = capacity
+        self.connections: Dict[str, _HubConnection] = {}
+        self.groups: Dict[str, Set[str]] = {}
+
+    async def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # left behind by a hub that didn't shut down cleanly
+        server = await asyncio.start_unix_server(self._handle, self.path)
+        os.chmod(self.path, 0o600)  # only processes of the same user
+        logger.info(f"Channel hub listening on {self.path}")
+        async with server:
+            await server.serve_forever()
+
+    def get_stats(self):
+        return {
+            'workers': len(self.connections),
+            'groups': {group: len(channels) for group, channels in self.groups.items()},
+            'dropped': {client_id: conn.dropped for client_id, conn in self.connections.items()},
+        }
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        conn = _HubConnection(writer, self.group_backlog, self.capacity)
+        try:
+            while True:
+                item = await _read_item(reader)
+                op = item.get('op')
+                if op == 'hello':
+                    conn.client_id = item['client_id']
+                    self.connections[conn.client_id] = conn
+                    logger.info(f"Channel layer worker {conn.client_id} connected")
+                elif op == 'send':
+                    self._deliver([item['channel']], item['message'])
+                elif op == 'group_add':
+                    self.groups.setdefault(item['group'], set()).add(item['channel'])
+                elif op == 'group_discard':
+                    self._discard(item['group'], item['channel'])
+                elif op == 'group_send':
+                    self._deliver(self.groups.get(item['group'], ()), item['message'], item['group'])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Channel hub connection error: {e}")
+        finally:
+            conn.close()
+            if conn.client_id and self.connections.get(conn.client_id) is conn:
+                del self.connections[conn.client_id]
+                for group in list(self.groups):
+                    for channel in [c for c in self.groups[group] if _client_id(c) == conn.client_id]:
+                        self._discard(group, channel)
+                logger.info(f"Channel layer worker {conn.client_id} disconnected")
+
+    def _discard(self, group: str, channel: str):
+        channels = self.groups.get(group)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.groups[group]
+
+    def _deliver(self, channels, message: bytes, group: Optional[str] = None):
+        by_worker: Dict[str, list] = {}
+        for channel in channels:
+            by_worker.setdefault(_client_id(channel), []).append(channel)
+        for client_id, worker_channels in by_worker.items():
+            conn = self.connections.get(client_id)
+            if conn:
+                conn.enqueue(_pack({'op': 'deliver', 'channels': worker_channels, 'message': message}), group)
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    '''
+    Channel layer for several processes on one machine (Daphne workers, the frame producer),
+    connected through the ChannelHub on a Unix socket. Only process specific channels are
+    supported, which is what consumers use. Messages for this process' own channels never
+    leave it.
+
+    Messages to a channel whose queue is full are dropped (group messages drop the oldest
+    queued one instead), so a busy consumer can't hold up the rest. While the hub is down
+    messages for other processes are dropped and the layer keeps reconnecting.
+    '''
+
+    extensions = ["groups", "flush"]
+
+    def __init__(self, path: str = DEFAULT_SOCKET_PATH, expiry: int = 60, capacity: int = 100,
+                 channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.path = path
+        self.client_id = uuid.uuid4().hex[:12]
+        self.queues: Dict[str, Deque[Tuple[float, dict]]] = {}  # channel -> (time queued, message)
+        self.queue_events: Dict[str, asyncio.Event] = {}
+        self.groups: Dict[str, Set[str]] = {}  # ours, to re-add after reconnecting
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.reader_task: Optional[asyncio.Task] = None
+        self.next_attempt = 0.0
+
+    # --- Connection to the hub ---
+
+    async def _connection(self) -> Optional[asyncio.StreamWriter]:
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # Used from a new event loop (tests, async_to_sync), the old connection is unusable
+            self.loop = loop
+            self.writer = None
+            self.reader_task = None
+            self.queue_events = {}
+        if self.writer and not self.writer.is_closing():
+            return self.writer
+        if loop.time() < self.next_attempt:
+            return None
+        self.next_attempt = loop.time() + RECONNECT_INTERVAL
+
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        except OSError as e:
+            logger.warning(f"Channel hub not reachable at {self.path}: {e}")
+            return None
+        writer.write(_pack({'op': 'hello', 'client_id': self.client_id}))
+        for group, channels in self.groups.items():
+            for channel in channels:
+                writer.write(_pack({'op': 'group_add', 'group': group, 'channel': channel}))
+        self.writer = writer
+        self.reader_task = asyncio.create_task(self._read(reader))
+        return writer
+
+    async def _read(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                item = await _read_item(reader)
+                if item.get('op') == 'deliver':
+                    message = msgpack.unpackb(item['message'], raw=False)
+                    for channel in item['channels']:
+                        self._put(channel, message, droppable=True)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.warning("Lost the connection to the channel hub")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Channel hub read error: {e}")
+        finally:
+            if self.writer:
+                self.writer.close()
+            self.writer = None
+
+    async def _send_to_hub(self, item):
+        writer = await self._connection()
+        if writer is None:
+            return
+        writer.write(_pack(item))
+        await writer.drain()
+
+    # --- Local queues ---
+
+    def _event(self, channel: str) -> asyncio.Event:
+        event = self.queue_events.get(channel)
+        if event is None:
+            event = self.queue_events[channel] = asyncio.Event()
+        return event
+
+    def _put(self, channel: str, message: dict, droppable: bool = False):
+        queue = self.queues.get(channel)
+        if queue is None:
+            return  # nobody receives on it (anymore)
+        if len(queue) >= self.get_capacity(channel):
+            if not droppable:
+                raise ChannelFull(channel)
+            queue.popleft()
+        queue.append((time.time(), message))
+        self._event(channel).set()
+
+    def _remove_expired(self):
+        '''
+        Channels of consumers that are gone are never received on again, once their oldest
+        message is older than expiry the channel is dropped with everything queued on it.
+        '''
+        cutoff = time.time() - self.expiry
+        for channel in [c for c, queue in self.queues.items() if queue and queue[0][0] < cutoff]:
+            del self.queues[channel]
+            self.queue_events.pop(channel, None)
+
+    # --- Channel layer API ---
+
+    async def new_channel(self, prefix: str = "specific") -> str:
+        self._remove_expired()
+        channel = f"{prefix}.{self.client_id}!{uuid.uuid4().hex}"
+        self.queues[channel] = deque()
+        await self._connection()
+        return channel
+
+    async def send(self, channel: str, message: dict):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        if _client_id(channel) == self.client_id:
+            self._put(channel, message)
+        else:
+            await self._send_to_hub({'op': 'send', 'channel': channel,
+                                     'message': msgpack.packb(message, use_bin_type=True)})
+
+    async def receive(self, channel: str) -> dict:
+        self.require_valid_channel_name(channel)
+        queue = self.queues.setdefault(channel, deque())
+        event = self._event(channel)
+        while not queue:
+            event.clear()
+            await event.wait()
+        return queue.popleft()[1]
+
+    async def group_add(self, group: str, channel: str):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self.groups.setdefault(group, set()).add(channel)
+        await self._send_to_hub({'op': 'group_add', 'group': group, 'channel': channel})
+
+    async def group_discard(self, group: str, channel: str):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        channels = self.groups.get(group)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.groups[group]
+        await self._send_to_hub({'op': 'group_discard', 'group': group, 'channel': channel})
+
+    async def group_send(self, group: str, message: dict):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_group_name(group)
+        await self._send_to_hub({'op': 'group_send', 'group': group,
+                                 'message': msgpack.packb(message, use_bin_type=True)})
+
+    async def flush(self):
+        self.queues = {}
+        self.queue_events = {}
+        self.groups = {}
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+        self.writer = None
+        self.reader_task = None
+
+    async def close(self):
+        await self.flush()
@@ -5,26 +5,57 @@ import logging
 import struct
 import time
 import traceback
-import os
-import platform
-from threading import Thread, Event
-from queue import Queue
-import subprocess
-import shlex
-
-import cv2
-import numpy as np
+
 from channels.generic.websocket import AsyncWebsocketConsumer
 from typing import Optional
 
-from Crypto.Cipher import AES, PKCS1_v1_5
-from Crypto.PublicKey import RSA
+from socket_com.metrics import metrics
+
+from .camera_broker import CameraBroker, get_camera_broker
+from .crypto import SessionCipher, get_crypto_service
+from .frame_sources import create_frame_source
+from .fanout import frame_group, pick_rendition
+from .encode_pipeline import (EncodeStage, encode_foveated_and_encrypt, encode_shared_jpeg_and_encrypt,
+                              encode_shared_stripes_and_encrypt, encode_tiles_and_encrypt, encrypt_frame,
+                              get_executor, with_pose)
+from .foveation import GazePredictor
+from .pose import PoseRingBuffer, is_sensor_batch, parse_sensor_batch
+from .h264_encoder import H264EncoderSession
+from .mailbox import LatestValueMailbox
+from .rate_control import AdaptiveStreamController
+from .stereo import DEFAULT_LENS_PROFILE, LENS_PROFILES, StereoView
+from .viewport import ViewportView
+from .tile_delta import TileDeltaEncoder
 
 logger = logging.getLogger(__name__)
 
 # --- Toggle Options ---
-USE_H264 = False      # Set False to use JPEG
+USE_H264 = False      # Set False to use JPEG, clients can still ask for a codec in the key exchange
+CODECS = ('jpeg', 'h264', 'tiles', 'foveated', 'stripes')  # 'tiles' only sends the JPEG tiles that changed since the last frame,
+                                                          # 'foveated' sends full quality only where the gyro says the viewer looks,
+                                                          # 'stripes' sends separate JPEG stripes the browser decodes in parallel
 USE_GPU = True       # If True, will use GPU encoder like NVIDIA's NVENC (FFmpeg needed)
+ENCODE_IN_FLIGHT = 2  # Frames that can be encoding/encrypting at once per stream, older ones are dropped
+H264_GOP = 60        # Frames between H264 keyframes, lower recovers faster from loss but costs bandwidth
+ADAPTIVE_TARGET_LATENCY = 0.1  # Send -> client ack time the adaptive controller aims for, in seconds
+MAX_UNACKED_FRAMES = 3         # Skip encoding new frames while the client hasn't acked this many
+MAX_UNACKED_BYTES = 1_000_000  # ... or this many bytes
+BACKPRESSURE_PROBE = 0.5       # Send a frame anyway after this long, in case acks got lost
+
+# Frame sources a client can pick by name in the key exchange: (type, options), see frame_sources.py.
+# Only what's listed here can be streamed, clients never pass paths or devices themselves.
+FRAME_SOURCES = {
+    'camera': ('camera', {'device': 0}),
+    'screen': ('screen', {'monitor': 1}),
+    'shm': ('shm', {'buffer_info_file': 'buffer_info.json'}),
+    'file': ('file', {'path': 'media/stream.mp4'}),
+    'synthetic': ('synthetic', {}),
+}
+DEFAULT_FRAME_SOURCE = 'camera'
+
+# 'stereo' sends side by side left/right eye frames pre-distorted for the lens profile in 'lens',
+# 'viewport' crops the part of the source the gyro says the viewer looks at, and the browser reprojects it
+STREAM_MODES = ('mono', 'stereo', 'viewport')
 
 
 class StreamingConsumer(AsyncWebsocketConsumer):
@@ -35,60 +66,45 @@ class StreamingConsumer(AsyncWebsocketConsumer):
         '''
         super().__init__(*args, **kwargs)
         self.running = False
-        self.cap: Optional[cv2.VideoCapture] = None
-        self.aes_key: Optional[bytes] = None
+        self.camera: Optional[CameraBroker] = None
+        self.crypto = get_crypto_service()
+        self.cipher: Optional[SessionCipher] = None
         self.iv: Optional[bytes] = None
         self.stream_task: Optional[asyncio.Task] = None
-        self.frame_queue = Queue(maxsize=3)
-        self.capture_thread: Optional[Thread] = None
-        self.capture_ready = Event()  # Added to signal when capture is ready
+        self.frame_mailbox: Optional[LatestValueMailbox] = None
         self.sequence_number = 0
         self.frame_width = 1280
         self.frame_height = 720
         self.fps = 30
         self.jpeg_quality = 20
-
-        try:
-            with open("server_public.pem", "rb") as f:
-                self.pub_key = RSA.import_key(f.read())
-            with open("server_private.pem", "rb") as f:
-                self.priv_key = RSA.import_key(f.read())
-            logger.info("RSA keys loaded successfully")
-        except Exception as e:
-            logger.error(f"Failed to load RSA keys: {e}")
-            self.pub_key = None
-            self.priv_key = None
-
-    def capture_frames(self):
+        self.codec = 'h264' if USE_H264 else 'jpeg'
+        self.source_name = DEFAULT_FRAME_SOURCE
+        self.mode = 'mono'
+        self.fanout = False
+        self.fanout_group: Optional[str] = None  # rendition group we're in, see fanout.py
+        self.view: Optional[StereoView] = None  # fixed view transform applied before encoding, None for mono
+        self.poses = PoseRingBuffer()  # head orientation history from the browser's sensor batches
+        self.gaze = GazePredictor(poses=self.poses)
+        self.client_clock = None  # the browser's estimate of our clock, from its last 'clock_sync'
+        self.h264_encoder: Optional[H264EncoderSession] = None
+        self.tile_encoder: Optional[TileDeltaEncoder] = None
+        self.encode_stage: Optional[EncodeStage] = None
+        self.rate_controller = AdaptiveStreamController(target_latency=ADAPTIVE_TARGET_LATENCY)
+        self.next_frame_due = 0.0
+        self.last_frame_sent = 0.0
+        self.frames_skipped_backpressure = 0
+        self.frames_skipped_rate = 0
+
+    def on_frame(self, frame_id, frame, timestamp):
         '''
-        Captures frames from the camera in a separate thread.
+        Called by the camera broker's capture thread for every new frame.
         '''
-        logger.info("Capture thread started")
-        self.capture_ready.set()
-
-        while self.running and self.cap and self.cap.isOpened():
-            try:
-                ret, frame = self.cap.read()
-                if not ret:
-                    logger.error("Failed to capture frame")
-                    break
-
-                if not self.frame_queue.full():
-                    self.frame_queue.put(frame)
-                    # logger.debug(f"Captured frame {self.sequence_number} at {time.time():.2f} seconds")
-                else:
-                    # Remove oldest frame and add new one, maybe I should use a circular buffer instead?
-                    try:
-                        self.frame_queue.get_nowait()
-                    except:
-                        pass
-                    self.frame_queue.put(frame)
-                    logger.warning("Frame queue was full, replaced oldest frame")
-            except Exception as e:
-                logger.error(f"Error in capture_frames: {e}")
-                break
+        if not self.running:
+            return
 
-        logger.info("Capture thread ended")
+        # Overwrites the frame the stream hasn't picked up yet, only the newest one matters
+        if self.frame_mailbox:
+            self.frame_mailbox.put((frame_id, frame))
 
     async def connect(self):
         '''
@@ -98,12 +114,12 @@ class StreamingConsumer(AsyncWebsocketConsumer):
         If the keys are not available, it sends an error message and closes the connection.
         '''
         await self.accept()
-        if not self.pub_key or not self.priv_key:
+        pub_key_b64 = self.crypto.public_key()
+        if not pub_key_b64:
             await self._send_error("RSA keys not available")
             await self.close()
             return
 
-        pub_key_b64 = base64.b64encode(self.pub_key.export_key()).decode()
         await self.send(text_data=json.dumps({
             'type': 'rsa_public_key',
             'key': pub_key_b64
@@ -118,42 +134,22 @@ class StreamingConsumer(AsyncWebsocketConsumer):
 
     async def _initialize_camera(self):
         '''
-        Initializes the camera and sets up the video capture properties.
-        Tries to open the camera using different backends based on the platform.
+        Attaches this consumer to the shared broker of the frame source the client picked.
+        The broker only starts the source for the first viewer, everyone else just
+        subscribes to the frames it is already capturing.
+        Fan-out streams join the source's channel layer group instead, see _join_fanout.
         '''
+        if self.fanout:
+            return await self._join_fanout()
         try:
-            backends = [
-                cv2.CAP_DSHOW if platform.system() == "Windows" else cv2.CAP_V4L2,
-                cv2.CAP_ANY
-            ]
-
-            for backend in backends:
-                self.cap = cv2.VideoCapture(0, backend)
-                if self.cap.isOpened():
-                    break
-
-            if not self.cap or not self.cap.isOpened():
-                logger.error("Failed to open camera")
-                return False
-
-            self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
-            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.frame_width)
-            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.frame_height)
-            self.cap.set(cv2.CAP_PROP_FPS, self.fps)
-            self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
-
-            ret, test_frame = self.cap.read()
-            if not ret:
-                logger.error("Failed to capture test frame")
-                return False
-
-            self.capture_ready.clear()
+            kind, options = FRAME_SOURCES[self.source_name]
+            self.camera = get_camera_broker(self.source_name, lambda: create_frame_source(
+                kind, self.frame_width, self.frame_height, self.fps, **options))
+            self.frame_mailbox = LatestValueMailbox()
             self.running = True
-            self.capture_thread = Thread(target=self.capture_frames, daemon=True)
-            self.capture_thread.start()
-
-            if not self.capture_ready.wait(timeout=5.0):
-                logger.error("Capture thread failed to start within timeout")
+            loop = asyncio.get_running_loop()
+            if not await loop.run_in_executor(None, self.camera.subscribe, self.on_frame):
+                self.running = False
                 return False
 
             logger.info("Camera initialized")
@@ -161,82 +157,340 @@ class StreamingConsumer(AsyncWebsocketConsumer):
 
         except Exception as e:
             logger.error(f"Camera init failed: {e}")
+            self.running = False
+            return False
+
+    async def _join_fanout(self):
+        '''
+        Subscribes to the JPEGs a producer publishes for the source on the channel layer
+        (`manage.py runproducer`), in the rendition the adaptive controller currently wants.
+        Nothing is captured or encoded in this process, so any worker can serve the stream.
+        '''
+        if self.channel_layer is None:
+            logger.error("Fan-out needs a channel layer, see CHANNEL_LAYERS in settings.py")
             return False
+        self.frame_mailbox = LatestValueMailbox()
+        self.running = True
+        await self._switch_fanout_group()
+        logger.info(f"Joined fan-out group {self.fanout_group}")
+        return True
 
-    def encode_h264_with_ffmpeg(self,frame, width, height):
-        command = [
-            "ffmpeg", "-y", "-f", "rawvideo", "-pix_fmt", "bgr24",
-            "-s", f"{width}x{height}", "-i", "-",
-            "-c:v", "libopenh264",  # fallback encoder
-            "-f", "h264", "-"       # output to stdout
-        ]
+    async def _switch_fanout_group(self):
+        '''
+        Moves to the rendition group closest to the adaptive controller's quality and scale.
+        '''
+        if self.rate_controller.enabled:
+            rendition = pick_rendition(self.rate_controller.quality, self.rate_controller.scale)
+        else:
+            rendition = pick_rendition(self.jpeg_quality, 1.0)
+        group = frame_group(self.source_name, rendition)
+        if group == self.fanout_group:
+            return
+        if self.fanout_group:
+            await self.channel_layer.group_discard(self.fanout_group, self.channel_name)
+        await self.channel_layer.group_add(group, self.channel_name)
+        self.fanout_group = group
+
+    async def frame_published(self, event):
+        '''
+        Channel layer handler for the producer's 'frame.published' messages.
+        Like on_frame it only overwrites the mailbox, the stream task picks the newest one up.
+        '''
+        if self.running and self.frame_mailbox:
+            self.frame_mailbox.put(event)
 
+    async def _stream_published(self):
+        '''
+        _stream_video for fan-out streams: the frames are already encoded by the producer,
+        the encode stage only encrypts them. Rate limiting and backpressure work the same,
+        and quality changes of the adaptive controller switch rendition groups.
+        '''
+        logger.info("Fan-out stream started")
+        self.encode_stage = EncodeStage(max_in_flight=ENCODE_IN_FLIGHT)
+        sender_task = asyncio.create_task(self._send_encoded_frames())
         try:
-            process = subprocess.Popen(
-                command,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE
-            )
-            out, err = process.communicate(input=frame.tobytes(), timeout=3.0)
-
-            if process.returncode != 0:
-                logger.error(f"FFmpeg failed: {err.decode()}")
-                return None
+            while self.running and self.fanout_group:
+                if sender_task.done():
+                    break
+                event = await self.frame_mailbox.get(timeout=1.0)
+                if event is None:
+                    continue
+                await self._switch_fanout_group()
+
+                now = time.time()
+                fps = min(self.rate_controller.fps, self.fps) if self.rate_controller.enabled else self.fps
+                if now < self.next_frame_due:
+                    self.frames_skipped_rate += 1
+                    continue
+                self.next_frame_due = max(self.next_frame_due + 1.0 / fps, now - 1.0 / fps)
 
-            return out
+                if self._client_behind(now):
+                    self.frames_skipped_backpressure += 1
+                    continue
+                self.last_frame_sent = now
 
-        except subprocess.TimeoutExpired:
-            process.kill()
-            logger.error("FFmpeg encode timed out")
-            return None
+                self.encode_stage.submit(encrypt_frame, self.cipher, event['data'])
 
         except Exception as e:
-            logger.error(f"Exception during FFmpeg encode: {e}")
-            return None
+            logger.error(f"Streaming error: {e}\n{traceback.format_exc()}")
+        finally:
+            logger.info(f"Fan-out stream ended ({self.frame_mailbox.delivered} frames picked up, "
+                        f"{self.frame_mailbox.overwritten} overwritten before pickup)")
+            sender_task.cancel()
+            try:
+                await sender_task
+            except asyncio.CancelledError:
+                pass
+            self.encode_stage.close()
+            await self._cleanup()
+
+    def _stream_coroutine(self):
+        return self._stream_published() if self.fanout else self._stream_video()
+
+    async def encode_h264(self, frame, view=None):
+        '''
+        Feeds the frame into the persistent H264 encoder and returns the access units
+        that came out of it, each tagged with the view of the frame it was encoded from.
+        The encoder is created on the first frame and recreated if the frame size changes.
+        '''
+        height, width = frame.shape[:2]
+        if self.h264_encoder and (self.h264_encoder.width, self.h264_encoder.height) != (width, height):
+            await self.h264_encoder.stop()
+            self.h264_encoder = None
+        if not self.h264_encoder:
+            self.h264_encoder = H264EncoderSession(width, height, fps=self.fps, gop=H264_GOP, use_gpu=USE_GPU)
+
+        # Skip raw frames rather than encoded ones when ffmpeg is behind,
+        # dropping encoded pictures would break the reference chain.
+        # Until the encoder's slice count is learned, the newest picture only ends when the next one starts.
+        if self.h264_encoder.in_flight >= 2:
+            return self.h264_encoder.drain()
+
+        encode_start = time.perf_counter()
+        if not await self.h264_encoder.encode(frame, view):
+            return []
+
+        unit = await self.h264_encoder.read_access_unit(timeout=1.0 / self.fps)
+        if unit:
+            metrics.record("encode", time.perf_counter() - encode_start)
+        units = [unit] if unit else []
+        return units + self.h264_encoder.drain()
 
     async def _stream_video(self):
         '''
         This method runs in a separate asyncio task to stream video frames.
-        It reads frames from the camera, encodes them as JPEG or H264, encrypts them using AES,
-        and sends them to the client.
+        It reads frames from the shared camera and hands them to the encode stage, which encodes
+        them as JPEG or H264 and encrypts them using AES on the encode pool.
+        A second task sends the finished payloads to the client in order.
         '''
         logger.info("Stream video started")
+        self.encode_stage = EncodeStage(max_in_flight=ENCODE_IN_FLIGHT)
+        if self.codec == 'tiles':
+            self.tile_encoder = TileDeltaEncoder()
+        sender_task = asyncio.create_task(self._send_encoded_frames())
         try:
-            while self.running and self.cap and self.cap.isOpened():
-                if self.frame_queue.empty():
-                    await asyncio.sleep(0.01)
+            while self.running and self.camera and self.camera.running:
+                if sender_task.done():
+                    break
+                # Timeout only so a dead camera or a pause gets noticed, frames wake us up right away
+                item = await self.frame_mailbox.get(timeout=1.0)
+                if item is None:
                     continue
 
-                frame = self.frame_queue.get_nowait()
-                if USE_H264:
-                    encoded_data = self.encode_h264_with_ffmpeg(frame, self.frame_width, self.frame_height)
-                    if not encoded_data:
-                        continue  # Skip frame if encode failed
-                else:
-                    ret, buffer = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.jpeg_quality])
-                    if not ret:
-                        logger.warning("JPEG encoding failed")
-                        continue
-                    encoded_data = buffer.tobytes()
-
-                nonce = os.urandom(12)
-                cipher = AES.new(self.aes_key, AES.MODE_GCM, nonce=nonce)
-                ciphertext, tag = cipher.encrypt_and_digest(encoded_data)
-                timestamp = time.time()
-                total_size = len(nonce) + len(ciphertext) + len(tag)
-                header = struct.pack("dII", timestamp, self.sequence_number, total_size)
-                payload = header + nonce + ciphertext + tag
+                frame_id, frame = item
+                quality, resolution, fps = self._stream_settings(frame)
 
-                await self.send(bytes_data=payload)
-                self.sequence_number += 1
+                # Frame rate limiting for the adaptive controller, skipped frames are never encoded
+                now = time.time()
+                if now < self.next_frame_due:
+                    self.frames_skipped_rate += 1
+                    continue
+                self.next_frame_due = max(self.next_frame_due + 1.0 / fps, now - 1.0 / fps)
+
+                # Don't even encode while the client is behind, the next frame after it
+                # catches up will be the newest one anyway
+                if self._client_behind(now):
+                    self.frames_skipped_backpressure += 1
+                    continue
+                self.last_frame_sent = now
+
+                # H264 and tile jobs can't be dropped once queued, so if encoding is slower
+                # than capture the capture is what gets skipped
+                if self.codec in ('h264', 'tiles') and not self.encode_stage.has_room():
+                    self.frames_skipped_backpressure += 1
+                    continue
+
+                view = self._frame_view(frame)
+                if self.codec == 'h264':
+                    if view:
+                        loop = asyncio.get_running_loop()
+                        frame = await loop.run_in_executor(get_executor(), view.render, frame, None)
+                    units = await self.encode_h264(frame, view)
+                    for i, unit in enumerate(units):
+                        if not await self.encode_stage.wait_for_room():
+                            # Later pictures reference the ones dropped here, start over from a keyframe
+                            logger.warning("Encode stage stuck, dropping H264 pictures and restarting the encoder")
+                            self.frames_skipped_backpressure += len(units) - i
+                            await self.h264_encoder.restart()
+                            break
+                        # A unit can be an earlier frame's picture, it carries the view it was cropped with
+                        self.encode_stage.submit(encrypt_frame, self.cipher, with_pose(unit.tag, unit.data), droppable=False)
+                elif self.codec == 'tiles':
+                    # Tile messages are deltas against what the client already has, never drop them
+                    self.encode_stage.submit(encode_tiles_and_encrypt, self.tile_encoder, self.tile_encoder.take_ticket(),
+                                             frame, quality, self.cipher, resolution, view, droppable=False)
+                elif self.codec == 'foveated':
+                    # Aim for where the viewer will be looking when the frame shows up,
+                    # a viewport is already centred on that
+                    centre = (0.5, 0.5) if self.mode == 'viewport' else self.gaze.predict(self._prediction_time())
+                    self.encode_stage.submit(encode_foveated_and_encrypt, self.camera, frame_id, frame, centre,
+                                             quality, self.cipher, resolution, view)
+                elif self.codec == 'stripes':
+                    self.encode_stage.submit(encode_shared_stripes_and_encrypt, self.camera, frame_id, frame,
+                                             quality, self.cipher, resolution, view)
+                else:
+                    self.encode_stage.submit(encode_shared_jpeg_and_encrypt, self.camera, frame_id, frame,
+                                             quality, self.cipher, resolution, view)
 
         except Exception as e:
             logger.error(f"Streaming error: {e}\n{traceback.format_exc()}")
         finally:
-            logger.info("Stream video ended")
+            logger.info(f"Stream video ended ({self.frame_mailbox.delivered} frames picked up, "
+                        f"{self.frame_mailbox.overwritten} overwritten before pickup)")
+            sender_task.cancel()
+            try:
+                await sender_task
+            except asyncio.CancelledError:
+                pass
+            self.encode_stage.close()
+            if self.tile_encoder:
+                self.tile_encoder.abort()
             await self._cleanup()
 
+    def _client_behind(self, now):
+        '''
+        True when too many frames or bytes are sent but not acked yet.
+        Clients that never ack are never considered behind.
+        '''
+        controller = self.rate_controller
+        if controller.latency is None:
+            return False
+        if now - self.last_frame_sent > BACKPRESSURE_PROBE:
+            return False
+        return (controller.unacked_frames >= MAX_UNACKED_FRAMES
+                or controller.unacked_bytes >= MAX_UNACKED_BYTES)
+
+    def get_stream_stats(self):
+        '''
+        Counters for the current stream, sent to the client on a 'stats' request.
+        '''
+        return {
+            'frames_sent': self.sequence_number,
+            'skipped_backpressure': self.frames_skipped_backpressure,
+            'skipped_rate_limit': self.frames_skipped_rate,
+            'dropped_in_encode': self.encode_stage.dropped if self.encode_stage else 0,
+            'overwritten_before_pickup': self.frame_mailbox.overwritten if self.frame_mailbox else 0,
+            'adaptive': self.rate_controller.get_stats(),
+            'tiles': self.tile_encoder.get_stats() if self.tile_encoder else None,
+            'clock': self.client_clock,
+        }
+
+    def _prediction_time(self):
+        '''
+        How far ahead to predict the viewer's orientation: until the frame is on their screen.
+        '''
+        return self.rate_controller.latency or 0.05
+
+    def _frame_view(self, frame):
+        '''
+        The view transform for the next frame. Viewports follow the head, so they are
+        cropped fresh for every frame from the newest orientation prediction.
+        '''
+        if self.mode == 'viewport':
+            centre = self.gaze.predict(self._prediction_time())
+            return ViewportView(self.gaze, centre, (frame.shape[1], frame.shape[0]))
+        return self.view
+
+    def _stream_settings(self, frame):
+        '''
+        Returns (JPEG quality, output resolution, fps) for the next frame, either picked by
+        the adaptive controller or the ones set by hand by the client.
+        '''
+        if not self.rate_controller.enabled:
+            return self.jpeg_quality, None, self.fps
+        height, width = frame.shape[:2]
+        return (self.rate_controller.quality, self.rate_controller.resolution(width, height),
+                min(self.rate_controller.fps, self.fps))
+
+    async def _send_encoded_frames(self):
+        '''
+        Sends the encrypted frames coming out of the encode stage, in capture order.
+        Format: [8 bytes timestamp][4 bytes sequence][4 bytes size][12 bytes nonce][ciphertext][16 bytes tag]
+        '''
+        try:
+            while True:
+                encrypted = await self.encode_stage.next_result()
+                if encrypted is None:
+                    continue
+
+                timestamp = time.time()
+                header = struct.pack("dII", timestamp, self.sequence_number, len(encrypted))
+                with metrics.time("send"):
+                    await self.send(bytes_data=header + encrypted)
+                self.rate_controller.on_frame_sent(self.sequence_number, len(header) + len(encrypted),
+                                                   timestamp, time.time())
+                self.sequence_number += 1
+
+                decision = self.rate_controller.update()
+                if decision:
+                    await self.send(text_data=json.dumps({
+                        'type': 'status',
+                        'message': decision,
+                        'adaptive': self.rate_controller.get_stats()
+                    }))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Send error: {e}")
+
+    async def _start_session(self, data, key: bytes, server_random: Optional[bytes] = None):
+        '''
+        Takes the stream options from the key exchange (or resume) message and starts streaming.
+        stream_ready carries a ticket the client can resume this session with later.
+        '''
+        self.cipher = SessionCipher(key)
+        if data.get('codec') in CODECS:
+            self.codec = data['codec']
+        if data.get('source') in FRAME_SOURCES:
+            self.source_name = data['source']
+        if data.get('mode') in STREAM_MODES:
+            self.mode = data['mode']
+        if self.mode == 'stereo':
+            lens = data.get('lens')
+            self.view = StereoView(lens if lens in LENS_PROFILES else DEFAULT_LENS_PROFILE)
+        if data.get('fanout'):
+            # The producer only publishes plain JPEGs of the whole frame
+            self.fanout = True
+            self.codec = 'jpeg'
+            self.mode = 'mono'
+            self.view = None
+
+        if await self._initialize_camera():
+            self.stream_task = asyncio.create_task(self._stream_coroutine())
+            await self.send(text_data=json.dumps({
+                'type': 'stream_ready',
+                'message': 'Video stream started',
+                'codec': self.codec,
+                'source': self.source_name,
+                'mode': self.mode,
+                'fanout': self.fanout,
+                'viewport_fov': ViewportView.field_of_view(self.gaze) if self.mode == 'viewport' else None,
+                'ticket': self.crypto.issue_ticket(key),
+                'server_random': base64.b64encode(server_random).decode() if server_random else None,
+            }))
+        else:
+            await self._send_error(f"Failed to start frame source '{self.source_name}'")
+
     async def _send_error(self, message):
         '''
         Convinient method to send an error message to the client.
@@ -247,61 +501,61 @@ class StreamingConsumer(AsyncWebsocketConsumer):
     async def _cleanup(self):
         '''
         Cleans up the resources used by the consumer.
-        This method stops the camera stream, releases the camera resources, and clears the frame queue.
+        This method stops the camera stream, detaches from the camera, and closes the frame mailbox.
         '''
         logger.info("Cleaning up")
         self.running = False
 
-        if self.stream_task and not self.stream_task.done():
+        # _stream_video calls this from its own finally, a task can't await itself
+        if self.stream_task and not self.stream_task.done() and self.stream_task is not asyncio.current_task():
             self.stream_task.cancel()
             try:
                 await self.stream_task
             except asyncio.CancelledError:
                 logger.info("Stream task was cancelled")
 
-        if self.capture_thread and self.capture_thread.is_alive():
-            logger.info("Waiting for capture thread to finish")
-            self.capture_thread.join(timeout=2.0)
-            if self.capture_thread.is_alive():
-                logger.warning("Capture thread did not finish within timeout")
+        if self.fanout_group:
+            await self.channel_layer.group_discard(self.fanout_group, self.channel_name)
+            self.fanout_group = None
 
-        if self.cap:
-            self.cap.release()
-            self.cap = None
+        if self.camera:
+            # Only detaches this viewer, the camera stays open for the others
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.camera.unsubscribe, self.on_frame)
+            self.camera = None
 
-        while not self.frame_queue.empty():
-            try:
-                self.frame_queue.get_nowait()
-            except:
-                break
+        if self.h264_encoder:
+            await self.h264_encoder.stop()
+            self.h264_encoder = None
+
+        if self.frame_mailbox:
+            self.frame_mailbox.close()
 
         logger.info("Cleanup completed")
 
-    def decrypt_message(self, encrypted_bytes: bytes) -> Optional[str]:
+    def decrypt_bytes(self, encrypted_bytes: bytes) -> Optional[bytes]:
         '''
         Decrypts an AES-GCM encrypted message sent by the client.
         Format: [12 bytes nonce][ciphertext + tag]
         '''
         try:
-            if not self.aes_key:
+            if not self.cipher:
                 logger.error("AES key not set")
                 return None
-
-            nonce = encrypted_bytes[:12]
-            ciphertext_and_tag = encrypted_bytes[12:]
-
-            cipher = AES.new(self.aes_key, AES.MODE_GCM, nonce=nonce)
-            decrypted_data = cipher.decrypt_and_verify(
-                ciphertext_and_tag[:-16],  # ciphertext
-                ciphertext_and_tag[-16:]  # tag
-            )
-            return decrypted_data.decode('utf-8')
+            return self.cipher.decrypt(encrypted_bytes)
         except Exception as e:
             logger.error(f"Decryption failed: {e}")
             return None
 
+    def decrypt_message(self, encrypted_bytes: bytes) -> Optional[str]:
+        '''
+        Decrypts a JSON control message, see decrypt_bytes.
+        '''
+        decrypted = self.decrypt_bytes(encrypted_bytes)
+        return decrypted.decode('utf-8') if decrypted is not None else None
 
     async def receive(self, text_data=None, bytes_data=None):
+        received_at = time.time()  # t2 for clock sync, before decrypting like the client encrypts before t1
         try:
             data = None
 
@@ -320,10 +574,15 @@ class StreamingConsumer(AsyncWebsocketConsumer):
                     data = json.loads(decrypted)
 
             elif bytes_data:
-                decrypted = self.decrypt_message(bytes_data)
+                decrypted = self.decrypt_bytes(bytes_data)
                 if not decrypted:
                     await self._send_error("Failed to decrypt binary message")
                     return
+                # Orientation samples come in binary batches, everything else is JSON
+                if is_sensor_batch(decrypted):
+                    base_time, samples, server_time = parse_sensor_batch(decrypted)
+                    self.poses.add_batch(base_time, samples, server_time)
+                    return
                 data = json.loads(decrypted)
 
             if not data:
@@ -341,38 +600,28 @@ class StreamingConsumer(AsyncWebsocketConsumer):
                     the video stream.
                     '''
                     enc_key = base64.b64decode(data['encrypted_key'])
-                    iv = base64.b64decode(data['iv'])
-                    cipher = PKCS1_v1_5.new(self.priv_key)
-                    decrypted_key_b64 = cipher.decrypt(enc_key, None)
-
-                    if decrypted_key_b64 is None:
-                        await self._send_error("AES decryption failed")
+                    self.iv = base64.b64decode(data['iv'])
+                    try:
+                        key = await self.crypto.decrypt_session_key(enc_key)
+                    except ValueError as e:
+                        await self._send_error(str(e))
                         return
+                    await self._start_session(data, key)
 
+                case 'session_resume':
+                    '''
+                    Reconnecting client with the ticket from its last stream_ready, skips RSA.
+                    Both sides derive a fresh key from the ticket's key and each other's random.
+                    On failure the client falls back to 'aes_key_exchange'.
+                    '''
                     try:
-                        decrypted_key = base64.b64decode(decrypted_key_b64)
-                    except Exception as e:
-                        logger.error("Base64 decode error on decrypted key: %s", e)
-                        await self._send_error("Invalid decrypted AES key format")
+                        key, server_random = self.crypto.resume(data.get('ticket') or '',
+                                                                base64.b64decode(data.get('client_random') or ''),
+                                                                base64.b64decode(data.get('proof') or ''))
+                    except ValueError as e:
+                        await self.send(text_data=json.dumps({'type': 'resume_failed', 'message': str(e)}))
                         return
-
-                    if len(decrypted_key) > 32:
-                        self.aes_key = decrypted_key[:32]
-                    elif len(decrypted_key) in [16, 24, 32]:
-                        self.aes_key = decrypted_key
-                    else:
-                        self.aes_key = decrypted_key.ljust(32, b'\x00')
-
-                    self.iv = iv
-
-                    if await self._initialize_camera():
-                        self.stream_task = asyncio.create_task(self._stream_video())
-                        await self.send(text_data=json.dumps({
-                            'type': 'stream_ready',
-                            'message': 'Video stream started'
-                        }))
-                    else:
-                        await self._send_error("Failed to initialize camera")
+                    await self._start_session(data, key, server_random)
 
                 case 'pause':
                     '''
@@ -380,6 +629,8 @@ class StreamingConsumer(AsyncWebsocketConsumer):
                     The client can resume the stream later.
                     '''
                     self.running = False
+                    if self.frame_mailbox:
+                        self.frame_mailbox.close()
                     await self.send(text_data=json.dumps({'type': 'status', 'message': 'Stream paused!'}))
 
                 case 'resume':
@@ -388,33 +639,107 @@ class StreamingConsumer(AsyncWebsocketConsumer):
                     '''
                     if not self.running:
                         logger.info("Resuming stream")
-                        self.running = True
-                        if not self.stream_task or self.stream_task.done():
-                            if await self._initialize_camera():
-                                self.stream_task = asyncio.create_task(self._stream_video())
+                        # Pausing only tells the stream task to stop, its cleanup may still be running.
+                        # Let it finish, or it would detach the camera and mailbox set up here.
+                        if self.stream_task and not self.stream_task.done():
+                            try:
+                                await self.stream_task
+                            except asyncio.CancelledError:
+                                pass
+                        if await self._initialize_camera():
+                            self.stream_task = asyncio.create_task(self._stream_coroutine())
                         await self.send(text_data=json.dumps({'type': 'status', 'message': 'Stream resumed'}))
 
                 case 'quality':
                     '''
-                    Just adjusts the JPEG quality of the stream. Could probably be made dynamic based on the network conditions.
+                    Sets the JPEG quality by hand. This turns the adaptive controller off,
+                    the client can turn it back on with an 'adaptive' message.
                     '''
                     value = data.get('value')
                     if isinstance(value, int) and 1 <= value <= 100:
                         self.jpeg_quality = value
-                        await self.send(text_data=json.dumps({'type': 'status', 'message': f'JPEG quality set to {value}'}))
+                        self.rate_controller.enabled = False
+                        await self.send(text_data=json.dumps({'type': 'status', 'message': f'JPEG quality set to {value} (adaptive off)'}))
                     else:
                         await self._send_error("Invalid quality value")
 
+                case 'adaptive':
+                    '''
+                    Turns the network adaptive quality/resolution/frame rate controller on or off.
+                    '''
+                    self.rate_controller.enabled = bool(data.get('enabled', True))
+                    state = 'on' if self.rate_controller.enabled else 'off'
+                    await self.send(text_data=json.dumps({'type': 'status', 'message': f'Adaptive quality {state}'}))
+
+                case 'recenter':
+                    '''
+                    The current head orientation becomes the middle of the frame for foveated encoding.
+                    '''
+                    self.gaze.recenter()
+
+                case 'keyframe':
+                    '''
+                    Client lost track of the tile state (or just joined), resend the whole frame.
+                    '''
+                    if self.tile_encoder:
+                        self.tile_encoder.request_keyframe()
+
+                case 'stats':
+                    await self.send(text_data=json.dumps({'type': 'stats', 'stats': self.get_stream_stats()}))
+
+                case 'ack':
+                    '''
+                    Client acknowledges a frame it received, feeds the adaptive controller.
+                    '''
+                    sequence = data.get('sequence')
+                    if isinstance(sequence, int):
+                        self.rate_controller.on_ack(sequence)
+                    # Browser side timings ride along with the ack. 'network' is send -> decrypted
+                    # on the synchronised clock, so it is only sent once the client has synced.
+                    # 'decode' and 'display' come later, in an ack without a sequence once the
+                    # frame is on screen.
+                    for stage in ('network', 'decrypt', 'decode', 'display'):
+                        value = data.get(f'{stage}_ms')
+                        if isinstance(value, (int, float)):
+                            metrics.record(stage, value / 1000)
+
+                case 'clock_sync':
+                    '''
+                    NTP style exchange so the client can map our frame timestamps onto its clock,
+                    see socket_com/clock_sync.py. Echoes its t1 with our receive and reply times.
+                    Plaintext like the other replies, it only carries timestamps.
+                    '''
+                    t1 = data.get('t1')
+                    if not isinstance(t1, (int, float)):
+                        await self._send_error("Invalid clock sync request")
+                        return
+                    if isinstance(data.get('estimate'), dict):
+                        self.client_clock = data['estimate']
+                    await self.send(text_data=json.dumps({
+                        'type': 'clock_sync',
+                        'id': data.get('id'),
+                        't1': t1,
+                        't2': received_at,
+                        't3': time.time(),
+                    }))
+
                 case 'terminate':
                     self.running = False
                     await self._send_error("Stream terminated by client")
                     await self.close()
                 case 'gyro':
+                    '''
+                    Single plaintext orientation sample from older clients, current ones send
+                    encrypted binary sensor batches instead.
+                    '''
                     alpha = data.get('alpha')
                     beta = data.get('beta')
                     gamma = data.get('gamma')
                     timestamp = data.get('timestamp')
-                    logger.info(f"Gyroscope - α: {alpha:.2f}, β: {beta:.2f}, γ: {gamma:.2f}, t: {timestamp}")
+                    logger.debug(f"Gyroscope - α: {alpha}, β: {beta}, γ: {gamma}, t: {timestamp}")
+                    # Browsers without a gyro send nulls
+                    if isinstance(alpha, (int, float)) and isinstance(beta, (int, float)):
+                        self.poses.add(alpha, beta, gamma if isinstance(gamma, (int, float)) else 0.0)
                 case _:
                     await self._send_error("Unknown message type")
 
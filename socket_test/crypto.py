@@ -0,0 +1,192 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import itertools
+import logging
+import os
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Optional, Tuple
+
+from Crypto.Cipher import AES, PKCS1_v1_5
+from Crypto.PublicKey import RSA
+
+from socket_com.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+PUBLIC_KEY_FILE = "server_public.pem"
+PRIVATE_KEY_FILE = "server_private.pem"
+KEY_CHECK_INTERVAL = 1.0  # seconds between checks whether the key files changed
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+# Session tickets let a reconnecting client skip RSA: the server hands out its session key
+# encrypted with a key only this process knows, and on 'session_resume' derives a fresh key
+# from it, so no (key, nonce) pair is ever used twice. Tickets die with the process.
+TICKET_LIFETIME = 3600  # seconds
+TICKET_FORMAT = "<d"    # expiry time, followed by the session key
+RESUME_RANDOM_SIZE = 16
+
+
+class SessionCipher:
+    '''
+    AES-GCM with one stream's key. Nonces are a random 4 byte prefix and an 8 byte counter,
+    so encrypting a frame doesn't need os.urandom, and the prefix keeps them apart from the
+    random nonces the client uses with the same key.
+    Safe to use from the encode pool threads, next() on a count is atomic.
+    '''
+
+    def __init__(self, key: bytes):
+        self.key = key
+        self.prefix = os.urandom(4)
+        self.counter = itertools.count()
+
+    def next_nonce(self) -> bytes:
+        return self.prefix + next(self.counter).to_bytes(8, 'big')
+
+    def encrypt(self, data: bytes) -> bytes:
+        '''Format: [12 bytes nonce][ciphertext][16 bytes tag]'''
+        nonce = self.next_nonce()
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        return nonce + ciphertext + tag
+
+    def decrypt(self, message: bytes) -> bytes:
+        '''Opposite of encrypt, raises ValueError if the message was tampered with'''
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=message[:NONCE_SIZE])
+        return cipher.decrypt_and_verify(message[NONCE_SIZE:-TAG_SIZE], message[-TAG_SIZE:])
+
+
+def derive_resumed_key(master: bytes, client_random: bytes, server_random: bytes) -> bytes:
+    '''The key of a resumed session, script.js derives the same with WebCrypto HMAC'''
+    return hmac.new(master, b"stream key" + client_random + server_random, hashlib.sha256).digest()
+
+
+def resume_proof(master: bytes, client_random: bytes) -> bytes:
+    '''Shows the client knows the ticket's key, not just the ticket'''
+    return hmac.new(master, b"resume" + client_random, hashlib.sha256).digest()
+
+
+class CryptoService:
+    '''
+    Process wide RSA keys and session tickets, shared by every consumer. The key files are
+    parsed once and reloaded when they change on disk, and the RSA private key operation runs
+    on its own small pool so a burst of connecting clients doesn't stall the event loop or
+    the encode pool.
+    '''
+
+    def __init__(self, public_key_file: str = PUBLIC_KEY_FILE, private_key_file: str = PRIVATE_KEY_FILE):
+        self.public_key_file = public_key_file
+        self.private_key_file = private_key_file
+        self.lock = Lock()
+        self.pub_key: Optional[RSA.RsaKey] = None
+        self.priv_key: Optional[RSA.RsaKey] = None
+        self.public_key_b64: Optional[str] = None
+        self.file_stamps = None
+        self.next_check = 0.0
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="rsa")
+        self.ticket_cipher = SessionCipher(os.urandom(32))
+
+    def _file_stamps(self):
+        return tuple((s.st_mtime_ns, s.st_size) for s in map(os.stat, (self.public_key_file, self.private_key_file)))
+
+    def _reload_if_changed(self):
+        now = time.monotonic()
+        if now < self.next_check:
+            return
+        with self.lock:
+            if now < self.next_check:
+                return
+            self.next_check = now + KEY_CHECK_INTERVAL
+            try:
+                stamps = self._file_stamps()
+                if stamps == self.file_stamps:
+                    return
+                with open(self.public_key_file, "rb") as f:
+                    pub_key = RSA.import_key(f.read())
+                with open(self.private_key_file, "rb") as f:
+                    priv_key = RSA.import_key(f.read())
+            except Exception as e:
+                # Keep whatever keys we had, the files may be halfway through being rewritten
+                logger.error(f"Failed to load RSA keys: {e}")
+                return
+            self.pub_key = pub_key
+            self.priv_key = priv_key
+            self.public_key_b64 = base64.b64encode(pub_key.export_key()).decode()
+            self.file_stamps = stamps
+            logger.info("RSA keys loaded successfully")
+
+    def public_key(self) -> Optional[str]:
+        '''Base64 of the PEM public key for the 'rsa_public_key' message, None without keys'''
+        self._reload_if_changed()
+        return self.public_key_b64
+
+    def _decrypt_session_key(self, priv_key: RSA.RsaKey, encrypted_key: bytes) -> bytes:
+        with metrics.time("key_exchange"):
+            decrypted_key_b64 = PKCS1_v1_5.new(priv_key).decrypt(encrypted_key, None)
+        if decrypted_key_b64 is None:
+            raise ValueError("AES decryption failed")
+        try:
+            decrypted_key = base64.b64decode(decrypted_key_b64)
+        except Exception as e:
+            logger.error("Base64 decode error on decrypted key: %s", e)
+            raise ValueError("Invalid decrypted AES key format")
+
+        if len(decrypted_key) > 32:
+            return decrypted_key[:32]
+        if len(decrypted_key) in [16, 24, 32]:
+            return decrypted_key
+        return decrypted_key.ljust(32, b'\x00')
+
+    async def decrypt_session_key(self, encrypted_key: bytes) -> bytes:
+        '''
+        RSA decrypts the AES key a client sent (JSEncrypt encrypts its base64), off the event loop.
+        Raises ValueError with a message for the client when it can't.
+        '''
+        self._reload_if_changed()
+        if not self.priv_key:
+            raise ValueError("RSA keys not available")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._decrypt_session_key, self.priv_key, encrypted_key)
+
+    def issue_ticket(self, key: bytes) -> str:
+        '''Base64 ticket for a session key, opaque to the client'''
+        payload = struct.pack(TICKET_FORMAT, time.time() + TICKET_LIFETIME) + key
+        return base64.b64encode(self.ticket_cipher.encrypt(payload)).decode()
+
+    def resume(self, ticket: str, client_random: bytes, proof: bytes) -> Tuple[bytes, bytes]:
+        '''
+        Checks a 'session_resume' request and returns (new session key, server random).
+        Raises ValueError when the ticket is unknown, expired or the proof doesn't match,
+        the client then falls back to the RSA exchange.
+        '''
+        if len(client_random) != RESUME_RANDOM_SIZE:
+            raise ValueError("Invalid resume request")
+        try:
+            payload = self.ticket_cipher.decrypt(base64.b64decode(ticket))
+        except (ValueError, TypeError):
+            raise ValueError("Unknown session ticket")
+        expiry, = struct.unpack_from(TICKET_FORMAT, payload)
+        master = payload[struct.calcsize(TICKET_FORMAT):]
+        if time.time() > expiry:
+            raise ValueError("Session ticket expired")
+        if not hmac.compare_digest(proof, resume_proof(master, client_random)):
+            raise ValueError("Invalid resume proof")
+
+        server_random = os.urandom(RESUME_RANDOM_SIZE)
+        return derive_resumed_key(master, client_random, server_random), server_random
+
+
+_service: Optional[CryptoService] = None
+
+
+def get_crypto_service() -> CryptoService:
+    global _service
+    if _service is None:
+        _service = CryptoService()
+    return _service
@@ -0,0 +1,269 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from socket_com.metrics import metrics
+from socket_com.striped_jpeg import encode_stripes, encode_striped_jpeg, pack_stripes
+
+from .crypto import SessionCipher
+from .foveation import encode_foveated, encode_periphery, foveated_qualities
+
+logger = logging.getLogger(__name__)
+
+# One pool for the whole process, shared by every stream. cv2.imencode and the
+# pycryptodome AES calls release the GIL so these threads actually run in parallel.
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="encode")
+    return _executor
+
+
+def encrypt_frame(cipher: SessionCipher, data: bytes) -> bytes:
+    '''
+    Encrypts an encoded frame with the stream's AES-GCM session.
+    Format: [12 bytes nonce][ciphertext][16 bytes tag]
+    '''
+    with metrics.time("encrypt"):
+        return cipher.encrypt(data)
+
+
+def encode_jpeg(frame: np.ndarray, quality: int, resolution: Optional[Tuple[int, int]] = None) -> Optional[bytes]:
+    '''
+    JPEG encodes a frame, resizing it first if a different (width, height) is asked for.
+    Returns None if the encode failed.
+    '''
+    if resolution and (frame.shape[1], frame.shape[0]) != resolution:
+        with metrics.time("convert"):
+            frame = cv2.resize(frame, resolution, interpolation=cv2.INTER_AREA)
+    with metrics.time("encode"):
+        # Big frames are encoded in stripes across cores and stitched back into one JPEG
+        data = encode_striped_jpeg(frame, quality)
+    if data is None:
+        logger.warning("JPEG encoding failed")
+    return data
+
+
+def encode_jpeg_and_encrypt(frame: np.ndarray, quality: int, cipher: SessionCipher,
+                            resolution: Optional[Tuple[int, int]] = None) -> Optional[bytes]:
+    '''
+    JPEG encodes and encrypts a frame, runs on the encode pool.
+    Returns None if the encode failed.
+    '''
+    data = encode_jpeg(frame, quality, resolution)
+    return encrypt_frame(cipher, data) if data else None
+
+
+def with_pose(view, data: bytes) -> bytes:
+    '''
+    Pose-cropped views (ViewportView) send the orientation they were cropped for
+    in front of the payload, so the browser can reproject the frame.
+    '''
+    return view.pose + data if view and view.pose else data
+
+
+def encode_shared_jpeg_and_encrypt(broker, frame_id: int, frame: np.ndarray, quality: int,
+                                   cipher: SessionCipher, resolution: Optional[Tuple[int, int]] = None,
+                                   view=None) -> Optional[bytes]:
+    '''
+    Same as encode_jpeg_and_encrypt, but the JPEG comes from the camera broker's cache
+    so viewers at the same quality and resolution share one encode.
+    Only the encryption is done per viewer.
+    view is an optional transform (StereoView, ViewportView) with a cache key and a
+    render(frame, resolution) method, applied before encoding.
+    '''
+    if resolution is None:
+        resolution = (frame.shape[1], frame.shape[0])
+
+    def encode():
+        if view:
+            # The view already scales to the resolution, and may not be that size itself
+            return encode_jpeg(view.render(frame, resolution), quality)
+        return encode_jpeg(frame, quality, resolution)
+
+    data = broker.get_encoded(frame_id, ('jpeg', quality, resolution, view.key if view else None), encode)
+    return encrypt_frame(cipher, with_pose(view, data)) if data else None
+
+
+def encode_stripes_message(frame: np.ndarray, quality: int, resolution: Optional[Tuple[int, int]] = None) -> Optional[bytes]:
+    '''
+    Encodes a frame as independent JPEG stripes in parallel, packed in a stripes message
+    the client decodes stripe by stripe (see socket_com/striped_jpeg.py).
+    '''
+    if resolution and (frame.shape[1], frame.shape[0]) != resolution:
+        with metrics.time("convert"):
+            frame = cv2.resize(frame, resolution, interpolation=cv2.INTER_AREA)
+    with metrics.time("encode"):
+        stripes = encode_stripes(frame, quality)
+    if stripes is None:
+        logger.warning("Stripe encoding failed")
+        return None
+    return pack_stripes(frame.shape[1], frame.shape[0], stripes)
+
+
+def encode_shared_stripes_and_encrypt(broker, frame_id: int, frame: np.ndarray, quality: int,
+                                      cipher: SessionCipher, resolution: Optional[Tuple[int, int]] = None,
+                                      view=None) -> Optional[bytes]:
+    '''
+    encode_shared_jpeg_and_encrypt for the 'stripes' codec, the stripes message is shared
+    through the broker's cache the same way.
+    '''
+    if resolution is None:
+        resolution = (frame.shape[1], frame.shape[0])
+
+    def encode():
+        if view:
+            return encode_stripes_message(view.render(frame, resolution), quality)
+        return encode_stripes_message(frame, quality, resolution)
+
+    data = broker.get_encoded(frame_id, ('stripes', quality, resolution, view.key if view else None), encode)
+    return encrypt_frame(cipher, with_pose(view, data)) if data else None
+
+
+def encode_tiles_and_encrypt(tile_encoder, ticket: int, frame: np.ndarray, quality: int, cipher: SessionCipher,
+                             resolution: Optional[Tuple[int, int]] = None, view=None) -> Optional[bytes]:
+    '''
+    Encodes the changed tiles of a frame with a TileDeltaEncoder and encrypts the message.
+    '''
+    # Rendered before taking the ticket's turn, so views still run in parallel
+    if view:
+        frame = view.render(frame, resolution)
+        resolution = None
+    data = tile_encoder.encode(ticket, frame, quality, resolution)
+    return encrypt_frame(cipher, with_pose(view, data)) if data else None
+
+
+def encode_foveated_and_encrypt(broker, frame_id: int, frame: np.ndarray, centre: Tuple[float, float], quality: int,
+                                cipher: SessionCipher, resolution: Optional[Tuple[int, int]] = None,
+                                view=None) -> Optional[bytes]:
+    '''
+    Encodes a foveated message around the viewer's predicted view centre and encrypts it.
+    The low resolution periphery is the same for every viewer, so it comes from the broker's cache.
+    '''
+    if view:
+        frame = view.render(frame, resolution)
+    elif resolution and (frame.shape[1], frame.shape[0]) != resolution:
+        with metrics.time("convert"):
+            frame = cv2.resize(frame, resolution, interpolation=cv2.INTER_AREA)
+
+    periphery_quality = foveated_qualities(quality)[1]
+    periphery = broker.get_encoded(frame_id, ('periphery', periphery_quality, resolution, view.key if view else None),
+                                   lambda: encode_periphery(frame, periphery_quality))
+    data = encode_foveated(frame, centre, quality, periphery)
+    return encrypt_frame(cipher, with_pose(view, data)) if data else None
+
+
+class _Job:
+    __slots__ = ("future", "droppable", "discarded")
+
+    def __init__(self, future: Future, droppable: bool):
+        self.future = future
+        self.droppable = droppable
+        self.discarded = False
+
+
+class EncodeStage:
+    '''
+    Bounded encode/encrypt stage for one stream.
+    Jobs run on the shared encode pool, results come back in submission order.
+    When max_in_flight jobs are queued, the oldest job that isn't running yet
+    (or that finished but wasn't sent) is dropped, since a newer frame is more useful.
+    If every job is already running the new frame is dropped instead.
+    Jobs that can't be dropped get backpressure instead: callers check has_room() and
+    skip the capture, or wait_for_room() before submitting.
+    '''
+
+    def __init__(self, max_in_flight: int = 2):
+        self.max_in_flight = max_in_flight
+        self.jobs: Deque[_Job] = deque()
+        self.job_added = asyncio.Event()
+        self.job_taken = asyncio.Event()
+        self.dropped = 0
+
+    def submit(self, fn, *args, droppable: bool = True) -> bool:
+        '''
+        Queues fn(*args) on the encode pool. Jobs that are not droppable (H264 access
+        units, which later frames depend on) are never dropped or refused, so callers
+        have to make room for them first (has_room, wait_for_room).
+        Returns False if the job was dropped.
+        '''
+        if len(self.jobs) >= self.max_in_flight and not self._drop_stale():
+            if droppable:
+                self.dropped += 1
+                return False
+
+        self.jobs.append(_Job(get_executor().submit(fn, *args), droppable))
+        self.job_added.set()
+        return True
+
+    def has_room(self) -> bool:
+        '''
+        Whether a non-droppable job fits without going over max_in_flight, counting
+        droppable jobs that submit() would drop to make room. Running jobs can't be
+        cancelled, so those don't count.
+        '''
+        return (len(self.jobs) < self.max_in_flight
+                or any(job.droppable and not job.future.running() for job in self.jobs))
+
+    async def wait_for_room(self, timeout: float = 1.0) -> bool:
+        '''
+        Waits until has_room(), for up to timeout seconds. False if it timed out.
+        '''
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not self.has_room():
+            self.job_taken.clear()
+            try:
+                await asyncio.wait_for(self.job_taken.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def _drop_stale(self):
+        for job in self.jobs:
+            if job.droppable and (job.future.done() or job.future.cancel()):
+                job.discarded = True
+                self.jobs.remove(job)
+                self.dropped += 1
+                return True
+        return False
+
+    async def next_result(self):
+        '''
+        Waits for the oldest job and returns its result. Returns None if that job
+        was dropped or failed, so callers should just move on to the next one.
+        '''
+        while not self.jobs:
+            self.job_added.clear()
+            await self.job_added.wait()
+
+        job = self.jobs[0]
+        result = asyncio.wrap_future(job.future)
+        await asyncio.wait([result])
+        if self.jobs and self.jobs[0] is job:
+            self.jobs.popleft()
+        self.job_taken.set()
+
+        if job.discarded or result.cancelled():
+            return None
+        if result.exception():
+            logger.error(f"Encode job failed: {result.exception()}")
+            return None
+        return result.result()
+
+    def close(self):
+        '''
+        Cancels everything that hasn't started yet.
+        '''
+        for job in self.jobs:
+            job.future.cancel()
+        self.jobs.clear()
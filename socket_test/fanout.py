@@ -0,0 +1,98 @@
+import asyncio
+import logging
+from typing import Optional, Sequence, Tuple
+
+from .camera_broker import CameraBroker
+from .encode_pipeline import encode_jpeg, get_executor
+from .mailbox import LatestValueMailbox
+
+logger = logging.getLogger(__name__)
+
+# (JPEG quality, resolution scale) the producer publishes every frame in, best first.
+# Each one is its own group, viewers join the one closest to what their adaptive controller wants.
+FANOUT_RENDITIONS: Tuple[Tuple[int, float], ...] = ((60, 1.0), (35, 1.0), (25, 0.5))
+
+Rendition = Tuple[int, float]
+
+
+def frame_group(source: str, rendition: Rendition) -> str:
+    '''Channel layer group of a source's frames in one rendition'''
+    quality, scale = rendition
+    return f"frames.{source}.q{quality}.s{int(scale * 100)}"
+
+
+def pick_rendition(quality: int, scale: float, renditions: Sequence[Rendition] = FANOUT_RENDITIONS) -> Rendition:
+    '''The best rendition that isn't above the asked quality and scale, the worst one otherwise'''
+    for rendition in renditions:
+        if rendition[0] <= quality and rendition[1] <= scale:
+            return rendition
+    return renditions[-1]
+
+
+class FrameProducer:
+    '''
+    Captures from a broker, JPEG encodes every frame once per rendition and publishes the
+    results to the rendition groups on a channel layer as 'frame.published' messages.
+    Consumers in any worker process just encrypt and forward them, so the number of viewers
+    is limited by worker cores instead of by how many encodes one process can do.
+
+    Frames are unencrypted on the layer, every viewer has its own key. Keep the layer local
+    (in memory or the Unix socket hub, which only the same user can connect to).
+    '''
+
+    def __init__(self, broker: CameraBroker, source_name: str, channel_layer,
+                 renditions: Sequence[Rendition] = FANOUT_RENDITIONS):
+        self.broker = broker
+        self.source_name = source_name
+        self.channel_layer = channel_layer
+        self.renditions = tuple(renditions)
+        self.mailbox: Optional[LatestValueMailbox] = None
+        self.published = 0
+
+    def on_frame(self, frame_id, frame, timestamp):
+        if self.mailbox:
+            self.mailbox.put((frame_id, frame, timestamp))
+
+    async def run(self, stop: Optional[asyncio.Event] = None):
+        self.mailbox = LatestValueMailbox()
+        loop = asyncio.get_running_loop()
+        if not await loop.run_in_executor(None, self.broker.subscribe, self.on_frame):
+            raise RuntimeError(f"Failed to start frame source '{self.source_name}'")
+        logger.info(f"Publishing {self.source_name} in {len(self.renditions)} renditions")
+
+        try:
+            while (stop is None or not stop.is_set()) and self.broker.running:
+                item = await self.mailbox.get(timeout=1.0)
+                if item is None:
+                    continue
+                await self._publish(*item)
+        finally:
+            self.mailbox.close()
+            await loop.run_in_executor(None, self.broker.unsubscribe, self.on_frame)
+            logger.info(f"Stopped publishing {self.source_name} ({self.published} frames)")
+
+    async def _publish(self, frame_id, frame, timestamp):
+        height, width = frame.shape[:2]
+        loop = asyncio.get_running_loop()
+
+        # Renditions are encoded in parallel on the encode pool, while this waits the mailbox
+        # keeps only the newest frame, so a slow encode drops frames instead of queueing them
+        encodes = []
+        for quality, scale in self.renditions:
+            resolution = (max(int(width * scale) // 2 * 2, 2), max(int(height * scale) // 2 * 2, 2))
+            encodes.append(loop.run_in_executor(get_executor(), encode_jpeg, frame, quality, resolution))
+        results = await asyncio.gather(*encodes)
+
+        for rendition, data in zip(self.renditions, results):
+            if data is None:
+                continue
+            await self.channel_layer.group_send(frame_group(self.source_name, rendition), {
+                'type': 'frame.published',
+                'source': self.source_name,
+                'frame_id': frame_id,
+                'captured_at': timestamp,
+                'quality': rendition[0],
+                'scale': rendition[1],
+                'data': data,
+            })
+        self.published += 1
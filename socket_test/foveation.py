@@ -0,0 +1,139 @@
+import logging
+import struct
+import time
+from threading import Lock
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+from socket_com.metrics import metrics
+
+from .pose import ALPHA, BETA, PoseRingBuffer
+
+logger = logging.getLogger(__name__)
+
+# Message layout (little endian), this is what gets encrypted and sent:
+#   [1 byte version][2 bytes width][2 bytes height]
+#   [2 bytes fovea x][2 bytes fovea y][2 bytes fovea w][2 bytes fovea h]
+#   [4 bytes periphery jpeg size][4 bytes fovea jpeg size][periphery jpeg][fovea jpeg]
+# The periphery covers the whole frame at a lower resolution and gets stretched to width x height,
+# the fovea is drawn on top at (x, y) at full resolution.
+FOVEATED_MESSAGE_VERSION = 1
+HEADER_FORMAT = "<BHHHHHHII"
+
+FOVEA_SIZE = 0.35        # Fovea width and height as a fraction of the frame
+PERIPHERY_SCALE = 0.25   # Periphery resolution relative to the frame
+FIELD_OF_VIEW = (90.0, 60.0)  # Degrees of head rotation that move the fovea across the whole frame
+
+
+def angle_difference(a: float, b: float) -> float:
+    '''Smallest signed difference a - b in degrees, across the 0/360 wrap'''
+    return (a - b + 180.0) % 360.0 - 180.0
+
+
+class GazePredictor:
+    '''
+    Turns the viewer's head orientation history into where in the frame they will be
+    looking when a frame arrives. The orientation of the first sample (or the first one
+    after recenter()) is the centre of the frame. The samples come from the pose buffer
+    the consumer fills from the gyro and sensor messages.
+    '''
+
+    def __init__(self, field_of_view: Tuple[float, float] = FIELD_OF_VIEW, poses: Optional[PoseRingBuffer] = None):
+        self.field_of_view = field_of_view
+        self.poses = poses or PoseRingBuffer()
+        self.lock = Lock()  # recenter comes in on the receive path, predictions happen on the stream task
+        self.reference: Optional[Tuple[float, float]] = None
+
+    def recenter(self):
+        with self.lock:
+            self.reference = None
+
+    def _reference(self) -> Optional[Tuple[float, float]]:
+        with self.lock:
+            if self.reference is None:
+                latest = self.poses.latest()
+                if latest is not None:
+                    self.reference = (latest[ALPHA], latest[BETA])
+            return self.reference
+
+    def predict(self, ahead: float, now: Optional[float] = None) -> Tuple[float, float]:
+        '''
+        Predicted view centre `ahead` seconds from now, as (x, y) fractions of the frame.
+        The middle of the frame until the first orientation sample.
+        '''
+        now = now or time.time()
+        reference = self._reference()
+        pose = self.poses.pose_at(now + ahead)
+        if reference is None or pose is None:
+            return 0.5, 0.5
+        yaw = angle_difference(pose[0], reference[0])
+        pitch = pose[1] - reference[1]
+
+        # Turning left raises alpha and moves the view left, tilting up raises beta
+        x = 0.5 - yaw / self.field_of_view[0]
+        y = 0.5 - pitch / self.field_of_view[1]
+        return min(max(x, 0.0), 1.0), min(max(y, 0.0), 1.0)
+
+    def orientation_at(self, centre: Tuple[float, float]) -> Optional[Tuple[float, float]]:
+        '''
+        The inverse of predict(): the (alpha, beta) the browser reports when looking at
+        centre, or None before the first sample.
+        '''
+        reference = self._reference()
+        if reference is None:
+            return None
+        alpha = (reference[0] + (0.5 - centre[0]) * self.field_of_view[0]) % 360.0
+        beta = reference[1] + (0.5 - centre[1]) * self.field_of_view[1]
+        return alpha, beta
+
+
+def fovea_rect(width: int, height: int, centre: Tuple[float, float],
+               size: float = FOVEA_SIZE) -> Tuple[int, int, int, int]:
+    '''
+    (x, y, w, h) of the fovea (or any region `size` times the frame) around centre,
+    kept inside the frame and on even pixels.
+    '''
+    w = int(width * size) // 2 * 2
+    h = int(height * size) // 2 * 2
+    x = int(min(max(centre[0] * width - w / 2, 0), width - w)) // 2 * 2
+    y = int(min(max(centre[1] * height - h / 2, 0), height - h)) // 2 * 2
+    return x, y, w, h
+
+
+def foveated_qualities(quality: int) -> Tuple[int, int]:
+    '''(fovea, periphery) JPEG quality for the stream's current quality'''
+    return min(quality + 30, 90), max(quality // 2, 10)
+
+
+def encode_periphery(frame: np.ndarray, quality: int) -> Optional[bytes]:
+    size = (max(int(frame.shape[1] * PERIPHERY_SCALE), 1), max(int(frame.shape[0] * PERIPHERY_SCALE), 1))
+    with metrics.time("convert"):
+        small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    with metrics.time("encode"):
+        ret, buffer = cv2.imencode('.jpg', small, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    return buffer.tobytes() if ret else None
+
+
+def encode_foveated(frame: np.ndarray, centre: Tuple[float, float], quality: int,
+                    periphery: Optional[bytes] = None) -> Optional[bytes]:
+    '''
+    Builds the foveated message for a frame. periphery can be passed in when it was
+    already encoded (it doesn't depend on the viewer), otherwise it is encoded here.
+    '''
+    height, width = frame.shape[:2]
+    fovea_quality, periphery_quality = foveated_qualities(quality)
+    if periphery is None:
+        periphery = encode_periphery(frame, periphery_quality)
+
+    x, y, w, h = fovea_rect(width, height, centre)
+    with metrics.time("encode"):
+        ret, fovea = cv2.imencode('.jpg', frame[y:y + h, x:x + w], [int(cv2.IMWRITE_JPEG_QUALITY), fovea_quality])
+    if not ret or periphery is None:
+        logger.warning("Foveated encoding failed")
+        return None
+
+    header = struct.pack(HEADER_FORMAT, FOVEATED_MESSAGE_VERSION, width, height, x, y, w, h,
+                         len(periphery), len(fovea))
+    return b"".join((header, periphery, fovea.tobytes()))
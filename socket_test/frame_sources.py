@@ -0,0 +1,327 @@
+import json
+import logging
+import platform
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Every source hands out frames in this format, the encoders expect it
+PIXEL_FORMAT = 'bgr24'
+
+# Layout of the shared memory ring written next to Ursina (see Ursina/test2.FrameReader):
+# 64 bytes of metadata (frame index, timestamp, width, height, channels), then buffer_size frame slots
+SHM_METADATA_FORMAT = 'Q d I I I 36x'
+
+FrameRead = Tuple[bool, Optional[np.ndarray], float]
+
+
+class FrameSource:
+    '''
+    Something that produces frames for the broker: a camera, the screen, another process...
+    start() opens it, read() blocks until the next frame and returns (ok, frame, timestamp),
+    stop() releases it. read() is only ever called from one thread at a time.
+    Frames are always BGR (PIXEL_FORMAT), sources convert if they need to.
+    '''
+
+    pixel_format = PIXEL_FORMAT
+
+    def __init__(self, width: int = 1280, height: int = 720, fps: int = 30):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.latest: Optional[Tuple[np.ndarray, float]] = None
+
+    def start(self) -> bool:
+        raise NotImplementedError
+
+    def _read(self) -> Optional[np.ndarray]:
+        raise NotImplementedError
+
+    def read(self) -> FrameRead:
+        frame = self._read()
+        if frame is None:
+            return False, None, 0.0
+        timestamp = time.time()
+        self.latest = (frame, timestamp)
+        return True, frame, timestamp
+
+    def latest_frame(self) -> Optional[Tuple[np.ndarray, float]]:
+        '''
+        The last frame read() returned and when, without waiting for a new one.
+        '''
+        return self.latest
+
+    def stop(self):
+        self.latest = None
+
+
+class PacedSource(FrameSource):
+    '''
+    Base for sources that could produce frames as fast as they are asked, so read()
+    sleeps to keep them at fps like a real camera would.
+    '''
+
+    def __init__(self, width: int = 1280, height: int = 720, fps: int = 30):
+        super().__init__(width, height, fps)
+        self.next_frame_time = 0.0
+
+    def _wait_for_next_frame(self):
+        delay = self.next_frame_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        # Don't try to catch up after a stall, just continue from now
+        self.next_frame_time = max(self.next_frame_time + 1.0 / self.fps, time.perf_counter())
+
+
+class CameraSource(FrameSource):
+    '''
+    A local camera through OpenCV, V4L2 on Linux and DirectShow on Windows.
+    '''
+
+    def __init__(self, width: int = 1280, height: int = 720, fps: int = 30, device: int = 0):
+        super().__init__(width, height, fps)
+        self.device = device
+        self.cap: Optional[cv2.VideoCapture] = None
+
+    def start(self) -> bool:
+        '''
+        Opens the camera and sets up the video capture properties.
+        Tries to open the camera using different backends based on the platform.
+        '''
+        backends = [
+            cv2.CAP_DSHOW if platform.system() == "Windows" else cv2.CAP_V4L2,
+            cv2.CAP_ANY
+        ]
+
+        for backend in backends:
+            self.cap = cv2.VideoCapture(self.device, backend)
+            if self.cap.isOpened():
+                break
+
+        if not self.cap or not self.cap.isOpened():
+            logger.error("Failed to open camera")
+            self.stop()
+            return False
+
+        self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        self.cap.set(cv2.CAP_PROP_FPS, self.fps)
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return True
+
+    def _read(self):
+        if not self.cap:
+            return None
+        ret, frame = self.cap.read()
+        return frame if ret else None
+
+    def stop(self):
+        super().stop()
+        if self.cap:
+            self.cap.release()
+            self.cap = None
+
+
+class ScreenSource(PacedSource):
+    '''
+    Grabs a monitor with MSS, the same way Ursina/MssWindowcap does.
+    Frames come at the monitor's resolution, width and height are ignored.
+    '''
+
+    def __init__(self, width: int = 1280, height: int = 720, fps: int = 30, monitor: int = 1):
+        super().__init__(width, height, fps)
+        self.monitor_index = monitor
+        self.sct = None
+        self.sct_thread: Optional[int] = None
+        self.monitor = None
+
+    def start(self) -> bool:
+        try:
+            import mss  # noqa: F401, only needed for this source
+        except ImportError:
+            logger.error("Screen capture needs the mss package")
+            return False
+        self.next_frame_time = time.perf_counter()
+        return True
+
+    def _read(self):
+        # MSS handles are per thread, and the broker reads from its own capture thread
+        if self.sct is None or self.sct_thread != threading.get_ident():
+            import mss
+            if self.sct:
+                self.sct.close()
+            self.sct = mss.mss()
+            self.sct_thread = threading.get_ident()
+            monitors = self.sct.monitors
+            if self.monitor_index >= len(monitors):
+                logger.warning(f"Monitor {self.monitor_index} not found, using the primary one")
+            self.monitor = monitors[self.monitor_index] if self.monitor_index < len(monitors) else monitors[1]
+
+        self._wait_for_next_frame()
+        grab = self.sct.grab(self.monitor)
+        return cv2.cvtColor(np.asarray(grab), cv2.COLOR_BGRA2BGR)
+
+    def stop(self):
+        super().stop()
+        # Can't close it from another thread, dropping the reference is all we can do
+        self.sct = None
+        self.sct_thread = None
+
+
+class SharedMemorySource(FrameSource):
+    '''
+    Reads the shared memory frame ring another process writes, like the one Ursina/test2.FrameReader
+    consumes. The ring is described by buffer_info.json (shm_name, width, height, channels,
+    buffer_size, metadata_size, frame_size). read() waits for the writer's next frame index.
+    '''
+
+    def __init__(self, width: int = 1280, height: int = 720, fps: int = 30,
+                 buffer_info_file: str = "buffer_info.json", poll_interval: float = 0.001, timeout: float = 2.0):
+        super().__init__(width, height, fps)
+        self.buffer_info_file = buffer_info_file
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.info = None
+        self.shm: Optional[shared_memory.SharedMemory] = None
+        self.last_index = 0
+
+    def start(self) -> bool:
+        try:
+            with open(self.buffer_info_file) as f:
+                self.info = json.load(f)
+            self.shm = shared_memory.SharedMemory(name=self.info['shm_name'], create=False)
+        except Exception as e:
+            logger.error(f"Failed to attach to the shared frame buffer: {e}")
+            return False
+        self.last_index = 0
+        return True
+
+    def _read(self):
+        deadline = time.perf_counter() + self.timeout
+        while self.shm:
+            # The writer's timestamp may be on another clock, read() stamps frames itself
+            frame_index, _, width, height, channels = struct.unpack_from(SHM_METADATA_FORMAT, self.shm.buf)
+            if frame_index and frame_index != self.last_index:
+                break
+            if time.perf_counter() > deadline:
+                logger.error("Shared frame buffer writer stopped producing frames")
+                return None
+            time.sleep(self.poll_interval)
+        else:
+            return None
+
+        slot = (frame_index - 1) % self.info['buffer_size']
+        offset = self.info['metadata_size'] + slot * self.info['frame_size']
+        frame = np.frombuffer(self.shm.buf, np.uint8, height * width * channels, offset)
+        self.last_index = frame_index
+
+        # Copy (or convert, which copies) so the writer can reuse the slot
+        frame = frame.reshape(height, width, channels)
+        if channels == 4:
+            return cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+        return frame.copy()
+
+    def stop(self):
+        super().stop()
+        if self.shm:
+            self.shm.close()
+            self.shm = None
+
+
+class VideoFileSource(PacedSource):
+    '''
+    Plays a video file at its own frame rate (or fps if the file doesn't say), looping at the end.
+    '''
+
+    def __init__(self, width: int = 1280, height: int = 720, fps: int = 30, path: str = "", loop: bool = True):
+        super().__init__(width, height, fps)
+        self.path = path
+        self.loop = loop
+        self.cap: Optional[cv2.VideoCapture] = None
+
+    def start(self) -> bool:
+        self.cap = cv2.VideoCapture(self.path)
+        if not self.cap.isOpened():
+            logger.error(f"Failed to open video file {self.path}")
+            self.stop()
+            return False
+        file_fps = self.cap.get(cv2.CAP_PROP_FPS)
+        if file_fps and file_fps > 0:
+            self.fps = file_fps
+        self.next_frame_time = time.perf_counter()
+        return True
+
+    def _read(self):
+        if not self.cap:
+            return None
+        self._wait_for_next_frame()
+        ret, frame = self.cap.read()
+        if not ret and self.loop:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.cap.read()
+        return frame if ret else None
+
+    def stop(self):
+        super().stop()
+        if self.cap:
+            self.cap.release()
+            self.cap = None
+
+
+class SyntheticSource(PacedSource):
+    '''
+    Generates frames, for load tests and machines without a camera. Frames are a moving
+    gradient with a frame counter so JPEG sizes and tile deltas stay realistic.
+    '''
+
+    def __init__(self, width: int = 1280, height: int = 720, fps: int = 30):
+        super().__init__(width, height, fps)
+        self.gradient: Optional[np.ndarray] = None
+        self.count = 0
+
+    def start(self) -> bool:
+        x = np.linspace(0, 255, self.width, dtype=np.float32)
+        y = np.linspace(0, 255, self.height, dtype=np.float32)
+        self.gradient = ((x[None, :] + y[:, None]) / 2).astype(np.uint8)
+        self.next_frame_time = time.perf_counter()
+        return True
+
+    def _read(self):
+        if self.gradient is None:
+            return None
+        self._wait_for_next_frame()
+        self.count += 1
+        channel = np.roll(self.gradient, (self.count * 4) % self.width, axis=1)
+        frame = cv2.merge([channel, np.roll(channel, self.height // 3, axis=0), 255 - channel])
+        cv2.putText(frame, f"{self.count}", (40, 80), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+        return frame
+
+    def stop(self):
+        super().stop()
+        self.gradient = None
+
+
+SOURCE_TYPES = {
+    'camera': CameraSource,
+    'screen': ScreenSource,
+    'shm': SharedMemorySource,
+    'file': VideoFileSource,
+    'synthetic': SyntheticSource,
+}
+
+
+def create_frame_source(kind: str, width: int = 1280, height: int = 720, fps: int = 30, **options) -> FrameSource:
+    '''
+    Builds a source by type name, options are passed to its constructor (device, monitor, path...).
+    '''
+    if kind not in SOURCE_TYPES:
+        raise ValueError(f"Unknown frame source type: {kind}")
+    return SOURCE_TYPES[kind](width, height, fps, **options)
@@ -0,0 +1,334 @@
+import asyncio
+import logging
+from collections import deque
+from typing import List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+START_CODE = b"\x00\x00\x01"
+START_CODE_4 = b"\x00" + START_CODE
+NAL_TYPE_IDR = 5
+NAL_TYPE_AUD = 9
+VCL_NAL_TYPES = range(1, 6)
+# After the last slice of a picture, any of these starts the next access unit (H.264 7.4.1.2.3)
+AU_START_NAL_TYPES = {6, 7, 8, 9, 14, 15, 16, 17, 18}
+# Pictures in a row with the same slice count before the splitter trusts it
+CALIBRATION_PICTURES = 3
+
+
+def split_nal_units(buffer: bytes):
+    '''
+    Splits an Annex B byte stream into NAL units (without start codes).
+    Returns (nal_units, remainder) where remainder is the trailing bytes that may
+    still be part of an unfinished NAL unit.
+    '''
+    nal_units = []
+    start = buffer.find(START_CODE)
+    if start < 0:
+        return nal_units, buffer
+
+    start += len(START_CODE)
+    while True:
+        next_start = buffer.find(START_CODE, start)
+        if next_start < 0:
+            break
+        end = next_start
+        # 4 byte start codes have an extra leading zero, it belongs to the next start code
+        if end > start and buffer[end - 1] == 0:
+            end -= 1
+        nal_units.append(buffer[start:end])
+        start = next_start + len(START_CODE)
+
+    return nal_units, buffer[start - len(START_CODE):]
+
+
+class AccessUnit:
+    '''
+    One encoded picture, i.e. every NAL unit between two access unit delimiters.
+    data is an Annex B byte stream which WebCodecs can decode directly.
+    tag is whatever was passed to H264EncoderSession.encode with the frame it came from.
+    '''
+    __slots__ = ("data", "keyframe", "tag")
+
+    def __init__(self, nal_units: List[bytes]):
+        self.data = b"".join(START_CODE_4 + nal for nal in nal_units)
+        self.keyframe = any(nal and (nal[0] & 0x1F) == NAL_TYPE_IDR for nal in nal_units)
+        self.tag = None
+
+
+class AccessUnitSplitter:
+    '''
+    Groups NAL units into access units. A unit ends where the next one starts: at an
+    access unit delimiter, SEI/SPS/PPS after a slice, or a slice with first_mb_in_slice
+    of 0 (the first slice of the next picture).
+    Waiting for the next picture costs a whole frame interval though, so once the last
+    CALIBRATION_PICTURES pictures all had the same number of slices, a picture is
+    finished as soon as that many slices are in.
+    '''
+
+    def __init__(self):
+        self.current: List[bytes] = []
+        self.slices = 0
+        self.slices_per_picture: Optional[int] = None
+        self.last_count = 0
+        self.same_count = 0
+        self.ended_early = False
+
+    def feed(self, nal: bytes) -> List[AccessUnit]:
+        '''
+        Takes the next NAL unit, returns the access units it finished.
+        '''
+        units = []
+        if not nal:
+            return units
+        nal_type = nal[0] & 0x1F
+        is_slice = nal_type in VCL_NAL_TYPES
+        if self.slices and (nal_type in AU_START_NAL_TYPES or (is_slice and self._first_slice(nal))):
+            units.append(self._finish(early=False))
+        if is_slice and not self.slices and self.ended_early and not self._first_slice(nal):
+            # The picture had more slices than learned and already went out without this one
+            logger.warning(f"H264 picture had more than {self.slices_per_picture} slices, dropping a slice")
+            self.slices_per_picture = None
+            self.same_count = 0
+            return units
+        if nal_type != NAL_TYPE_AUD:
+            self.current.append(nal)
+        if is_slice:
+            self.slices += 1
+            self.ended_early = False
+            if self.slices == self.slices_per_picture:
+                units.append(self._finish(early=True))
+        return units
+
+    def flush(self) -> Optional[AccessUnit]:
+        unit = AccessUnit(self.current) if self.current else None
+        self.current = []
+        self.slices = 0
+        return unit
+
+    def _finish(self, early: bool) -> AccessUnit:
+        if not early:
+            # Only pictures ended by the next one tell how many slices a picture really has
+            if self.slices != self.slices_per_picture:
+                self.slices_per_picture = None
+            self.same_count = self.same_count + 1 if self.slices == self.last_count else 1
+            self.last_count = self.slices
+            if self.same_count >= CALIBRATION_PICTURES:
+                self.slices_per_picture = self.slices
+        self.ended_early = early
+        return self.flush()
+
+    @staticmethod
+    def _first_slice(nal: bytes) -> bool:
+        # first_mb_in_slice is the first ue(v) of the slice header, a leading 1 bit means 0
+        return len(nal) > 1 and bool(nal[1] & 0x80)
+
+
+class H264EncoderSession:
+    '''
+    Long lived ffmpeg process that encodes raw BGR frames into H.264.
+    Frames are written to ffmpeg's stdin, and a reader task splits stdout into
+    access units. If ffmpeg dies it gets restarted on the next frame, starting
+    again with a keyframe.
+    '''
+
+    def __init__(self, width: int, height: int, fps: int = 30, gop: int = 60,
+                 use_gpu: bool = False):
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.gop = gop
+        self.use_gpu = use_gpu
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.reader_task: Optional[asyncio.Task] = None
+        self.stderr_task: Optional[asyncio.Task] = None
+        self.access_units: asyncio.Queue = asyncio.Queue()
+        self.tags = deque()  # one per frame written, handed to the access unit it turns into
+        self.restarts = 0
+        self.failed = False  # the pipe broke, the next frame restarts ffmpeg
+        self.frames_in = 0
+        self.units_out = 0
+
+    def build_command(self):
+        '''
+        Builds the ffmpeg command line. Everything is tuned for latency: no B-frames,
+        no lookahead, and packets are flushed right after every frame.
+        '''
+        command = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-fflags", "nobuffer", "-flags", "low_delay",
+            "-f", "rawvideo", "-pix_fmt", "bgr24",
+            "-s", f"{self.width}x{self.height}", "-r", str(self.fps), "-i", "-",
+        ]
+        if self.use_gpu:
+            command += ["-c:v", "h264_nvenc", "-preset", "p1", "-tune", "ll",
+                        "-zerolatency", "1", "-delay", "0", "-rc-lookahead", "0"]
+        else:
+            command += ["-c:v", "libx264", "-preset", "ultrafast", "-tune", "zerolatency"]
+        command += [
+            "-pix_fmt", "yuv420p", "-profile:v", "baseline",
+            "-g", str(self.gop), "-bf", "0",
+            # Access unit delimiters let the reader know where a picture ends
+            "-bsf:v", "h264_metadata=aud=insert",
+            "-flush_packets", "1",
+            "-f", "h264", "-",
+        ]
+        return command
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        '''
+        Spawns ffmpeg and the stdout reader task.
+        '''
+        await self.stop()
+        self.failed = False
+        self.frames_in = 0
+        self.units_out = 0
+        self.tags.clear()
+        self.process = await asyncio.create_subprocess_exec(
+            *self.build_command(),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        self.reader_task = asyncio.create_task(self._read_access_units(self.process))
+        self.stderr_task = asyncio.create_task(self._log_stderr(self.process))
+        logger.info(f"H264 encoder started ({self.width}x{self.height}@{self.fps}, gop {self.gop})")
+
+    async def restart(self):
+        self.restarts += 1
+        logger.warning(f"Restarting H264 encoder (restart #{self.restarts})")
+        await self.start()
+
+    async def encode(self, frame: np.ndarray, tag=None):
+        '''
+        Feeds one raw frame to the encoder. Returns False if the frame could not be
+        written, which also schedules a restart for the next frame.
+        tag comes back on the access unit of this frame. There are no B-frames, so
+        pictures come out in the order the frames went in.
+        '''
+        if frame.shape[1] != self.width or frame.shape[0] != self.height:
+            logger.warning("Frame size does not match encoder size, skipping frame")
+            return False
+
+        if not self.alive:
+            # Anything but the very first start is a restart, whether ffmpeg exited or the pipe broke
+            await (self.restart() if self.failed or self.process else self.start())
+
+        try:
+            self.process.stdin.write(memoryview(np.ascontiguousarray(frame)).cast("B"))
+            await self.process.stdin.drain()
+            self.frames_in += 1
+            self.tags.append(tag)
+            return True
+        except (BrokenPipeError, ConnectionResetError) as e:
+            logger.error(f"H264 encoder pipe broken: {e}")
+            await self.stop()
+            self.failed = True
+            return False
+
+    async def read_access_unit(self, timeout: Optional[float] = None) -> Optional[AccessUnit]:
+        '''
+        Waits for the next encoded picture. Returns None on timeout.
+        '''
+        try:
+            return await asyncio.wait_for(self.access_units.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def drain(self) -> List[AccessUnit]:
+        '''
+        Returns every access unit that is already available without waiting.
+        '''
+        units = []
+        while not self.access_units.empty():
+            units.append(self.access_units.get_nowait())
+        return units
+
+    async def _read_access_units(self, process):
+        '''
+        Reads ffmpeg's stdout and groups NAL units into access units.
+        Annex B has no lengths, so a picture is complete once the start of the next one
+        (its delimiter) comes out, or once it has as many slices as the splitter learned
+        pictures have. Guessing from pauses in the output split pictures whenever ffmpeg
+        paused mid picture.
+        '''
+        buffer = b""
+        splitter = AccessUnitSplitter()
+        try:
+            while True:
+                chunk = await process.stdout.read(65536)
+                if not chunk:
+                    break
+                buffer += chunk
+                nal_units, buffer = split_nal_units(buffer)
+                for nal in nal_units:
+                    for unit in splitter.feed(nal):
+                        self._publish(unit)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"H264 reader error: {e}")
+
+        # Output closed, whatever is left is the last picture
+        nal_units, _ = split_nal_units(buffer + START_CODE)
+        for nal in nal_units:
+            for unit in splitter.feed(nal):
+                self._publish(unit)
+        unit = splitter.flush()
+        if unit:
+            self._publish(unit)
+        logger.info("H264 encoder output closed")
+
+    def _publish(self, unit: AccessUnit):
+        # Never drop encoded pictures here, later P-frames reference them.
+        # Callers should skip raw frames instead when pending gets too high.
+        self.units_out += 1
+        unit.tag = self.tags.popleft() if self.tags else None
+        self.access_units.put_nowait(unit)
+
+    @property
+    def in_flight(self):
+        '''
+        Frames written to ffmpeg that haven't come out as access units yet.
+        '''
+        return max(self.frames_in - self.units_out, 0)
+
+    async def _log_stderr(self, process):
+        while True:
+            line = await process.stderr.readline()
+            if not line:
+                break
+            logger.error(f"ffmpeg: {line.decode(errors='replace').rstrip()}")
+
+    async def stop(self):
+        '''
+        Stops ffmpeg and the reader tasks. Pending access units are discarded since
+        they reference pictures the next process won't know about.
+        '''
+        process, self.process = self.process, None
+        if process is not None:
+            if process.stdin and not process.stdin.is_closing():
+                process.stdin.close()
+            if process.returncode is None:
+                try:
+                    await asyncio.wait_for(process.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+
+        for task in (self.reader_task, self.stderr_task):
+            if task and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.reader_task = None
+        self.stderr_task = None
+        self.drain()
@@ -0,0 +1,95 @@
+import asyncio
+from threading import Lock
+from typing import Any, Optional
+
+
+class LatestValueMailbox:
+    '''
+    Single slot mailbox between a producer thread and an asyncio consumer.
+    put() overwrites whatever hasn't been picked up yet, so the consumer always gets
+    the newest value, and wakes the consumer through call_soon_threadsafe instead of
+    the consumer polling. Must be created on the event loop that will call get().
+    '''
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.lock = Lock()
+        self.value: Any = None
+        self.has_value = False
+        self.closed = False
+        self.wakeup_pending = False
+        self.event = asyncio.Event()
+        self.delivered = 0
+        self.overwritten = 0
+
+    def put(self, value):
+        '''
+        Stores a value from any thread. Returns False if the mailbox is closed.
+        '''
+        with self.lock:
+            if self.closed:
+                return False
+            if self.has_value:
+                self.overwritten += 1
+            self.value = value
+            self.has_value = True
+            # One wakeup is enough no matter how many puts happen before get() runs
+            if self.wakeup_pending:
+                return True
+            self.wakeup_pending = True
+
+        try:
+            self.loop.call_soon_threadsafe(self._wakeup)
+        except RuntimeError:
+            # Event loop is already closed, nobody is waiting anymore
+            return False
+        return True
+
+    def _wakeup(self):
+        with self.lock:
+            self.wakeup_pending = False
+        self.event.set()
+
+    def take(self) -> Optional[Any]:
+        '''
+        Returns the pending value without waiting, or None if there isn't one.
+        '''
+        with self.lock:
+            if not self.has_value:
+                return None
+            value, self.value = self.value, None
+            self.has_value = False
+            self.delivered += 1
+            return value
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[Any]:
+        '''
+        Waits for the next value. Returns None if the mailbox was closed or the timeout
+        ran out, so callers can re-check whether they should keep going.
+        '''
+        while not self.closed:
+            value = self.take()
+            if value is not None:
+                return value
+            self.event.clear()
+            # A put() may have landed between take() and clear(), check again before sleeping
+            if self.has_value:
+                continue
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return None
+
+    def close(self):
+        '''
+        Drops the pending value and wakes up any waiting get().
+        '''
+        with self.lock:
+            self.closed = True
+            self.value = None
+            self.has_value = False
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:
+            pass
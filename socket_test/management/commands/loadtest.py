@@ -0,0 +1,455 @@
+import asyncio
+import base64
+import json
+import os
+import struct
+import time
+from typing import Optional
+
+import cv2
+import numpy as np
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from Crypto.Cipher import AES, PKCS1_v1_5
+from Crypto.PublicKey import RSA
+from django.core.management.base import BaseCommand, CommandError
+
+from socket_com.clock_sync import SYNC_BURST, SYNC_INTERVAL, ClockSync
+from socket_com.metrics import LatencyHistogram, metrics
+from socket_com.striped_jpeg import unpack_stripes
+from socket_test import consumers
+from socket_test.camera_broker import get_camera_broker
+from socket_test.fanout import FrameProducer
+from socket_test.crypto import RESUME_RANDOM_SIZE, derive_resumed_key, resume_proof
+from socket_test.frame_sources import SyntheticSource
+from socket_test import foveation, pose
+from socket_test.tile_delta import HEADER_FORMAT, RECT_FORMAT
+from socket_test.viewport import POSE_SIZE
+
+HEADER_SIZE = struct.calcsize("dII")
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+
+class HeadlessViewer:
+    '''
+    Python version of script.js: does the same RSA/AES key exchange, then decrypts,
+    acks and decodes every frame like the browser would, and keeps its own numbers.
+    '''
+
+    def __init__(self, index: int, codec: str, decode: bool, mode: str = 'mono', fanout: bool = False):
+        self.index = index
+        self.codec = codec
+        self.mode = mode
+        self.fanout = fanout
+        self.decode = decode
+        self.aes_key = os.urandom(32)
+        self.communicator: Optional[WebsocketCommunicator] = None
+        self.canvas: Optional[np.ndarray] = None
+
+        self.measuring = False
+        self.frames = 0
+        self.bytes = 0
+        self.errors = 0
+        self.sequence_gaps = 0
+        self.last_sequence: Optional[int] = None
+        self.latency = LatencyHistogram()
+        self.ticket: Optional[str] = None  # from the last stream_ready, for session resumption
+        self.connect_time: Optional[float] = None  # websocket open -> stream_ready, seconds
+        self.clock = ClockSync()  # frame timestamps are on the server's clock, same as for the browser
+        self.cpu_time = 0.0  # client side decrypt + decode, so it can be taken out of the server's share
+        self.server_stats = None
+
+    async def _receive(self, timeout):
+        message = await self.communicator.receive_output(timeout)
+        if message['type'] == 'websocket.close':
+            raise ConnectionError(f"Viewer {self.index}: server closed the connection")
+        return message.get('text'), message.get('bytes')
+
+    async def _send_encrypted_bytes(self, data: bytes):
+        nonce = os.urandom(NONCE_SIZE)
+        cipher = AES.new(self.aes_key, AES.MODE_GCM, nonce=nonce)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        await self.communicator.send_to(bytes_data=nonce + ciphertext + tag)
+
+    async def _send_encrypted(self, message):
+        await self._send_encrypted_bytes(json.dumps(message).encode())
+
+    async def connect(self, app):
+        '''
+        Opens the stream, resuming the last session when there is a ticket like the browser does.
+        '''
+        start = time.perf_counter()
+        self.last_sequence = None
+        self.communicator = WebsocketCommunicator(app, "/ws/stream/")
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise ConnectionError(f"Viewer {self.index}: connection refused")
+
+        text, _ = await self._receive(timeout=5)
+        message = json.loads(text)
+        if message.get('type') != 'rsa_public_key':
+            raise ConnectionError(f"Viewer {self.index}: expected the public key, got {message}")
+        public_key_b64 = message['key']
+
+        client_random = None
+        if self.ticket:
+            client_random = os.urandom(RESUME_RANDOM_SIZE)
+            await self.communicator.send_to(text_data=json.dumps({
+                'type': 'session_resume',
+                'ticket': self.ticket,
+                'client_random': base64.b64encode(client_random).decode(),
+                'proof': base64.b64encode(resume_proof(self.aes_key, client_random)).decode(),
+                **self._stream_options(),
+            }))
+        else:
+            await self._send_key_exchange(public_key_b64)
+
+        while True:
+            text, _ = await self._receive(timeout=10)
+            if not text:
+                continue
+            message = json.loads(text)
+            if message.get('type') == 'resume_failed':
+                client_random = None
+                await self._send_key_exchange(public_key_b64)
+            elif message.get('type') == 'stream_ready':
+                if client_random and message.get('server_random'):
+                    self.aes_key = derive_resumed_key(self.aes_key, client_random,
+                                                      base64.b64decode(message['server_random']))
+                self.ticket = message.get('ticket')
+                self.codec = message.get('codec', self.codec)
+                self.connect_time = time.perf_counter() - start
+                return
+            elif message.get('type') == 'error':
+                raise ConnectionError(f"Viewer {self.index}: {message.get('message')}")
+
+    def _stream_options(self):
+        return {'codec': self.codec, 'source': 'synthetic', 'mode': self.mode, 'fanout': self.fanout}
+
+    async def _send_key_exchange(self, public_key_b64: str):
+        # Same as JSEncrypt in the browser: PKCS#1 v1.5 over the base64 of the raw key
+        self.aes_key = os.urandom(32)
+        public_key = RSA.import_key(base64.b64decode(public_key_b64))
+        encrypted_key = PKCS1_v1_5.new(public_key).encrypt(base64.b64encode(self.aes_key))
+        await self.communicator.send_to(text_data=json.dumps({
+            'type': 'aes_key_exchange',
+            'encrypted_key': base64.b64encode(encrypted_key).decode(),
+            'iv': base64.b64encode(os.urandom(12)).decode(),
+            **self._stream_options(),
+        }))
+
+    async def run(self, stop: asyncio.Event):
+        while not stop.is_set():
+            try:
+                text, data = await self._receive(timeout=1)
+            except asyncio.TimeoutError:
+                continue
+            if data:
+                await self._handle_frame(data)
+            elif text:
+                self._handle_text(text)
+
+    def _handle_text(self, text):
+        message = json.loads(text)
+        if message.get('type') == 'stats':
+            self.server_stats = message['stats']
+        elif message.get('type') == 'clock_sync':
+            self.clock.on_response(message['t1'], message['t2'], message['t3'])
+        elif message.get('type') == 'error':
+            self.errors += 1
+
+    async def _handle_frame(self, data: bytes):
+        timestamp, sequence, size = struct.unpack_from("dII", data)
+        if len(data) != HEADER_SIZE + size:
+            self.errors += 1
+            return
+
+        cpu_start = time.thread_time()
+        try:
+            nonce = data[HEADER_SIZE:HEADER_SIZE + NONCE_SIZE]
+            cipher = AES.new(self.aes_key, AES.MODE_GCM, nonce=nonce)
+            payload = cipher.decrypt_and_verify(data[HEADER_SIZE + NONCE_SIZE:-TAG_SIZE], data[-TAG_SIZE:])
+        except ValueError:
+            self.errors += 1
+            return
+        finally:
+            self.cpu_time += time.thread_time() - cpu_start
+
+        # The browser acks right after decrypting, before decoding
+        ack = {'type': 'ack', 'sequence': sequence}
+        if self.clock.synced:
+            ack['network_ms'] = (time.time() - self.clock.to_local(timestamp)) * 1000
+        await self._send_encrypted(ack)
+
+        if self.mode == 'viewport':
+            payload = payload[POSE_SIZE:]
+
+        if self.decode:
+            # Decoding runs off the event loop, the server shares this loop
+            ok, cpu = await asyncio.to_thread(self._decode, payload)
+            self.cpu_time += cpu
+            if not ok:
+                self.errors += 1
+                return
+
+        if self.last_sequence is not None and sequence > self.last_sequence + 1:
+            self.sequence_gaps += sequence - self.last_sequence - 1
+        self.last_sequence = sequence
+
+        if self.measuring:
+            self.frames += 1
+            self.bytes += len(data)
+            self.latency.record(time.time() - self.clock.to_local(timestamp))
+
+    def _decode(self, payload: bytes):
+        cpu_start = time.thread_time()
+        if self.codec == 'tiles':
+            ok = self._decode_tiles(payload)
+        elif self.codec == 'foveated':
+            ok = self._decode_foveated(payload)
+        elif self.codec == 'stripes':
+            ok = self._decode_stripes(payload)
+        elif self.codec == 'h264':
+            # No H264 decoder on the Python side, only the decrypt counts for this codec
+            ok = True
+        else:
+            ok = cv2.imdecode(np.frombuffer(payload, np.uint8), cv2.IMREAD_COLOR) is not None
+        return ok, time.thread_time() - cpu_start
+
+    def _decode_tiles(self, payload: bytes):
+        _, _, width, height, count = struct.unpack_from(HEADER_FORMAT, payload)
+        if self.canvas is None or self.canvas.shape[:2] != (height, width):
+            self.canvas = np.zeros((height, width, 3), np.uint8)
+        offset = struct.calcsize(HEADER_FORMAT)
+        for _ in range(count):
+            x, y, w, h, size = struct.unpack_from(RECT_FORMAT, payload, offset)
+            offset += struct.calcsize(RECT_FORMAT)
+            tile = cv2.imdecode(np.frombuffer(payload, np.uint8, size, offset), cv2.IMREAD_COLOR)
+            offset += size
+            if tile is None:
+                return False
+            self.canvas[y:y + h, x:x + w] = tile
+        return True
+
+    def _decode_stripes(self, payload: bytes):
+        width, height, stripes = unpack_stripes(payload)
+        if self.canvas is None or self.canvas.shape[:2] != (height, width):
+            self.canvas = np.zeros((height, width, 3), np.uint8)
+        for y, h, jpeg in stripes:
+            stripe = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+            if stripe is None:
+                return False
+            self.canvas[y:y + h] = stripe
+        return True
+
+    def _decode_foveated(self, payload: bytes):
+        _, width, height, x, y, w, h, periphery_size, fovea_size = struct.unpack_from(foveation.HEADER_FORMAT, payload)
+        offset = struct.calcsize(foveation.HEADER_FORMAT)
+        periphery = cv2.imdecode(np.frombuffer(payload, np.uint8, periphery_size, offset), cv2.IMREAD_COLOR)
+        fovea = cv2.imdecode(np.frombuffer(payload, np.uint8, fovea_size, offset + periphery_size), cv2.IMREAD_COLOR)
+        if periphery is None or fovea is None:
+            return False
+        self.canvas = cv2.resize(periphery, (width, height), interpolation=cv2.INTER_LINEAR)
+        self.canvas[y:y + h, x:x + w] = fovea
+        return True
+
+    async def send_sensors(self, stop: asyncio.Event, rate: float):
+        '''
+        Sends sensor batches like script.js does, every 25 ms, with the head sweeping
+        slowly left and right so pose dependent modes have something to follow.
+        '''
+        interval = 0.025
+        per_batch = max(int(rate * interval), 1)
+        while not stop.is_set():
+            base = time.time()
+            rows = []
+            for i in range(per_batch):
+                t = base + i / rate
+                rows.append(struct.pack("<ffff", i / rate, (30 * np.sin(t)) % 360, 90.0, 0.0))
+            flags, base_time = 0, base
+            if self.clock.synced:
+                flags, base_time = pose.FLAG_SERVER_TIME, self.clock.to_remote(base)
+            await self._send_encrypted_bytes(struct.pack(pose.BATCH_HEADER_FORMAT, pose.SENSOR_BATCH, flags, per_batch,
+                                                         base_time) + b"".join(rows))
+            await asyncio.sleep(interval)
+
+    async def sync_clock(self, stop: asyncio.Event):
+        '''
+        Clock sync exchanges like script.js: a burst to start with, then every SYNC_INTERVAL.
+        '''
+        for _ in range(SYNC_BURST):
+            await self._send_clock_sync()
+            await asyncio.sleep(0.05)
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), SYNC_INTERVAL)
+            except asyncio.TimeoutError:
+                await self._send_clock_sync()
+
+    async def _send_clock_sync(self):
+        request_id, t1 = self.clock.make_request()
+        await self._send_encrypted({'type': 'clock_sync', 'id': request_id, 't1': t1})
+
+    async def request_stats(self):
+        await self._send_encrypted({'type': 'stats'})
+
+    async def close(self):
+        if self.communicator:
+            await self.communicator.disconnect()
+
+
+class Command(BaseCommand):
+    help = ("Load tests StreamingConsumer in process: M headless viewers against a synthetic camera, "
+            "reports FPS, latency percentiles, CPU per stream and dropped frames.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=4, help="Concurrent viewers")
+        parser.add_argument('--duration', type=float, default=20.0, help="Seconds to measure")
+        parser.add_argument('--warmup', type=float, default=3.0, help="Seconds before measuring starts")
+        parser.add_argument('--codec', choices=consumers.CODECS, default='jpeg')
+        parser.add_argument('--mode', choices=consumers.STREAM_MODES, default='mono')
+        parser.add_argument('--width', type=int, default=1280)
+        parser.add_argument('--height', type=int, default=720)
+        parser.add_argument('--fps', type=int, default=30, help="Synthetic camera frame rate")
+        parser.add_argument('--no-decode', action='store_true', help="Only decrypt, skip decoding on the viewers")
+        parser.add_argument('--sensor-hz', type=float, default=0, help="Orientation samples per second each viewer sends")
+        parser.add_argument('--resume', action='store_true',
+                            help="Connect once, then reconnect every viewer with its session ticket before measuring")
+        parser.add_argument('--fanout', action='store_true',
+                            help="Viewers take the frames a producer publishes on the channel layer instead of encoding their own")
+        parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+
+    def handle(self, *args, **options):
+        if options['clients'] < 1:
+            raise CommandError("--clients must be at least 1")
+        if not (os.path.exists("server_public.pem") and os.path.exists("server_private.pem")):
+            raise CommandError("RSA keys not found, run generate_rsa_keys.py first")
+
+        # Creates the shared synthetic broker with our size and rate before any viewer asks for it
+        get_camera_broker('synthetic', lambda: SyntheticSource(options['width'], options['height'], options['fps']))
+        report = asyncio.run(self._run(options))
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self._print_report(report)
+
+    async def _run(self, options):
+        app = consumers.StreamingConsumer.as_asgi()
+        viewers = [HeadlessViewer(i, options['codec'], not options['no_decode'], options['mode'], options['fanout'])
+                   for i in range(options['clients'])]
+        stop = asyncio.Event()
+        tasks = []
+        if options['fanout']:
+            # Same thing `manage.py runproducer` does, on whatever CHANNEL_LAYERS is set to
+            producer = FrameProducer(get_camera_broker('synthetic', None), 'synthetic', get_channel_layer())
+            tasks.append(asyncio.create_task(producer.run(stop)))
+        await asyncio.gather(*(viewer.connect(app) for viewer in viewers))
+        if options['resume']:
+            # Everyone reconnects at once, like headsets coming back after a network blip
+            await asyncio.gather(*(viewer.close() for viewer in viewers))
+            await asyncio.gather(*(viewer.connect(app) for viewer in viewers))
+
+        tasks += [asyncio.create_task(viewer.run(stop)) for viewer in viewers]
+        tasks += [asyncio.create_task(viewer.sync_clock(stop)) for viewer in viewers]
+        if options['sensor_hz'] > 0:
+            tasks += [asyncio.create_task(viewer.send_sensors(stop, options['sensor_hz'])) for viewer in viewers]
+        try:
+            await asyncio.sleep(options['warmup'])
+
+            metrics.reset()
+            for viewer in viewers:
+                viewer.measuring = True
+                viewer.cpu_time = 0.0
+            cpu_start = time.process_time()
+            wall_start = time.perf_counter()
+
+            await asyncio.sleep(options['duration'])
+
+            for viewer in viewers:
+                viewer.measuring = False
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+
+            # Server side drop counters come back on the same socket
+            await asyncio.gather(*(viewer.request_stats() for viewer in viewers))
+            await asyncio.sleep(0.5)
+        finally:
+            stop.set()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.gather(*(viewer.close() for viewer in viewers), return_exceptions=True)
+
+        return self._build_report(options, viewers, wall, cpu)
+
+    def _build_report(self, options, viewers, wall, cpu):
+        latency = LatencyHistogram()
+        for viewer in viewers:
+            latency.merge(viewer.latency)
+        connect = LatencyHistogram()
+        for viewer in viewers:
+            connect.record(viewer.connect_time)
+
+        client_cpu = sum(viewer.cpu_time for viewer in viewers)
+        server_cpu = max(cpu - client_cpu, 0.0)
+        dropped = {}
+        for viewer in viewers:
+            for key in ('skipped_backpressure', 'skipped_rate_limit', 'dropped_in_encode', 'overwritten_before_pickup'):
+                dropped[key] = dropped.get(key, 0) + (viewer.server_stats or {}).get(key, 0)
+
+        return {
+            'clients': len(viewers),
+            'codec': viewers[0].codec,
+            'mode': options['mode'],
+            'fanout': options['fanout'],
+            'resolution': f"{options['width']}x{options['height']}",
+            'source_fps': options['fps'],
+            'duration_s': wall,
+            'fps_per_client': [viewer.frames / wall for viewer in viewers],
+            'fps_total': sum(viewer.frames for viewer in viewers) / wall,
+            'mbps_total': sum(viewer.bytes for viewer in viewers) * 8 / wall / 1e6,
+            'latency': latency.snapshot(),
+            'connect': connect.snapshot(),
+            'resumed': options['resume'],
+            'cpu_percent_total': cpu / wall * 100,
+            'cpu_percent_clients': client_cpu / wall * 100,
+            'cpu_percent_per_stream': server_cpu / wall * 100 / len(viewers),
+            'dropped': dropped,
+            'sequence_gaps': sum(viewer.sequence_gaps for viewer in viewers),
+            'client_errors': sum(viewer.errors for viewer in viewers),
+            'server_stages': metrics.snapshot()['stages'],
+        }
+
+    def _print_report(self, report):
+        write = self.stdout.write
+        write(f"{report['clients']} viewers, {report['codec']} {report['mode']} {report['resolution']} "
+              f"@ {report['source_fps']} fps source{' (fan-out)' if report['fanout'] else ''}, "
+              f"{report['duration_s']:.1f} s")
+        fps = report['fps_per_client']
+        write(f"FPS per viewer: mean {sum(fps) / len(fps):.1f}, min {min(fps):.1f}, max {max(fps):.1f} "
+              f"({report['fps_total']:.1f} total, {report['mbps_total']:.1f} Mbps)")
+
+        latency = report['latency']
+        if latency['count']:
+            write(f"Send -> decoded latency: p50 {latency['p50_ms']:.1f} ms, p95 {latency['p95_ms']:.1f} ms, "
+                  f"p99 {latency['p99_ms']:.1f} ms, max {latency['max_ms']:.1f} ms")
+        else:
+            write("No frames received")
+
+        connect = report['connect']
+        write(f"Connect ({'resumed' if report['resumed'] else 'RSA'}): p50 {connect['p50_ms']:.1f} ms, "
+              f"p95 {connect['p95_ms']:.1f} ms, max {connect['max_ms']:.1f} ms")
+
+        write(f"CPU: {report['cpu_percent_total']:.0f}% total, {report['cpu_percent_clients']:.0f}% in the viewers, "
+              f"{report['cpu_percent_per_stream']:.1f}% server side per stream")
+
+        dropped = report['dropped']
+        write(f"Dropped: {dropped['skipped_backpressure']} backpressure, {dropped['skipped_rate_limit']} rate limit, "
+              f"{dropped['dropped_in_encode']} in encode, {dropped['overwritten_before_pickup']} overwritten before pickup, "
+              f"{report['sequence_gaps']} sequence gaps, {report['client_errors']} client errors")
+
+        write("Server stages:")
+        for stage, snapshot in report['server_stages'].items():
+            if snapshot['count']:
+                write(f"  {stage:<10} p50 {snapshot['p50_ms']:7.2f} ms  p95 {snapshot['p95_ms']:7.2f} ms  "
+                      f"p99 {snapshot['p99_ms']:7.2f} ms  ({snapshot['count']} samples)")
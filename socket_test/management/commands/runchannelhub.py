@@ -0,0 +1,25 @@
+import asyncio
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from socket_test.channel_layers import GROUP_BACKLOG, ChannelHub
+
+
+class Command(BaseCommand):
+    help = ("Runs the Unix socket hub the Daphne workers and `runproducer` talk through "
+            "when CHANNEL_LAYER=unix, see socket_test/channel_layers.py.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=settings.CHANNEL_HUB_SOCKET, help="Unix socket to listen on")
+        parser.add_argument('--group-backlog', type=int, default=GROUP_BACKLOG,
+                            help="Group messages waiting per worker and group before the oldest is dropped")
+
+    def handle(self, *args, **options):
+        logging.basicConfig(level=logging.INFO)
+        hub = ChannelHub(options['path'], group_backlog=options['group_backlog'])
+        try:
+            asyncio.run(hub.serve())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,46 @@
+import asyncio
+import logging
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand, CommandError
+
+from socket_test import consumers
+from socket_test.camera_broker import get_camera_broker
+from socket_test.fanout import FANOUT_RENDITIONS, FrameProducer
+from socket_test.frame_sources import create_frame_source
+
+
+class Command(BaseCommand):
+    help = ("Captures one frame source, encodes it once per rendition and publishes the JPEGs on the "
+            "channel layer for the 'fanout' viewers of every worker. Needs CHANNEL_LAYER=unix and "
+            "`runchannelhub` to reach other processes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--source', choices=list(consumers.FRAME_SOURCES), default=consumers.DEFAULT_FRAME_SOURCE)
+        parser.add_argument('--width', type=int, default=1280)
+        parser.add_argument('--height', type=int, default=720)
+        parser.add_argument('--fps', type=int, default=30)
+        parser.add_argument('--rendition', action='append', metavar='QUALITY:SCALE',
+                            help="JPEG quality and scale to publish, repeatable, best first "
+                                 f"(default {' '.join(f'{q}:{s}' for q, s in FANOUT_RENDITIONS)})")
+
+    def handle(self, *args, **options):
+        logging.basicConfig(level=logging.INFO)
+        renditions = FANOUT_RENDITIONS
+        if options['rendition']:
+            try:
+                renditions = [(int(q), float(s)) for q, s in (r.split(':') for r in options['rendition'])]
+            except ValueError:
+                raise CommandError("--rendition must look like 60:1.0")
+
+        layer = get_channel_layer()
+        if layer is None:
+            raise CommandError("No channel layer configured, see CHANNEL_LAYERS in settings.py")
+        kind, source_options = consumers.FRAME_SOURCES[options['source']]
+        broker = get_camera_broker(options['source'], lambda: create_frame_source(
+            kind, options['width'], options['height'], options['fps'], **source_options))
+
+        try:
+            asyncio.run(FrameProducer(broker, options['source'], layer, renditions).run())
+        except KeyboardInterrupt:
+            pass
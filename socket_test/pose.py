@@ -0,0 +1,163 @@
+import struct
+import time
+from threading import Lock
+from typing import Optional, Tuple
+
+import numpy as np
+
+# Binary sensor batch, sent AES-GCM encrypted like the JSON control messages. The first byte
+# tells them apart, JSON always starts with '{'. Little endian:
+#   [1 byte type = SENSOR_BATCH][1 byte flags][2 bytes sample count][8 bytes base time, seconds]
+#   then per sample: [4 bytes float offset from base, seconds][4 bytes float alpha][beta][gamma]
+#   and with FLAG_ACCELERATION: [4 bytes float x][y][z] acceleration in m/s^2
+# Times are on the client's clock, or already on the server's with FLAG_SERVER_TIME once
+# the client has synced its clock (see socket_com/clock_sync.py).
+SENSOR_BATCH = 0x01
+FLAG_ACCELERATION = 0x01
+FLAG_SERVER_TIME = 0x02
+BATCH_HEADER_FORMAT = "<BBHd"
+BATCH_HEADER_SIZE = struct.calcsize(BATCH_HEADER_FORMAT)
+
+# Ring buffer columns
+TIME, ALPHA, BETA, GAMMA, ACCEL_X, ACCEL_Y, ACCEL_Z = range(7)
+ANGLES = slice(ALPHA, GAMMA + 1)
+
+MAX_EXTRAPOLATION = 0.1  # seconds, further than this the guess is worse than holding still
+VELOCITY_WINDOW = 0.05   # seconds of samples the extrapolation velocity is fitted over
+
+
+def is_sensor_batch(data: bytes) -> bool:
+    return len(data) >= BATCH_HEADER_SIZE and data[0] == SENSOR_BATCH
+
+
+def parse_sensor_batch(data: bytes) -> Tuple[float, np.ndarray, bool]:
+    '''
+    Returns (base time, samples, server time) where samples is a (count, 7) array laid out
+    like the ring buffer rows, with times still relative to base time and NaN acceleration
+    when the batch has none. server time tells if the times are already on the server's
+    clock. Raises ValueError on a malformed batch.
+    '''
+    kind, flags, count, base_time = struct.unpack_from(BATCH_HEADER_FORMAT, data)
+    columns = 7 if flags & FLAG_ACCELERATION else 4
+    expected = BATCH_HEADER_SIZE + count * columns * 4
+    if kind != SENSOR_BATCH or len(data) != expected:
+        raise ValueError(f"Malformed sensor batch ({len(data)} bytes, expected {expected})")
+
+    values = np.frombuffer(data, dtype="<f4", count=count * columns, offset=BATCH_HEADER_SIZE)
+    samples = np.full((count, 7), np.nan)
+    samples[:, :columns] = values.reshape(count, columns)
+    return base_time, samples, bool(flags & FLAG_SERVER_TIME)
+
+
+class PoseRingBuffer:
+    '''
+    Fixed size history of one connection's orientation samples, in server time.
+    pose_at() interpolates between samples, or extrapolates past the newest one, so pose
+    dependent encode stages can ask for the orientation at the moment a frame will be seen.
+
+    Batches from a client that synced its clock come in server time already. Otherwise client
+    timestamps are mapped to server time with the smallest delay seen so far between a sample
+    being taken and its batch arriving, which absorbs the clock offset plus the fastest
+    network delay.
+    '''
+
+    def __init__(self, capacity: int = 512):
+        self.capacity = capacity
+        self.samples = np.zeros((capacity, 7))
+        self.count = 0
+        self.next = 0
+        self.lock = Lock()  # written on the receive path, read from the encode pool
+        self.clock_offset: Optional[float] = None  # server time - client time
+
+    def add_batch(self, base_time: float, samples: np.ndarray, server_time: bool = False,
+                  received_at: Optional[float] = None):
+        samples = samples.copy()
+        samples[:, TIME] += base_time
+        if server_time:
+            self._append(samples)
+            return
+
+        received_at = received_at or time.time()
+        offset = received_at - samples[:, TIME].max()
+        if self.clock_offset is None or offset < self.clock_offset:
+            self.clock_offset = offset
+        samples[:, TIME] += self.clock_offset
+        self._append(samples)
+
+    def add(self, alpha: float, beta: float, gamma: float = 0.0, timestamp: Optional[float] = None):
+        '''
+        Adds a single sample already in server time, for the old JSON 'gyro' messages.
+        '''
+        self._append(np.array([[timestamp or time.time(), alpha, beta, gamma, np.nan, np.nan, np.nan]]))
+
+    def _append(self, samples: np.ndarray):
+        with self.lock:
+            # Batches can arrive out of order, drop anything older than what we have
+            if self.count:
+                samples = samples[samples[:, TIME] > self.samples[(self.next - 1) % self.capacity, TIME]]
+            samples = samples[-self.capacity:]
+            n = len(samples)
+            if not n:
+                return
+            end = self.next + n
+            if end <= self.capacity:
+                self.samples[self.next:end] = samples
+            else:
+                split = self.capacity - self.next
+                self.samples[self.next:] = samples[:split]
+                self.samples[:n - split] = samples[split:]
+            self.next = end % self.capacity
+            self.count = min(self.count + n, self.capacity)
+
+    def clear(self):
+        with self.lock:
+            self.count = 0
+            self.next = 0
+
+    def history(self) -> np.ndarray:
+        '''Copy of the samples in time order'''
+        with self.lock:
+            if self.count < self.capacity:
+                return self.samples[:self.count].copy()
+            return np.concatenate((self.samples[self.next:], self.samples[:self.next]))
+
+    def latest(self) -> Optional[np.ndarray]:
+        with self.lock:
+            if not self.count:
+                return None
+            return self.samples[(self.next - 1) % self.capacity].copy()
+
+    def pose_at(self, timestamp: float) -> Optional[np.ndarray]:
+        '''
+        (alpha, beta, gamma) in degrees at a server timestamp: interpolated between the two
+        samples around it, extrapolated from the recent angular velocity past the newest
+        sample (for at most MAX_EXTRAPOLATION), the oldest sample before the history.
+        None when there are no samples yet.
+        '''
+        history = self.history()
+        if not len(history):
+            return None
+        times = history[:, TIME]
+        # Unwrapped so interpolating across 359 -> 0 doesn't spin the long way round
+        angles = np.unwrap(history[:, ANGLES], period=360.0, axis=0)
+
+        if timestamp >= times[-1]:
+            recent = times >= times[-1] - VELOCITY_WINDOW
+            if recent.sum() < 2:
+                pose = angles[-1]
+            else:
+                # Least squares slope over the recent samples, less noisy than the last two
+                t = times[recent] - times[-1]
+                velocity = np.polyfit(t, angles[recent], 1)[0]
+                pose = angles[-1] + velocity * min(timestamp - times[-1], MAX_EXTRAPOLATION)
+        elif timestamp <= times[0]:
+            pose = angles[0]
+        else:
+            index = int(np.searchsorted(times, timestamp))
+            t0, t1 = times[index - 1], times[index]
+            fraction = (timestamp - t0) / (t1 - t0)
+            pose = angles[index - 1] + (angles[index] - angles[index - 1]) * fraction
+
+        pose = pose.copy()
+        pose[0] %= 360.0  # alpha is a compass heading
+        return pose
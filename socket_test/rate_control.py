@@ -0,0 +1,189 @@
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Quality ladder from best to worst: (JPEG quality, resolution scale, fps).
+# Quality is dropped first since it's the cheapest to change, then resolution, then frame rate.
+QUALITY_LADDER = [
+    (60, 1.0, 30),
+    (45, 1.0, 30),
+    (35, 1.0, 30),
+    (25, 1.0, 30),
+    (35, 0.75, 30),
+    (25, 0.75, 30),
+    (30, 0.5, 30),
+    (20, 0.5, 30),
+    (20, 0.5, 20),
+    (15, 0.5, 15),
+    (15, 0.33, 15),
+    (10, 0.33, 10),
+]
+
+# A send() taking more than this share of the frame interval means the socket's write
+# buffer is full, the link can't take the bitrate even before acks show it.
+SLOW_SEND_SHARE = 0.5
+
+
+class AdaptiveStreamController:
+    '''
+    Closed loop controller for one connection.
+    It measures how long frames take from being sent until the client acknowledges
+    them, and how fast acknowledged bytes are delivered, then moves along
+    QUALITY_LADDER to keep the latency near target_latency without building up
+    a queue in the network buffers. Sends that block on a full socket buffer count
+    as congestion too.
+    '''
+
+    def __init__(self, target_latency: float = 0.1, start_level: int = 3, hold_time: float = 1.0):
+        self.target_latency = target_latency
+        self.hold_time = hold_time  # minimum time between two level changes
+        self.level = start_level
+        self.enabled = True
+        self.last_change = 0.0
+
+        self.in_flight: Dict[int, Tuple[float, int]] = {}  # sequence -> (send time, size)
+        self.deliveries: Deque[Tuple[float, int]] = deque(maxlen=60)  # (ack time, size)
+        self.frame_sizes: Deque[int] = deque(maxlen=30)
+        self.latency: Optional[float] = None  # smoothed send -> ack time
+        self.min_latency: Optional[float] = None
+        self.bandwidth: Optional[float] = None  # bytes per second
+        self.send_time: float = 0.0  # smoothed time spent in send()
+
+    @property
+    def quality(self):
+        return QUALITY_LADDER[self.level][0]
+
+    @property
+    def scale(self):
+        return QUALITY_LADDER[self.level][1]
+
+    @property
+    def fps(self):
+        return QUALITY_LADDER[self.level][2]
+
+    def resolution(self, width, height):
+        '''
+        Output resolution for a source frame of the given size, kept even for the encoders.
+        '''
+        return (int(width * self.scale) // 2 * 2, int(height * self.scale) // 2 * 2)
+
+    def on_frame_sent(self, sequence: int, size: int, send_started: float, send_finished: float):
+        self.in_flight[sequence] = (send_finished, size)
+        self.frame_sizes.append(size)
+        self.send_time = 0.9 * self.send_time + 0.1 * (send_finished - send_started)
+        # Old clients never ack, don't let the map grow forever
+        if len(self.in_flight) > 300:
+            for old in sorted(self.in_flight)[:100]:
+                del self.in_flight[old]
+
+    def on_ack(self, sequence: int, now: Optional[float] = None):
+        now = now or time.time()
+        sent = self.in_flight.pop(sequence, None)
+        if not sent:
+            return
+        # Anything older than an acked frame was dropped or lost on the way
+        for old in [seq for seq in self.in_flight if seq < sequence]:
+            del self.in_flight[old]
+
+        sent_at, size = sent
+        sample = now - sent_at
+        self.latency = sample if self.latency is None else 0.8 * self.latency + 0.2 * sample
+        self.min_latency = sample if self.min_latency is None else min(self.min_latency, sample)
+
+        self.deliveries.append((now, size))
+        if len(self.deliveries) >= 5:
+            elapsed = self.deliveries[-1][0] - self.deliveries[0][0]
+            if elapsed > 0:
+                delivered = sum(size for _, size in list(self.deliveries)[1:])
+                self.bandwidth = delivered / elapsed
+
+    @property
+    def unacked_frames(self):
+        return len(self.in_flight)
+
+    @property
+    def unacked_bytes(self):
+        return sum(size for _, size in self.in_flight.values())
+
+    def current_latency(self, now: float) -> Optional[float]:
+        '''
+        Smoothed latency, or the age of the oldest unacked frame if that is worse.
+        When the link stalls acks stop arriving, and that needs to count too.
+        '''
+        if self.latency is None:
+            return None
+        if self.in_flight:
+            oldest = min(sent_at for sent_at, _ in self.in_flight.values())
+            return max(self.latency, now - oldest)
+        return self.latency
+
+    @property
+    def sending_slow(self):
+        return self.send_time > SLOW_SEND_SHARE / self.fps
+
+    def _expected_bitrate(self, level: int) -> float:
+        '''
+        Rough bytes per second at another level, scaled from the current frame sizes.
+        JPEG size goes roughly with quality and with pixel count.
+        '''
+        if not self.frame_sizes:
+            return 0.0
+        quality, scale, fps = QUALITY_LADDER[level]
+        frame_size = sum(self.frame_sizes) / len(self.frame_sizes)
+        return frame_size * (quality / self.quality) * (scale / self.scale) ** 2 * fps
+
+    def update(self, now: Optional[float] = None) -> Optional[str]:
+        '''
+        Decides whether to move along the ladder. Returns a message describing the
+        decision if the level changed, otherwise None.
+        '''
+        now = now or time.time()
+        latency = self.current_latency(now)
+        if not self.enabled or latency is None or now - self.last_change < self.hold_time:
+            return None
+
+        # The delivery rate only shows the real link capacity once the link is full,
+        # otherwise it just mirrors our own bitrate. So latency drives the decisions,
+        # and the bandwidth estimate is only used to see how far to back off.
+        queuing = latency - (self.min_latency or 0)
+        new_level = self.level
+
+        if latency > self.target_latency * 1.5 or queuing > self.target_latency:
+            # Latency is building up, back off hard until the bitrate fits
+            new_level = min(self.level + 1, len(QUALITY_LADDER) - 1)
+            while new_level < len(QUALITY_LADDER) - 1 and self._expected_bitrate(new_level) > (self.bandwidth or 0) * 0.8:
+                new_level += 1
+                if new_level - self.level >= 3:
+                    break
+        elif latency > self.target_latency or self.sending_slow:
+            new_level = min(self.level + 1, len(QUALITY_LADDER) - 1)
+        elif latency < self.target_latency * 0.5:
+            new_level = max(self.level - 1, 0)
+
+        if new_level == self.level:
+            return None
+
+        direction = "down" if new_level > self.level else "up"
+        self.level = new_level
+        self.last_change = now
+        bandwidth = f"{self.bandwidth * 8 / 1e6:.1f} Mbps" if self.bandwidth else "unknown"
+        message = (f"Adaptive {direction}: quality {self.quality}, scale {self.scale}, {self.fps} fps "
+                   f"(latency {latency * 1000:.0f} ms, bandwidth {bandwidth})")
+        logger.info(message)
+        return message
+
+    def get_stats(self):
+        return {
+            'level': self.level,
+            'quality': self.quality,
+            'scale': self.scale,
+            'fps': self.fps,
+            'latency_ms': self.latency * 1000 if self.latency is not None else None,
+            'bandwidth_bps': self.bandwidth * 8 if self.bandwidth else None,
+            'send_time_ms': self.send_time * 1000,
+            'in_flight': len(self.in_flight),
+            'unacked_bytes': self.unacked_bytes,
+        }
@@ -1,5 +1,12 @@
 const canvas = document.getElementById("canvas");
 const ctx = canvas.getContext("2d");
+
+// Frames are decoded into this offscreen canvas and copied onto the visible one on every
+// animation frame, reprojected to the newest head orientation when the server sent a pose
+const frameCanvas = document.createElement("canvas");
+frameCanvas.width = canvas.width;
+frameCanvas.height = canvas.height;
+const frameCtx = frameCanvas.getContext("2d");
 const statusDiv = document.getElementById("status");
 const qualitySlider = document.getElementById("quality");
 const qualityValue = document.getElementById("qualityValue");
@@ -8,7 +15,31 @@ let socket,
   aesKey,
   iv,
   isConnected = false,
-  streamReady = false;
+  streamReady = false,
+  codec = "jpeg",
+  h264Decoder = null,
+  tileChain = Promise.resolve(),
+  haveTileKeyframe = false,
+  lastTileSequence = -1,
+  streamMode = "mono",
+  viewportFov = null,
+  framePose = null,
+  frameTiming = null,
+  frameDirty = false,
+  latestOrientation = null,
+  presentedOrientation = null,
+  publicKeyPem = null,
+  sessionKeyRaw = null,
+  pendingResume = null;
+
+// Ticket from the last stream_ready and its key, lets a reload skip the RSA exchange
+const SESSION_STORAGE_KEY = "streamSession";
+
+// Pose and decode start of the H264 frames still in the decoder, by chunk timestamp
+const h264Frames = new Map();
+
+// Optional stream settings picked through the page URL, e.g. ?codec=tiles
+const streamParams = new URLSearchParams(window.location.search);
 
 qualitySlider.oninput = () => {
   qualityValue.textContent = qualitySlider.value;
@@ -34,6 +65,7 @@ function connect() {
     updateStatus("Connection closed", "error");
     isConnected = false;
     streamReady = false;
+    stopClockSync();
   };
 
   socket.onerror = () => {
@@ -58,21 +90,57 @@ function base64Decode(str) {
   return new Uint8Array([...atob(str)].map((c) => c.charCodeAt(0)));
 }
 
-async function performKeyExchange(encodedPem) {
-  const pem = atob(encodedPem);
-  const encrypt = new JSEncrypt();
-  encrypt.setPublicKey(pem);
-
-  const aesKeyRaw = crypto.getRandomValues(new Uint8Array(32));
-  iv = crypto.getRandomValues(new Uint8Array(12));
+function streamOptions() {
+  return {
+    codec: streamParams.get("codec") || undefined,
+    source: streamParams.get("source") || undefined,
+    mode: streamParams.get("mode") || undefined,
+    lens: streamParams.get("lens") || undefined,
+    // ?fanout=1 takes the frames of the shared producer (manage.py runproducer), JPEG mono only
+    fanout: streamParams.get("fanout") === "1" || undefined,
+  };
+}
 
+async function importSessionKey(raw) {
+  sessionKeyRaw = raw;
   aesKey = await crypto.subtle.importKey(
     "raw",
-    aesKeyRaw,
+    raw,
     { name: "AES-GCM" },
     false,
     ["encrypt", "decrypt"]
   );
+}
+
+async function hmacSha256(keyBytes, label, ...parts) {
+  const key = await crypto.subtle.importKey(
+    "raw",
+    keyBytes,
+    { name: "HMAC", hash: "SHA-256" },
+    false,
+    ["sign"]
+  );
+  const labelBytes = new TextEncoder().encode(label);
+  const data = new Uint8Array(
+    parts.reduce((size, p) => size + p.length, labelBytes.length)
+  );
+  data.set(labelBytes, 0);
+  let offset = labelBytes.length;
+  for (const p of parts) {
+    data.set(p, offset);
+    offset += p.length;
+  }
+  return new Uint8Array(await crypto.subtle.sign("HMAC", key, data));
+}
+
+async function performKeyExchange(encodedPem) {
+  const pem = atob(encodedPem);
+  const encrypt = new JSEncrypt();
+  encrypt.setPublicKey(pem);
+
+  const aesKeyRaw = crypto.getRandomValues(new Uint8Array(32));
+  iv = crypto.getRandomValues(new Uint8Array(12));
+  await importSessionKey(aesKeyRaw);
 
   const aesKeyB64 = btoa(String.fromCharCode(...aesKeyRaw));
   const encryptedKey = encrypt.encrypt(aesKeyB64);
@@ -82,22 +150,92 @@ async function performKeyExchange(encodedPem) {
       type: "aes_key_exchange",
       encrypted_key: encryptedKey,
       iv: base64Encode(iv),
+      ...streamOptions(),
+    })
+  );
+}
+
+// Resumes the previous session with its ticket instead of doing RSA again, the server
+// answers with stream_ready (and its random for the new key) or resume_failed.
+// Must match socket_test/crypto.py.
+async function resumeSession(stored) {
+  const master = base64Decode(stored.key);
+  const clientRandom = crypto.getRandomValues(new Uint8Array(16));
+  const proof = await hmacSha256(master, "resume", clientRandom);
+  pendingResume = { master, clientRandom };
+  aesKey = null;
+  socket.send(
+    JSON.stringify({
+      type: "session_resume",
+      ticket: stored.ticket,
+      client_random: base64Encode(clientRandom),
+      proof: base64Encode(proof),
+      ...streamOptions(),
     })
   );
 }
 
+function storedSession() {
+  try {
+    return JSON.parse(sessionStorage.getItem(SESSION_STORAGE_KEY));
+  } catch (e) {
+    return null;
+  }
+}
+
 async function handleMessage(msg) {
   switch (msg.type) {
-    case "rsa_public_key":
-      await performKeyExchange(msg.key);
+    case "rsa_public_key": {
+      publicKeyPem = msg.key;
+      const stored = storedSession();
+      if (stored && stored.ticket && stored.key) {
+        await resumeSession(stored);
+      } else {
+        await performKeyExchange(msg.key);
+      }
+      break;
+    }
+    case "resume_failed":
+      console.info("Session resume failed, doing the full key exchange", msg.message);
+      pendingResume = null;
+      sessionStorage.removeItem(SESSION_STORAGE_KEY);
+      await performKeyExchange(publicKeyPem);
       break;
     case "stream_ready":
+      if (pendingResume && msg.server_random) {
+        const { master, clientRandom } = pendingResume;
+        await importSessionKey(
+          await hmacSha256(
+            master,
+            "stream key",
+            clientRandom,
+            base64Decode(msg.server_random)
+          )
+        );
+      }
+      pendingResume = null;
+      if (msg.ticket) {
+        sessionStorage.setItem(
+          SESSION_STORAGE_KEY,
+          JSON.stringify({ ticket: msg.ticket, key: base64Encode(sessionKeyRaw) })
+        );
+      }
       updateStatus("Streaming video...", "connected");
+      codec = msg.codec || "jpeg";
+      streamMode = msg.mode || "mono";
+      viewportFov = msg.viewport_fov || null;
       streamReady = true;
+      startClockSync();
+      break;
+    case "clock_sync":
+      onClockSync(msg);
       break;
     case "status":
       updateStatus(msg.message, "connected");
       break;
+    case "stats":
+      console.info("Stream stats", msg.stats);
+      break;
     case "error":
       updateStatus(`Error: ${msg.message}`, "error");
       break;
@@ -130,7 +268,8 @@ async function handleEncryptedFrame(data) {
   fullData.set(new Uint8Array(tag), ciphertext.byteLength);
 
   try {
-    const decrypted = await crypto.subtle.decrypt(
+    const decryptStart = performance.now();
+    let decrypted = await crypto.subtle.decrypt(
       {
         name: "AES-GCM",
         iv: nonce,
@@ -140,12 +279,54 @@ async function handleEncryptedFrame(data) {
       fullData
     );
 
+    // Lets the server's adaptive controller measure latency and bandwidth.
+    // The timestamp is on the server's clock, so the one way latency needs a synced clock.
+    sendEncryptedMessage({
+      type: "ack",
+      sequence,
+      decrypt_ms: performance.now() - decryptStart,
+      network_ms: clock.samples
+        ? (nowSeconds() - toLocalTime(timestamp)) * 1000
+        : undefined,
+    });
+
+    // Decode and display times go out in a second ack once the frame is on screen
+    const decodeStart = performance.now();
+
+    // Viewport frames start with the orientation the server cropped them for
+    let pose = null;
+    if (streamMode === "viewport") {
+      const poseView = new DataView(decrypted, 0, 8);
+      const alpha = poseView.getFloat32(0, true);
+      const beta = poseView.getFloat32(4, true);
+      pose = Number.isNaN(alpha) ? null : { alpha, beta };
+      decrypted = decrypted.slice(8);
+    }
+
+    if (codec === "h264") {
+      renderH264(decrypted, timestamp, pose, decodeStart);
+      return;
+    }
+    if (codec === "tiles") {
+      renderTiles(decrypted, sequence, pose, decodeStart);
+      return;
+    }
+    if (codec === "foveated") {
+      renderFoveated(decrypted, sequence, pose, decodeStart);
+      return;
+    }
+    if (codec === "stripes") {
+      renderStripes(decrypted, sequence, pose, decodeStart);
+      return;
+    }
+
     // --- JPEG rendering ---
 
     const blob = new Blob([decrypted], { type: "image/jpeg" });
     const img = new Image();
     img.onload = () => {
-      ctx.drawImage(img, 0, 0, canvas.width, canvas.height);
+      frameCtx.drawImage(img, 0, 0, frameCanvas.width, frameCanvas.height);
+      showFrame(pose, decodeStart);
       URL.revokeObjectURL(img.src);
     };
     img.onerror = (e) => {
@@ -153,32 +334,256 @@ async function handleEncryptedFrame(data) {
       URL.revokeObjectURL(img.src);
     };
     img.src = URL.createObjectURL(blob);
-
-    /*
-            // --- H264 rendering using WebCodecs API ---
-            const decoder = new VideoDecoder({
-                output: frame => {
-                    ctx.drawImage(frame, 0, 0, canvas.width, canvas.height);
-                    frame.close();
-                },
-                error: e => console.error(e)
-            });
-            decoder.configure({ codec: 'avc1.42E01E', width: 1280, height: 720 });
-            decoder.decode(new EncodedVideoChunk({
-                type: 'key',
-                timestamp,
-                data: new Uint8Array(decrypted)
-            }));*/
   } catch (e) {
     console.warn("Decryption failed", e);
   }
 }
 
+// --- H264 rendering using WebCodecs API ---
+// The server sends one Annex B access unit per message from a persistent encoder,
+// so a single decoder is kept for the whole stream.
+function isKeyframe(data) {
+  const bytes = new Uint8Array(data);
+  for (let i = 0; i + 3 < bytes.length; i++) {
+    if (bytes[i] === 0 && bytes[i + 1] === 0 && bytes[i + 2] === 1) {
+      const nalType = bytes[i + 3] & 0x1f;
+      if (nalType === 5 || nalType === 7) return true;
+      if (nalType === 1) return false;
+      i += 3;
+    }
+  }
+  return false;
+}
+
+function renderH264(data, timestamp, pose, decodeStart) {
+  const keyframe = isKeyframe(data);
+  if (!h264Decoder || h264Decoder.state === "closed") {
+    // Wait for a keyframe, delta frames can't be decoded on their own
+    if (!keyframe) return;
+    h264Decoder = new VideoDecoder({
+      output: (frame) => {
+        frameCtx.drawImage(frame, 0, 0, frameCanvas.width, frameCanvas.height);
+        const decoded = h264Frames.get(frame.timestamp);
+        showFrame(decoded ? decoded.pose : null, decoded ? decoded.decodeStart : null);
+        h264Frames.delete(frame.timestamp);
+        frame.close();
+      },
+      error: (e) => {
+        console.error("H264 decode error", e);
+        h264Decoder = null;
+      },
+    });
+    h264Decoder.configure({ codec: "avc1.42E028", optimizeForLatency: true });
+  }
+
+  const chunkTimestamp = Math.round(timestamp * 1e6);
+  h264Frames.set(chunkTimestamp, { pose, decodeStart });
+  // Frames the decoder dropped never come out, don't keep them forever
+  if (h264Frames.size > 30) h264Frames.delete(h264Frames.keys().next().value);
+  h264Decoder.decode(
+    new EncodedVideoChunk({
+      type: keyframe ? "key" : "delta",
+      timestamp: chunkTimestamp,
+      data: new Uint8Array(data),
+    })
+  );
+}
+
+// --- Tile delta rendering ---
+// Each message only carries the JPEG tiles that changed, so they are drawn on top of
+// what is already on the canvas. Messages are composited strictly in order.
+function requestKeyframe() {
+  haveTileKeyframe = false;
+  sendEncryptedMessage({ type: "keyframe" });
+}
+
+function renderTiles(data, sequence, pose, decodeStart) {
+  const view = new DataView(data);
+  const keyframe = (view.getUint8(1) & 0x01) !== 0;
+  const width = view.getUint16(2, true);
+  const height = view.getUint16(4, true);
+  const count = view.getUint16(6, true);
+
+  if (sequence < lastTileSequence || (!keyframe && !haveTileKeyframe)) {
+    // Out of order or nothing to draw on top of yet
+    requestKeyframe();
+    return;
+  }
+  lastTileSequence = sequence;
+
+  const rects = [];
+  let offset = 8;
+  for (let i = 0; i < count; i++) {
+    const x = view.getUint16(offset, true);
+    const y = view.getUint16(offset + 2, true);
+    const w = view.getUint16(offset + 4, true);
+    const h = view.getUint16(offset + 6, true);
+    const length = view.getUint32(offset + 8, true);
+    offset += 12;
+    const jpeg = new Blob([new Uint8Array(data, offset, length)], { type: "image/jpeg" });
+    rects.push({ x, y, w, h, bitmap: createImageBitmap(jpeg) });
+    offset += length;
+  }
+
+  tileChain = tileChain
+    .then(async () => {
+      const bitmaps = await Promise.all(rects.map((r) => r.bitmap));
+      const sx = frameCanvas.width / width;
+      const sy = frameCanvas.height / height;
+      rects.forEach((r, i) => {
+        frameCtx.drawImage(bitmaps[i], r.x * sx, r.y * sy, r.w * sx, r.h * sy);
+        bitmaps[i].close();
+      });
+      showFrame(pose, decodeStart);
+      if (keyframe) haveTileKeyframe = true;
+    })
+    .catch((e) => {
+      console.warn("Tile decode failed", e);
+      requestKeyframe();
+    });
+}
+
+// --- Stripe rendering ---
+// Big frames come as horizontal JPEG stripes the server encoded in parallel, they are
+// decoded in parallel here too and drawn at their y. Layout must match socket_com/striped_jpeg.py:
+//   [u8 version][u8 count][u16 width][u16 height], per stripe [u16 y][u16 height][u32 size][jpeg]
+let lastStripeSequence = -1;
+
+async function renderStripes(data, sequence, pose, decodeStart) {
+  const view = new DataView(data);
+  const count = view.getUint8(1);
+  const width = view.getUint16(2, true);
+  const height = view.getUint16(4, true);
+
+  const stripes = [];
+  let offset = 6;
+  for (let i = 0; i < count; i++) {
+    const y = view.getUint16(offset, true);
+    const h = view.getUint16(offset + 2, true);
+    const length = view.getUint32(offset + 4, true);
+    offset += 8;
+    const jpeg = new Blob([new Uint8Array(data, offset, length)], { type: "image/jpeg" });
+    stripes.push({ y, h, bitmap: createImageBitmap(jpeg) });
+    offset += length;
+  }
+
+  try {
+    const bitmaps = await Promise.all(stripes.map((s) => s.bitmap));
+    // A newer frame finished decoding first, don't draw over it
+    if (sequence < lastStripeSequence) {
+      bitmaps.forEach((b) => b.close());
+      return;
+    }
+    lastStripeSequence = sequence;
+    const sx = frameCanvas.width / width;
+    const sy = frameCanvas.height / height;
+    stripes.forEach((s, i) => {
+      frameCtx.drawImage(bitmaps[i], 0, s.y * sy, width * sx, s.h * sy);
+      bitmaps[i].close();
+    });
+    showFrame(pose, decodeStart);
+  } catch (e) {
+    console.warn("Stripe decode failed", e);
+  }
+}
+
+// --- Foveated rendering ---
+// Each message has a low resolution JPEG of the whole frame and a full quality JPEG of
+// the part the viewer is looking at. The periphery is stretched over the canvas and
+// the fovea drawn on top of it.
+let lastFoveatedSequence = -1;
+
+async function renderFoveated(data, sequence, pose, decodeStart) {
+  const view = new DataView(data);
+  const width = view.getUint16(1, true);
+  const height = view.getUint16(3, true);
+  const x = view.getUint16(5, true);
+  const y = view.getUint16(7, true);
+  const w = view.getUint16(9, true);
+  const h = view.getUint16(11, true);
+  const peripheryLength = view.getUint32(13, true);
+  const foveaLength = view.getUint32(17, true);
+  const offset = 21;
+
+  try {
+    const [periphery, fovea] = await Promise.all([
+      createImageBitmap(new Blob([new Uint8Array(data, offset, peripheryLength)], { type: "image/jpeg" })),
+      createImageBitmap(
+        new Blob([new Uint8Array(data, offset + peripheryLength, foveaLength)], { type: "image/jpeg" })
+      ),
+    ]);
+    // Decodes can finish out of order, never draw an older frame over a newer one
+    if (sequence > lastFoveatedSequence) {
+      lastFoveatedSequence = sequence;
+      const sx = frameCanvas.width / width;
+      const sy = frameCanvas.height / height;
+      frameCtx.drawImage(periphery, 0, 0, frameCanvas.width, frameCanvas.height);
+      frameCtx.drawImage(fovea, x * sx, y * sy, w * sx, h * sy);
+      showFrame(pose, decodeStart);
+    }
+    periphery.close();
+    fovea.close();
+  } catch (e) {
+    console.warn("Foveated decode failed", e);
+  }
+}
+
+// --- Presenting and timewarp ---
+// The newest decoded frame stays in frameCanvas together with the orientation it was
+// cropped for. Every animation frame it is shifted by how far the head turned since, so
+// rotation shows up at display rate instead of waiting for the next frame from the server.
+// Only viewport frames are warped. Mono and stereo frames show the whole camera frame
+// whatever way the head points, so there is no pose to reproject from, and shifting them
+// would move a picture that shouldn't move. They get no pose and no viewportFov.
+//
+// Once a frame is drawn, its decode time (decrypted -> in frameCanvas) and display time
+// (in frameCanvas -> drawn on the visible canvas) go to the server in an ack without a
+// sequence, so the rate controller doesn't see the frame twice. Frames replaced before
+// the next animation frame are never seen and aren't reported.
+function showFrame(pose, decodeStart = null) {
+  const now = performance.now();
+  framePose = pose;
+  frameTiming = decodeStart === null ? null : { decodeMs: now - decodeStart, decodedAt: now };
+  frameDirty = true;
+}
+
+function angleDifference(a, b) {
+  return ((a - b + 540) % 360) - 180;
+}
+
+function present() {
+  // Viewport mode only, see above
+  const warp = framePose && latestOrientation && viewportFov;
+  if (frameDirty || (warp && latestOrientation !== presentedOrientation)) {
+    if (warp) {
+      const dx = (angleDifference(latestOrientation.alpha, framePose.alpha) / viewportFov[0]) * canvas.width;
+      const dy = ((latestOrientation.beta - framePose.beta) / viewportFov[1]) * canvas.height;
+      ctx.fillStyle = "#000";
+      ctx.fillRect(0, 0, canvas.width, canvas.height);
+      ctx.drawImage(frameCanvas, dx, dy);
+    } else {
+      ctx.drawImage(frameCanvas, 0, 0);
+    }
+    if (frameDirty && frameTiming) {
+      sendEncryptedMessage({
+        type: "ack",
+        decode_ms: frameTiming.decodeMs,
+        display_ms: performance.now() - frameTiming.decodedAt,
+      });
+      frameTiming = null;
+    }
+    frameDirty = false;
+    presentedOrientation = latestOrientation;
+  }
+  requestAnimationFrame(present);
+}
+
+requestAnimationFrame(present);
+
 // --- Add encrypted message helper ---
-async function sendEncryptedMessage(messageObj) {
-  if (!aesKey || !iv || !isConnected) return;
+async function sendEncryptedBytes(bytes) {
+  if (!aesKey || !isConnected) return;
 
-  const encoded = new TextEncoder().encode(JSON.stringify(messageObj));
   const nonce = crypto.getRandomValues(new Uint8Array(12));
 
   try {
@@ -189,7 +594,7 @@ async function sendEncryptedMessage(messageObj) {
         tagLength: 128,
       },
       aesKey,
-      encoded
+      bytes
     );
 
     const nonceAndEncrypted = new Uint8Array(nonce.byteLength + encrypted.byteLength);
@@ -202,6 +607,10 @@ async function sendEncryptedMessage(messageObj) {
   }
 }
 
+function sendEncryptedMessage(messageObj) {
+  return sendEncryptedBytes(new TextEncoder().encode(JSON.stringify(messageObj)));
+}
+
 function sendControl(type) {
   sendEncryptedMessage({ type });
 }
@@ -213,34 +622,195 @@ function setQuality() {
   }
 }
 
+function setAdaptive(enabled) {
+  sendEncryptedMessage({ type: "adaptive", enabled });
+}
+
 function disconnect() {
   sendEncryptedMessage({ type: "terminate" });
   socket.close();
 }
 
-// Throttle rate (ms) to reduce WebSocket load
-let lastSentTime = 0;
-const gyroInterval = 50;
+// --- Clock sync ---
+// NTP style estimate of the server clock's offset and drift from ours, the same as
+// socket_com/clock_sync.py: the lowest round trip sample of the recent ones gives the
+// offset, a line fitted through a longer history of those gives the drift.
+const CLOCK_SYNC_BURST = 5; // exchanges right after the stream starts
+const CLOCK_SYNC_INTERVAL = 2000; // ms between exchanges after that
+const CLOCK_FILTER_SAMPLES = 8;
+const CLOCK_DRIFT_SAMPLES = 64;
+const CLOCK_MIN_DRIFT_SPAN = 10; // seconds of history before trusting the drift
+const clock = {
+  nextId: 0,
+  recent: [], // [local time, offset, delay]
+  history: [], // [local time, offset] of the filtered samples
+  offset: 0, // server - local, at referenceTime
+  referenceTime: 0,
+  drift: 0,
+  delay: null,
+  samples: 0,
+};
+let clockSyncTimer = null;
+
+function nowSeconds() {
+  return (performance.timeOrigin + performance.now()) / 1000;
+}
+
+function serverOffset(localTime = nowSeconds()) {
+  return clock.offset + clock.drift * (localTime - clock.referenceTime);
+}
+
+function toLocalTime(serverTime) {
+  return serverTime - serverOffset();
+}
+
+function toServerTime(localTime) {
+  return localTime + serverOffset(localTime);
+}
+
+function clockStats() {
+  return {
+    offset_ms: serverOffset() * 1000,
+    drift_ppm: clock.drift * 1e6,
+    rtt_ms: clock.delay * 1000,
+    samples: clock.samples,
+  };
+}
+
+function sendClockSync() {
+  if (!streamReady) return;
+  sendEncryptedMessage({
+    type: "clock_sync",
+    id: ++clock.nextId,
+    t1: nowSeconds(),
+    // Only for the server's stats
+    estimate: clock.samples ? clockStats() : undefined,
+  });
+}
+
+function startClockSync() {
+  stopClockSync();
+  for (let i = 0; i < CLOCK_SYNC_BURST; i++) {
+    setTimeout(sendClockSync, i * 50);
+  }
+  clockSyncTimer = setInterval(sendClockSync, CLOCK_SYNC_INTERVAL);
+}
+
+function stopClockSync() {
+  if (clockSyncTimer) clearInterval(clockSyncTimer);
+  clockSyncTimer = null;
+}
+
+function onClockSync(msg) {
+  const t4 = nowSeconds();
+  const delay = t4 - msg.t1 - (msg.t3 - msg.t2);
+  if (delay < 0) return; // our clock stepped during the exchange
+  const offset = (msg.t2 - msg.t1 + (msg.t3 - t4)) / 2;
+
+  clock.samples++;
+  clock.recent.push([t4, offset, delay]);
+  if (clock.recent.length > CLOCK_FILTER_SAMPLES) clock.recent.shift();
+  const best = clock.recent.reduce((a, b) => (b[2] < a[2] ? b : a));
+  clock.delay = best[2];
+  const last = clock.history[clock.history.length - 1];
+  if (!last || last[0] !== best[0]) {
+    clock.history.push([best[0], best[1]]);
+    if (clock.history.length > CLOCK_DRIFT_SAMPLES) clock.history.shift();
+  }
+
+  const first = clock.history[0];
+  const newest = clock.history[clock.history.length - 1];
+  if (newest[0] - first[0] < CLOCK_MIN_DRIFT_SPAN) {
+    [clock.referenceTime, clock.offset] = newest;
+    clock.drift = 0;
+    return;
+  }
+  // Least squares line through (time, offset)
+  const n = clock.history.length;
+  const meanT = clock.history.reduce((sum, [t]) => sum + t, 0) / n;
+  const meanO = clock.history.reduce((sum, [, o]) => sum + o, 0) / n;
+  let variance = 0;
+  let covariance = 0;
+  for (const [t, o] of clock.history) {
+    variance += (t - meanT) ** 2;
+    covariance += (t - meanT) * (o - meanO);
+  }
+  clock.drift = variance ? covariance / variance : 0;
+  clock.offset = meanO;
+  clock.referenceTime = meanT;
+}
+
+// --- Orientation sensor batches ---
+// Every deviceorientation reading is kept (with the latest acceleration from devicemotion)
+// and sent in encrypted binary batches, the server keeps the history to predict the pose.
+// Layout must match socket_test/pose.py:
+//   [u8 type = 1][u8 flags, 1 = has acceleration, 2 = server time][u16 count][f64 base time, seconds]
+//   per sample: [f32 offset from base][f32 alpha][f32 beta][f32 gamma] (+ [f32 x][f32 y][f32 z])
+const SENSOR_BATCH = 1;
+const FLAG_ACCELERATION = 1;
+const FLAG_SERVER_TIME = 2; // times converted with the clock sync estimate
+const SENSOR_BATCH_INTERVAL = 25; // ms between batches
+const SENSOR_BATCH_MAX = 16; // samples, sent early when reached
+let sensorSamples = [];
+let latestAcceleration = null;
+
+function flushSensorBatch() {
+  if (!sensorSamples.length || !streamReady) {
+    sensorSamples = [];
+    return;
+  }
+  const samples = sensorSamples;
+  sensorSamples = [];
+
+  const hasAcceleration = samples.every((s) => s.acceleration);
+  const columns = hasAcceleration ? 7 : 4;
+  const buffer = new ArrayBuffer(12 + samples.length * columns * 4);
+  const view = new DataView(buffer);
+  const base = samples[0].time;
+  const synced = clock.samples > 0;
+  view.setUint8(0, SENSOR_BATCH);
+  view.setUint8(
+    1,
+    (hasAcceleration ? FLAG_ACCELERATION : 0) | (synced ? FLAG_SERVER_TIME : 0)
+  );
+  view.setUint16(2, samples.length, true);
+  view.setFloat64(4, synced ? toServerTime(base) : base, true);
+
+  let offset = 12;
+  for (const s of samples) {
+    const values = [s.time - base, s.alpha, s.beta, s.gamma];
+    if (hasAcceleration) values.push(...s.acceleration);
+    for (const v of values) {
+      view.setFloat32(offset, v, true);
+      offset += 4;
+    }
+  }
+  sendEncryptedBytes(buffer);
+}
+
+setInterval(flushSensorBatch, SENSOR_BATCH_INTERVAL);
 
 window.addEventListener(
-  "deviceorientation",
+  "devicemotion",
   (event) => {
-    const now = Date.now();
-    if (!socket || !isConnected || now - lastSentTime < gyroInterval) return;
+    const a = event.accelerationIncludingGravity;
+    if (a && a.x !== null) latestAcceleration = [a.x, a.y, a.z];
+  },
+  true
+);
 
+window.addEventListener(
+  "deviceorientation",
+  (event) => {
     const { alpha, beta, gamma } = event;
-
-    socket.send(
-      JSON.stringify({
-        type: "gyro",
-        alpha,
-        beta,
-        gamma,
-        timestamp: now,
-      })
-    );
-
-    lastSentTime = now;
+    // Browsers without a gyro fire this once with nulls
+    if (alpha === null || beta === null) return;
+    // Used by the timewarp on every animation frame
+    latestOrientation = { alpha, beta };
+
+    const time = (performance.timeOrigin + event.timeStamp) / 1000;
+    sensorSamples.push({ time, alpha, beta, gamma: gamma || 0, acceleration: latestAcceleration });
+    if (sensorSamples.length >= SENSOR_BATCH_MAX) flushSensorBatch();
   },
   true
 );
@@ -0,0 +1,134 @@
+import logging
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from socket_com.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class LensProfile:
+    '''
+    Describes the headset lenses the frame gets pre-distorted for.
+    k1, k2: radial distortion coefficients, r' = r * (1 + k1 r^2 + k2 r^4), with r normalized
+        to half the eye viewport width.
+    chroma_red, chroma_blue: extra radial scale for the red and blue channels relative to green,
+        to cancel the lens' chromatic aberration. 1.0 for both skips the per channel remap.
+    lens_separation: distance between the lens centres as a fraction of the full output width.
+    fill: zoom applied after distortion so the image fills more (>1) or less of the eye.
+    '''
+
+    def __init__(self, k1: float, k2: float, chroma_red: float = 1.0, chroma_blue: float = 1.0,
+                 lens_separation: float = 0.5, fill: float = 1.0):
+        self.k1 = k1
+        self.k2 = k2
+        self.chroma_red = chroma_red
+        self.chroma_blue = chroma_blue
+        self.lens_separation = lens_separation
+        self.fill = fill
+
+    @property
+    def has_chroma(self):
+        return self.chroma_red != 1.0 or self.chroma_blue != 1.0
+
+
+LENS_PROFILES: Dict[str, LensProfile] = {
+    'flat': LensProfile(0.0, 0.0),  # plain side by side, no lenses
+    'cardboard': LensProfile(0.34, 0.55, chroma_red=0.996, chroma_blue=1.014, lens_separation=0.53, fill=1.3),
+    'generic': LensProfile(0.22, 0.24, chroma_red=0.996, chroma_blue=1.014, fill=1.15),
+}
+DEFAULT_LENS_PROFILE = 'cardboard'
+
+# (source size, output size, profile) -> one map per channel (B, G, R), or one map for all three
+RemapTables = List[Tuple[np.ndarray, np.ndarray]]
+_tables: Dict[Tuple[int, int, int, int, str], RemapTables] = {}
+_tables_lock = Lock()
+
+
+def build_remap_tables(source_size: Tuple[int, int], output_size: Tuple[int, int],
+                       profile: LensProfile) -> RemapTables:
+    '''
+    Computes the cv2.remap tables that turn a mono source frame into a side by side
+    frame, each eye barrel distorted around its lens centre.
+    Each eye shows the middle of the source cropped to the eye's aspect ratio.
+    '''
+    src_w, src_h = source_size
+    out_w, out_h = output_size
+    eye_w = out_w // 2
+
+    # Source pixels per output pixel, for a centred crop of the source at the eye's aspect ratio
+    scale = min(src_w / eye_w, src_h / out_h)
+    radius = eye_w / 2
+
+    x = np.arange(out_w, dtype=np.float32)
+    y = np.arange(out_h, dtype=np.float32)
+    xx, yy = np.meshgrid(x, y)
+
+    # Lens centres sit symmetric around the middle of the frame
+    half_separation = profile.lens_separation * out_w / 2
+    centre_x = np.where(xx < eye_w, out_w / 2 - half_separation, out_w / 2 + half_separation).astype(np.float32)
+    dx = (xx - centre_x) / radius
+    dy = (yy - out_h / 2) / radius
+    r2 = dx * dx + dy * dy
+    distortion = (1 + profile.k1 * r2 + profile.k2 * r2 * r2) / profile.fill
+
+    channel_scales = [profile.chroma_blue, 1.0, profile.chroma_red] if profile.has_chroma else [1.0]
+    tables = []
+    for channel_scale in channel_scales:
+        factor = distortion * channel_scale * radius * scale
+        map_x = (src_w / 2 + dx * factor).astype(np.float32)
+        map_y = (src_h / 2 + dy * factor).astype(np.float32)
+        # Fixed point maps are about twice as fast to remap with
+        tables.append(cv2.convertMaps(map_x, map_y, cv2.CV_16SC2))
+    return tables
+
+
+def get_remap_tables(source_size: Tuple[int, int], output_size: Tuple[int, int], profile_name: str) -> RemapTables:
+    '''
+    Cached build_remap_tables, the tables only depend on the sizes and the profile.
+    '''
+    key = (*source_size, *output_size, profile_name)
+    tables = _tables.get(key)
+    if tables is None:
+        with _tables_lock:
+            tables = _tables.get(key)
+            if tables is None:
+                tables = build_remap_tables(source_size, output_size, LENS_PROFILES[profile_name])
+                _tables[key] = tables
+                logger.info(f"Built stereo remap tables for {source_size} -> {output_size} ({profile_name})")
+    return tables
+
+
+class StereoView:
+    '''
+    Turns source frames into side by side left/right eye frames, pre-distorted for a lens
+    profile, so a phone in a headset can show them as they are.
+    Used as a view transform by the encode pipeline: render() also does the resize, so the
+    output comes out at the requested resolution without a second pass.
+    '''
+
+    def __init__(self, profile_name: str = DEFAULT_LENS_PROFILE):
+        if profile_name not in LENS_PROFILES:
+            raise ValueError(f"Unknown lens profile: {profile_name}")
+        self.profile_name = profile_name
+        self.pose = None  # not pose dependent, nothing to send in front of the payload
+
+    @property
+    def key(self):
+        '''Identifies the output for the broker's encode cache'''
+        return ('stereo', self.profile_name)
+
+    def render(self, frame: np.ndarray, resolution: Optional[Tuple[int, int]] = None) -> np.ndarray:
+        source_size = (frame.shape[1], frame.shape[0])
+        output_size = resolution or source_size
+        with metrics.time("convert"):
+            tables = get_remap_tables(source_size, output_size, self.profile_name)
+            if len(tables) == 1:
+                map1, map2 = tables[0]
+                return cv2.remap(frame, map1, map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+            channels = [cv2.remap(channel, map1, map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+                        for channel, (map1, map2) in zip(cv2.split(frame), tables)]
+            return cv2.merge(channels)
@@ -0,0 +1,84 @@
+import asyncio
+import time
+from unittest import mock
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from socket_test.consumers import (BACKPRESSURE_PROBE, MAX_UNACKED_BYTES, MAX_UNACKED_FRAMES,
+                                   StreamingConsumer)
+from socket_test.encode_pipeline import EncodeStage
+from socket_test.mailbox import LatestValueMailbox
+
+
+class FakeCamera:
+    running = True
+
+    def unsubscribe(self, callback):
+        pass
+
+
+def consumer_behind(now):
+    # A client that acked one frame, then stopped acking the next MAX_UNACKED_FRAMES
+    consumer = StreamingConsumer()
+    controller = consumer.rate_controller
+    controller.on_frame_sent(0, 1000, now - 0.1, now - 0.1)
+    controller.on_ack(0, now=now - 0.05)
+    for sequence in range(1, MAX_UNACKED_FRAMES + 1):
+        controller.on_frame_sent(sequence, 1000, now, now)
+    consumer.last_frame_sent = now
+    return consumer
+
+
+class ClientBehindTests(SimpleTestCase):
+    def test_unacked_frames(self):
+        now = time.time()
+        consumer = consumer_behind(now)
+        self.assertTrue(consumer._client_behind(now))
+        consumer.rate_controller.on_ack(MAX_UNACKED_FRAMES, now=now)
+        self.assertFalse(consumer._client_behind(now))
+
+    def test_unacked_bytes(self):
+        now = time.time()
+        consumer = StreamingConsumer()
+        consumer.rate_controller.on_frame_sent(0, 1000, now, now)
+        consumer.rate_controller.on_ack(0, now=now)
+        consumer.rate_controller.on_frame_sent(1, MAX_UNACKED_BYTES, now, now)
+        consumer.last_frame_sent = now
+        self.assertTrue(consumer._client_behind(now))
+
+    def test_clients_that_never_ack(self):
+        now = time.time()
+        consumer = StreamingConsumer()
+        for sequence in range(MAX_UNACKED_FRAMES + 1):
+            consumer.rate_controller.on_frame_sent(sequence, 1000, now, now)
+        consumer.last_frame_sent = now
+        self.assertFalse(consumer._client_behind(now))
+
+    def test_probe_after_a_while(self):
+        now = time.time()
+        consumer = consumer_behind(now)
+        # Acks may have been lost, a frame goes out anyway
+        self.assertFalse(consumer._client_behind(now + BACKPRESSURE_PROBE + 0.01))
+
+
+class SkipWhileBehindTests(SimpleTestCase):
+    def test_frames_are_not_encoded(self):
+        async def run():
+            consumer = consumer_behind(time.time())
+            consumer.running = True
+            consumer.camera = FakeCamera()
+            consumer.frame_mailbox = LatestValueMailbox()
+            consumer.frame_mailbox.put((1, np.zeros((16, 16, 3), dtype=np.uint8)))
+            with mock.patch.object(EncodeStage, "submit") as submit:
+                task = asyncio.create_task(consumer._stream_video())
+                while consumer.frame_mailbox.delivered < 1:
+                    await asyncio.sleep(0.001)
+                consumer.running = False
+                consumer.frame_mailbox.close()
+                await task
+            return consumer, submit
+        with self.assertLogs("socket_test.consumers", "INFO"):
+            consumer, submit = asyncio.run(run())
+        self.assertEqual(consumer.frames_skipped_backpressure, 1)
+        submit.assert_not_called()
@@ -0,0 +1,125 @@
+import threading
+import time
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from socket_test.camera_broker import ENCODE_CACHE_FRAMES, CameraBroker, get_camera_broker
+from socket_test.frame_sources import FrameSource
+
+
+class FakeSource(FrameSource):
+    def __init__(self):
+        super().__init__(16, 16, 30)
+        self.starts = 0
+        self.stops = 0
+        self.opened = False
+
+    def start(self):
+        self.starts += 1
+        self.opened = True
+        return True
+
+    def _read(self):
+        time.sleep(0.001)
+        return np.zeros((16, 16, 3), dtype=np.uint8) if self.opened else None
+
+    def stop(self):
+        super().stop()
+        self.stops += 1
+        self.opened = False
+
+
+class Subscriber:
+    def __init__(self):
+        self.frame_ids = []
+        self.got_frames = threading.Event()
+
+    def __call__(self, frame_id, frame, timestamp):
+        self.frame_ids.append(frame_id)
+        if len(self.frame_ids) >= 3:
+            self.got_frames.set()
+
+
+class SubscribeTests(SimpleTestCase):
+    def test_one_source_for_every_subscriber(self):
+        source = FakeSource()
+        broker = CameraBroker(source)
+        first, second = Subscriber(), Subscriber()
+        try:
+            self.assertTrue(broker.subscribe(first))
+            self.assertTrue(broker.subscribe(second))
+            self.assertTrue(first.got_frames.wait(5.0) and second.got_frames.wait(5.0))
+            self.assertEqual(source.starts, 1)
+
+            broker.unsubscribe(first)
+            self.assertTrue(broker.running)
+        finally:
+            broker.unsubscribe(second)
+        # The last one out stops the source
+        self.assertFalse(broker.running)
+        self.assertEqual(source.stops, 1)
+
+    def test_source_that_fails_to_start(self):
+        source = FakeSource()
+        source.start = lambda: False
+        broker = CameraBroker(source)
+        self.assertFalse(broker.subscribe(Subscriber()))
+        self.assertEqual(broker.subscribers, [])
+
+
+class EncodeCacheTests(SimpleTestCase):
+    def test_concurrent_viewers_share_one_encode(self):
+        broker = CameraBroker(FakeSource())
+        release = threading.Event()
+        calls = []
+
+        def encode():
+            calls.append(1)
+            release.wait(5.0)
+            return b"jpeg"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(broker.get_encoded(1, ("jpeg", 80), encode)))
+                   for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        while broker.cache_hits + len(calls) < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5.0)
+
+        self.assertEqual(results, [b"jpeg"] * 3)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(broker.cache_hits, 2)
+
+    def test_keys_and_old_frames(self):
+        broker = CameraBroker(FakeSource())
+        broker.get_encoded(1, ("jpeg", 80), lambda: b"80")
+        self.assertEqual(broker.get_encoded(1, ("jpeg", 50), lambda: b"50"), b"50")
+        broker.get_encoded(1 + ENCODE_CACHE_FRAMES, ("jpeg", 80), lambda: b"new")
+        self.assertEqual([frame_id for frame_id, _ in broker.encode_cache], [1 + ENCODE_CACHE_FRAMES])
+
+    def test_failed_encode(self):
+        broker = CameraBroker(FakeSource())
+
+        def encode():
+            raise RuntimeError("encoder broke")
+        with self.assertLogs("socket_test.camera_broker", "ERROR"):
+            self.assertIsNone(broker.get_encoded(1, ("jpeg", 80), encode))
+        # Later viewers get the failure too instead of waiting forever
+        self.assertIsNone(broker.get_encoded(1, ("jpeg", 80), lambda: b"late"))
+
+
+class GetCameraBrokerTests(SimpleTestCase):
+    def test_one_broker_per_name(self):
+        created = []
+
+        def create_source():
+            created.append(FakeSource())
+            return created[-1]
+        broker = get_camera_broker("test_one_broker_per_name", create_source)
+        self.assertIs(get_camera_broker("test_one_broker_per_name", create_source), broker)
+        self.assertEqual(len(created), 1)
+        self.assertIs(broker.source, created[0])
@@ -0,0 +1,119 @@
+import asyncio
+import os
+import shutil
+import tempfile
+
+from channels.exceptions import ChannelFull
+from django.test import SimpleTestCase
+
+from socket_test.channel_layers import ChannelHub, UnixSocketChannelLayer, _HubConnection, _client_id
+from socket_test.fanout import FANOUT_RENDITIONS, frame_group, pick_rendition
+
+
+class FakeWriter:
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class HubConnectionTests(SimpleTestCase):
+    def test_group_backlog_drops_the_oldest(self):
+        async def run():
+            writer = FakeWriter()
+            conn = _HubConnection(writer, group_backlog=2, capacity=10)
+            # Nothing gets written before the loop gets to the writer task
+            for frame in (b"1", b"2", b"3", b"4"):
+                conn.enqueue(frame, group="frames")
+            conn.enqueue(b"direct")
+            conn.enqueue(b"other", group="other")
+            self.assertEqual(conn.dropped, 2)
+            await asyncio.sleep(0)
+            conn.close()
+            return writer.written, conn.pending
+        written, pending = asyncio.run(run())
+        self.assertEqual(written, [b"3", b"4", b"direct", b"other"])
+        self.assertEqual(pending, {"frames": 0, "other": 0})
+
+    def test_direct_messages_over_capacity(self):
+        async def run():
+            conn = _HubConnection(FakeWriter(), group_backlog=2, capacity=2)
+            with self.assertLogs("socket_test.channel_layers", "WARNING"):
+                for message in (b"1", b"2", b"3"):
+                    conn.enqueue(message)
+            conn.close()
+            return list(conn.outbox), conn.dropped
+        outbox, dropped = asyncio.run(run())
+        self.assertEqual(outbox, [(None, b"1"), (None, b"2")])
+        self.assertEqual(dropped, 1)
+
+    def test_client_id(self):
+        self.assertEqual(_client_id("specific.abc123!def"), "abc123")
+        self.assertIsNone(_client_id("plain"))
+
+
+class UnixSocketChannelLayerTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "hub.sock")
+
+    def test_group_send_through_the_hub(self):
+        async def run():
+            hub = ChannelHub(self.path)
+            hub_task = asyncio.create_task(hub.serve())
+            while not os.path.exists(self.path):
+                await asyncio.sleep(0.001)
+            producer, worker = UnixSocketChannelLayer(self.path), UnixSocketChannelLayer(self.path)
+            try:
+                channel = await worker.new_channel()
+                await worker.group_add("frames.test", channel)
+                while not hub.groups.get("frames.test"):
+                    await asyncio.sleep(0.001)
+                await producer.group_send("frames.test", {'type': 'frame.published', 'data': b"\xff\xd8jpeg"})
+                return await asyncio.wait_for(worker.receive(channel), 5.0)
+            finally:
+                await producer.close()
+                await worker.close()
+                # Let the hub see both workers go before it stops
+                while hub.connections:
+                    await asyncio.sleep(0.001)
+                hub_task.cancel()
+                try:
+                    await hub_task
+                except asyncio.CancelledError:
+                    pass
+        with self.assertLogs("socket_test.channel_layers", "INFO"):
+            message = asyncio.run(run())
+        self.assertEqual(message, {'type': 'frame.published', 'data': b"\xff\xd8jpeg"})
+
+    def test_local_channels_skip_the_hub(self):
+        async def run():
+            layer = UnixSocketChannelLayer(self.path, capacity=1)
+            with self.assertLogs("socket_test.channel_layers", "WARNING"):
+                channel = await layer.new_channel()  # no hub running
+            await layer.send(channel, {'type': 'hello'})
+            with self.assertRaises(ChannelFull):
+                await layer.send(channel, {'type': 'again'})
+            return await layer.receive(channel)
+        self.assertEqual(asyncio.run(run()), {'type': 'hello'})
+
+
+class PickRenditionTests(SimpleTestCase):
+    def test_best_rendition_not_above_the_ask(self):
+        self.assertEqual(pick_rendition(100, 1.0), FANOUT_RENDITIONS[0])
+        self.assertEqual(pick_rendition(40, 1.0), (35, 1.0))
+        self.assertEqual(pick_rendition(60, 0.75), (25, 0.5))
+
+    def test_worst_when_nothing_fits(self):
+        self.assertEqual(pick_rendition(10, 0.25), FANOUT_RENDITIONS[-1])
+
+    def test_group_names(self):
+        self.assertEqual(frame_group("camera", (25, 0.5)), "frames.camera.q25.s50")
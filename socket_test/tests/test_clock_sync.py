@@ -0,0 +1,53 @@
+from django.test import SimpleTestCase
+
+from socket_com.clock_sync import (ClockSync, pack_sync_request, pack_sync_response,
+                                   unpack_sync_response)
+
+
+def exchange(sync, t1, offset, outbound, inbound, processing=0.0001):
+    # One request/response against a remote clock `offset` ahead of ours
+    t2 = t1 + outbound + offset
+    t3 = t2 + processing
+    t4 = t3 - offset + inbound
+    sync.on_response(t1, t2, t3, t4)
+
+
+class ClockSyncTests(SimpleTestCase):
+    def test_symmetric_exchange(self):
+        sync = ClockSync()
+        self.assertFalse(sync.synced)
+        exchange(sync, 100.0, offset=3.5, outbound=0.01, inbound=0.01)
+        self.assertTrue(sync.synced)
+        self.assertAlmostEqual(sync.offset_at(100.0), 3.5)
+        self.assertAlmostEqual(sync.delay, 0.02)
+        self.assertAlmostEqual(sync.to_remote(200.0), 203.5)
+        self.assertAlmostEqual(sync.to_local(203.5), 200.0, places=6)
+
+    def test_lowest_delay_sample_wins(self):
+        sync = ClockSync()
+        # Queuing on the way there skews those samples, the quick one is the truth
+        exchange(sync, 100.0, offset=-2.0, outbound=0.08, inbound=0.005)
+        exchange(sync, 100.5, offset=-2.0, outbound=0.005, inbound=0.005)
+        exchange(sync, 101.0, offset=-2.0, outbound=0.06, inbound=0.005)
+        self.assertAlmostEqual(sync.offset_at(101.0), -2.0)
+        self.assertAlmostEqual(sync.delay, 0.01)
+
+    def test_drift(self):
+        sync = ClockSync()
+        drift = 50e-6
+        for i in range(40):
+            t1 = 1000.0 + i
+            exchange(sync, t1, offset=1.0 + drift * (t1 - 1000.0), outbound=0.002, inbound=0.002)
+        self.assertAlmostEqual(sync.drift, drift, delta=1e-6)
+        self.assertAlmostEqual(sync.offset_at(1100.0), 1.0 + drift * 100, delta=1e-4)
+
+    def test_clock_step_is_ignored(self):
+        sync = ClockSync()
+        sync.on_response(100.0, 50.0, 51.0, 100.01)  # remote took longer than the round trip
+        self.assertFalse(sync.synced)
+
+    def test_packets(self):
+        remote = ClockSync(clock=lambda: 20.5)
+        request_id, t1 = 7, 10.0
+        response = pack_sync_response(pack_sync_request(request_id, t1), 20.25, clock=remote.clock)
+        self.assertEqual(unpack_sync_response(response), (7, 10.0, 20.25, 20.5))
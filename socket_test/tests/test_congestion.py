@@ -0,0 +1,33 @@
+from django.test import SimpleTestCase
+
+from socket_com.congestion import LADDER_DOWN_FRAMES, LADDER_UP_FRAMES, UPGRADE_HEADROOM, EncodingLadder
+
+
+class EncodingLadderTests(SimpleTestCase):
+    def test_steps_down_after_frames_in_a_row(self):
+        ladder = EncodingLadder(["best", "middle", "worst"])
+        for _ in range(LADDER_DOWN_FRAMES - 1):
+            ladder.on_frame(120, 100)
+        self.assertEqual(ladder.current, "best")
+        ladder.on_frame(120, 100)
+        self.assertEqual(ladder.current, "middle")
+
+    def test_no_flapping(self):
+        # Frames around the budget used to move the ladder on every one of them
+        ladder = EncodingLadder(["best", "middle", "worst"])
+        ladder.index = 1
+        for i in range(100):
+            ladder.on_frame(120 if i % 2 else 100 * UPGRADE_HEADROOM - 10, 100)
+        self.assertEqual(ladder.current, "middle")
+        self.assertEqual(ladder.changes, 0)
+
+    def test_steps_up_slowly(self):
+        ladder = EncodingLadder(["best", "middle", "worst"])
+        ladder.index = 2
+        for _ in range(LADDER_UP_FRAMES * 2):
+            ladder.on_frame(10, 100)
+        self.assertEqual(ladder.current, "best")
+        for _ in range(LADDER_UP_FRAMES):
+            ladder.on_frame(10, 100)
+        self.assertEqual(ladder.current, "best")
+        self.assertEqual(ladder.changes, 2)
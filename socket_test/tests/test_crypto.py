@@ -0,0 +1,66 @@
+import base64
+import os
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from socket_test.crypto import (RESUME_RANDOM_SIZE, TICKET_LIFETIME, CryptoService, SessionCipher,
+                                derive_resumed_key, resume_proof)
+
+
+class SessionCipherTests(SimpleTestCase):
+    def test_round_trip_and_unique_nonces(self):
+        cipher = SessionCipher(os.urandom(32))
+        messages = [cipher.encrypt(b"frame %d" % i) for i in range(3)]
+        self.assertEqual(len({message[:12] for message in messages}), 3)
+        self.assertEqual(cipher.decrypt(messages[1]), b"frame 1")
+
+    def test_tampered_message(self):
+        cipher = SessionCipher(os.urandom(32))
+        message = bytearray(cipher.encrypt(b"frame"))
+        message[14] ^= 1
+        with self.assertRaises(ValueError):
+            cipher.decrypt(bytes(message))
+
+
+class SessionTicketTests(SimpleTestCase):
+    def setUp(self):
+        self.service = CryptoService("missing_public.pem", "missing_private.pem")
+        self.master = os.urandom(32)
+        self.ticket = self.service.issue_ticket(self.master)
+        self.client_random = os.urandom(RESUME_RANDOM_SIZE)
+
+    def resume(self, ticket=None, client_random=None, proof=None):
+        client_random = client_random or self.client_random
+        proof = proof or resume_proof(self.master, client_random)
+        return self.service.resume(ticket or self.ticket, client_random, proof)
+
+    def test_resume(self):
+        key, server_random = self.resume()
+        self.assertEqual(len(server_random), RESUME_RANDOM_SIZE)
+        self.assertEqual(key, derive_resumed_key(self.master, self.client_random, server_random))
+        self.assertNotEqual(key, self.master)
+        # Every resume gets a fresh key, even from the same ticket
+        self.assertNotEqual(self.resume()[0], key)
+
+    def test_wrong_proof(self):
+        with self.assertRaisesMessage(ValueError, "Invalid resume proof"):
+            self.resume(proof=resume_proof(os.urandom(32), self.client_random))
+
+    def test_expired(self):
+        with mock.patch("socket_test.crypto.time.time", return_value=time.time() + TICKET_LIFETIME + 1):
+            with self.assertRaisesMessage(ValueError, "Session ticket expired"):
+                self.resume()
+
+    def test_unknown_tickets(self):
+        tampered = bytearray(base64.b64decode(self.ticket))
+        tampered[20] ^= 1
+        other_process = CryptoService("missing_public.pem", "missing_private.pem").issue_ticket(self.master)
+        for ticket in (base64.b64encode(tampered).decode(), other_process, "not base64!"):
+            with self.assertRaisesMessage(ValueError, "Unknown session ticket"):
+                self.resume(ticket=ticket)
+
+    def test_bad_client_random(self):
+        with self.assertRaisesMessage(ValueError, "Invalid resume request"):
+            self.resume(client_random=b"short")
@@ -0,0 +1,88 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from socket_test.encode_pipeline import EncodeStage
+
+
+class EncodeStageTests(SimpleTestCase):
+    def setUp(self):
+        # A pool of our own, so the tests know how many jobs can run at once
+        self.pool = ThreadPoolExecutor(2)
+        patcher = mock.patch("socket_test.encode_pipeline.get_executor", return_value=self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.pool.shutdown)
+
+    def wait_running(self, stage, count):
+        deadline = time.monotonic() + 5.0
+        while sum(job.future.running() for job in stage.jobs) < count:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.001)
+
+    def test_results_in_order(self):
+        async def run():
+            stage = EncodeStage(max_in_flight=3)
+            for i in range(3):
+                stage.submit(lambda i=i: i)
+            return [await stage.next_result() for _ in range(3)]
+        self.assertEqual(asyncio.run(run()), [0, 1, 2])
+
+    def test_stale_droppable_jobs_make_room(self):
+        async def run():
+            stage = EncodeStage(max_in_flight=3)
+            release = threading.Event()
+            try:
+                stage.submit(release.wait)
+                stage.submit(release.wait)
+                self.wait_running(stage, 2)
+                # The queued one gives way to each newer frame
+                accepted = [stage.submit(release.wait) for _ in range(4)]
+                return accepted, stage.dropped, stage.has_room()
+            finally:
+                release.set()
+                stage.close()
+        accepted, dropped, has_room = asyncio.run(run())
+        self.assertEqual(accepted, [True] * 4)
+        self.assertEqual(dropped, 3)
+        self.assertTrue(has_room)
+
+    def test_running_jobs_are_not_room(self):
+        async def run():
+            stage = EncodeStage(max_in_flight=2)
+            release = threading.Event()
+            try:
+                stage.submit(release.wait)
+                stage.submit(release.wait)
+                self.wait_running(stage, 2)
+                self.assertFalse(stage.has_room())
+                self.assertFalse(stage.submit(release.wait))
+                self.assertEqual(stage.dropped, 1)
+                self.assertFalse(await stage.wait_for_room(timeout=0.01))
+            finally:
+                release.set()
+                stage.close()
+        asyncio.run(run())
+
+    def test_non_droppable_jobs_get_backpressure(self):
+        async def run():
+            stage = EncodeStage(max_in_flight=2)
+            release = threading.Event()
+            stage.submit(release.wait, droppable=False)
+            stage.submit(lambda: "second", droppable=False)
+            self.assertFalse(stage.has_room())
+            self.assertFalse(await stage.wait_for_room(timeout=0.01))
+
+            waiter = asyncio.ensure_future(stage.wait_for_room(timeout=5.0))
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+            release.set()
+            self.assertTrue(await stage.next_result())
+            self.assertTrue(await waiter)
+            self.assertEqual(len(stage.jobs), 1)
+            self.assertEqual(stage.dropped, 0)
+        asyncio.run(run())
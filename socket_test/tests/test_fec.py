@@ -0,0 +1,64 @@
+import os
+
+from django.test import SimpleTestCase
+
+from socket_com.fec import MAX_FEC_RATIO, MIN_FEC_RATIO, FecController, make_parity, parity_count
+from socket_com.frame_packets import FrameSlot
+
+PACKET_SIZE = 100
+
+
+def receive(payload, parity, lost):
+    # What the client's reassembler ends up with when the packets in `lost` don't arrive
+    data_packets = -(-len(payload) // PACKET_SIZE)
+    slot = FrameSlot(1, 0.0, len(payload), data_packets, parity, PACKET_SIZE, now=0.0)
+    packets = [payload[i:i + PACKET_SIZE] for i in range(0, len(payload), PACKET_SIZE)]
+    packets += make_parity(payload, PACKET_SIZE, parity)
+    for index, packet in enumerate(packets):
+        if index not in lost:
+            slot.add(index, packet, now=0.0)
+    return slot
+
+
+class MakeParityTests(SimpleTestCase):
+    def test_parity_packets(self):
+        parity = make_parity(os.urandom(950), PACKET_SIZE, 3)
+        self.assertEqual(len(parity), 3)
+        self.assertTrue(all(len(p) == PACKET_SIZE for p in parity))
+        self.assertEqual(make_parity(os.urandom(950), PACKET_SIZE, 0), [])
+
+    def test_one_loss_per_group(self):
+        payload = os.urandom(950)  # the last packet is short
+        slot = receive(payload, parity=3, lost={1, 5, 9})
+        self.assertTrue(slot.complete)
+        self.assertEqual(slot.recovered, 3)
+        self.assertEqual(bytes(slot.frame()), payload)
+
+    def test_burst_loss(self):
+        # Interleaved groups, a burst as long as the parity count costs one packet per group
+        payload = os.urandom(2000)
+        slot = receive(payload, parity=4, lost={8, 9, 10, 11})
+        self.assertTrue(slot.complete)
+        self.assertEqual(bytes(slot.frame()), payload)
+
+    def test_two_losses_in_a_group(self):
+        slot = receive(os.urandom(2000), parity=4, lost={0, 4})
+        self.assertFalse(slot.complete)
+        self.assertEqual(slot.missing(), [0, 4])
+
+
+class FecControllerTests(SimpleTestCase):
+    def test_parity_count(self):
+        self.assertEqual(parity_count(100, 0.05), 5)
+        self.assertEqual(parity_count(3, 0.05), 1)
+        self.assertEqual(parity_count(3, 2.0), 3)
+        self.assertEqual(parity_count(0, 0.5), 0)
+
+    def test_ratio_follows_loss(self):
+        fec = FecController()
+        self.assertEqual(fec.ratio, MIN_FEC_RATIO)
+        fec.on_loss_report(90, 100)
+        self.assertAlmostEqual(fec.ratio, 0.4)
+        fec.on_loss_report(0, 100)
+        self.assertEqual(fec.ratio, MAX_FEC_RATIO)
+        self.assertEqual(FecController(ratio=0.2).ratio, 0.2)
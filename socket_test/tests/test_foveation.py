@@ -0,0 +1,73 @@
+from django.test import SimpleTestCase
+
+from socket_test.foveation import FIELD_OF_VIEW, GazePredictor, angle_difference, fovea_rect
+from socket_test.pose import PoseRingBuffer
+
+
+def looking(start, *orientations):
+    # The first prediction makes `start` the centre, then the head moves, one sample a second
+    poses = PoseRingBuffer()
+    poses.add(*start, timestamp=90.0)
+    gaze = GazePredictor(poses=poses)
+    gaze.predict(0.0, now=90.0)
+    for i, (alpha, beta) in enumerate(orientations):
+        poses.add(alpha, beta, timestamp=101.0 - len(orientations) + i)
+    return gaze
+
+
+class GazePredictorTests(SimpleTestCase):
+    def test_centre_before_any_sample(self):
+        gaze = GazePredictor()
+        self.assertEqual(gaze.predict(0.05, now=100.0), (0.5, 0.5))
+        self.assertIsNone(gaze.orientation_at((0.2, 0.2)))
+
+    def test_orientation_at_the_first_prediction_is_the_centre(self):
+        # Turning left raises alpha and moves the view left, tilting up moves it up
+        gaze = looking((10.0, 0.0), (19.0, 6.0))
+        x, y = gaze.predict(0.0, now=100.0)
+        self.assertAlmostEqual(x, 0.5 - 9.0 / FIELD_OF_VIEW[0])
+        self.assertAlmostEqual(y, 0.5 - 6.0 / FIELD_OF_VIEW[1])
+
+    def test_heading_wraps(self):
+        gaze = looking((355.0, 0.0), (5.0, 0.0))
+        self.assertAlmostEqual(gaze.predict(0.0, now=100.0)[0], 0.5 - 10.0 / FIELD_OF_VIEW[0])
+        self.assertAlmostEqual(angle_difference(5.0, 355.0), 10.0)
+
+    def test_clamped_to_the_frame(self):
+        gaze = looking((0.0, 0.0), (270.0, -80.0))
+        self.assertEqual(gaze.predict(0.0, now=100.0), (1.0, 1.0))
+
+    def test_predicts_ahead(self):
+        gaze = looking((0.0, 0.0))
+        for i in range(6):
+            gaze.poses.add(i * 1.0, 0.0, timestamp=100.0 + i * 0.01)  # 100 degrees/s to the left
+        x, _ = gaze.predict(0.05, now=100.05)
+        self.assertAlmostEqual(x, 0.5 - 10.0 / FIELD_OF_VIEW[0], places=3)
+
+    def test_orientation_at_inverts_predict(self):
+        gaze = looking((350.0, 5.0), (20.0, -10.0))
+        centre = gaze.predict(0.0, now=100.0)
+        alpha, beta = gaze.orientation_at(centre)
+        self.assertAlmostEqual(alpha, 20.0)
+        self.assertAlmostEqual(beta, -10.0)
+
+    def test_recenter(self):
+        gaze = looking((10.0, 0.0), (40.0, 0.0))
+        self.assertNotEqual(gaze.predict(0.0, now=100.0), (0.5, 0.5))
+        gaze.recenter()
+        self.assertEqual(gaze.predict(0.0, now=100.0), (0.5, 0.5))
+
+
+class FoveaRectTests(SimpleTestCase):
+    def test_centred(self):
+        self.assertEqual(fovea_rect(1000, 600, (0.5, 0.5), 0.3), (350, 210, 300, 180))
+
+    def test_kept_inside_the_frame(self):
+        self.assertEqual(fovea_rect(1000, 600, (0.0, 1.0), 0.3), (0, 420, 300, 180))
+        self.assertEqual(fovea_rect(1000, 600, (1.0, 0.0), 0.3), (700, 0, 300, 180))
+
+    def test_even_pixels(self):
+        x, y, w, h = fovea_rect(1279, 721, (0.37, 0.61))
+        self.assertTrue(all(value % 2 == 0 for value in (x, y, w, h)))
+        self.assertLessEqual(x + w, 1279)
+        self.assertLessEqual(y + h, 721)
@@ -0,0 +1,159 @@
+import asyncio
+import os
+import socket
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from socket_com.frame_packets import (FLAG_RETRANSMIT, HEADER_SIZE, FrameSender, Reassembler, TokenBucketPacer,
+                                      frame_nonce, pack_header, unpack_header)
+
+PACKET_SIZE = 100
+
+
+def packets(sequence, payload, timestamp=1.5):
+    # (header, payload) of every data packet of a frame, as the client parses them
+    chunks = [payload[i:i + PACKET_SIZE] for i in range(0, len(payload), PACKET_SIZE)]
+    return [(unpack_header(pack_header(i, sequence, timestamp, len(payload), len(chunks), 0, PACKET_SIZE)), chunk)
+            for i, chunk in enumerate(chunks)]
+
+
+class HeaderTests(SimpleTestCase):
+    def test_round_trip(self):
+        header = pack_header(7, 123456, 1700000000.25, 65000, 47, 3, 1400, FLAG_RETRANSMIT)
+        self.assertEqual(len(header), HEADER_SIZE)
+        self.assertEqual(unpack_header(header + b"payload"), (FLAG_RETRANSMIT, 7, 123456, 1700000000.25, 65000, 47, 3, 1400))
+
+    def test_not_a_data_packet(self):
+        self.assertIsNone(unpack_header(b"SYNC" + bytes(HEADER_SIZE)))
+        self.assertIsNone(unpack_header(pack_header(0, 1, 0.0, 10, 1, 0, 1400)[:-1]))
+
+    def test_frame_nonce(self):
+        iv = os.urandom(12)
+        self.assertEqual(frame_nonce(iv, 1)[:8], iv[:8])
+        self.assertNotEqual(frame_nonce(iv, 1), frame_nonce(iv, 2))
+
+
+class ReassemblerTests(SimpleTestCase):
+    def test_out_of_order_packets(self):
+        reassembler = Reassembler()
+        payload = os.urandom(450)
+        frame = packets(1, payload)
+        done = [reassembler.add(header, chunk, now=0.0) for header, chunk in reversed(frame)]
+        self.assertEqual(done[:-1], [None] * (len(frame) - 1))
+        self.assertEqual(bytes(done[-1].frame()), payload)
+        self.assertEqual(done[-1].timestamp, 1.5)
+        self.assertEqual(reassembler.completed, 1)
+        # Duplicates of a finished frame are late
+        self.assertIsNone(reassembler.add(*frame[0], now=0.0))
+        self.assertEqual(reassembler.late_packets, 1)
+
+    def test_interleaved_frames_and_older_ones_dropped(self):
+        reassembler = Reassembler()
+        first, second = packets(1, os.urandom(300)), packets(2, os.urandom(300))
+        reassembler.add(*first[0], now=0.0)
+        for header, chunk in second:
+            slot = reassembler.add(header, chunk, now=0.0)
+        self.assertEqual(slot.sequence, 2)
+        # Frame 1 would be shown out of order now
+        self.assertEqual(reassembler.frames, {})
+        self.assertIsNone(reassembler.add(*first[1], now=0.0))
+
+    def test_timeout_and_eviction(self):
+        reassembler = Reassembler(max_frames=2, timeout=0.1)
+        for sequence in (1, 2, 3):
+            reassembler.add(*packets(sequence, os.urandom(300))[0], now=0.0)
+        self.assertEqual(sorted(reassembler.frames), [2, 3])
+        self.assertEqual(reassembler.evicted, 1)
+        reassembler.expire(now=0.2)
+        self.assertEqual(reassembler.frames, {})
+        self.assertEqual(reassembler.timed_out, 2)
+
+    def test_bogus_header(self):
+        reassembler = Reassembler()
+        header = unpack_header(pack_header(0, 1, 0.0, 1000, 1, 0, PACKET_SIZE))  # bigger than its packets
+        self.assertIsNone(reassembler.add(header, b"x", now=0.0))
+        self.assertEqual(reassembler.frames, {})
+
+
+class TokenBucketPacerTests(SimpleTestCase):
+    def test_unpaced(self):
+        pacer = TokenBucketPacer(1000)
+        self.assertEqual(pacer.delay(10_000), 0.0)
+
+    def test_burst_then_rate(self):
+        with mock.patch("socket_com.frame_packets.time.perf_counter", return_value=10.0):
+            pacer = TokenBucketPacer(1000)
+            pacer.rate = 10_000
+            self.assertEqual(pacer.delay(1000), 0.0)
+            # The bucket is empty, but a send may still take it below zero
+            self.assertEqual(pacer.delay(500), 0.0)
+            self.assertAlmostEqual(pacer.delay(500), 0.05)
+            self.assertAlmostEqual(pacer.waited, 0.05)
+        with mock.patch("socket_com.frame_packets.time.perf_counter", return_value=10.25):
+            # Refilled while idle, but never above the burst
+            self.assertEqual(pacer.delay(1000), 0.0)
+            self.assertEqual(pacer.delay(1000), 0.0)
+            self.assertAlmostEqual(pacer.delay(1), 0.1)
+
+
+class FrameSenderTests(SimpleTestCase):
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(("127.0.0.1", 0))
+        self.receiver.settimeout(1.0)
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.receiver.close)
+        self.addCleanup(self.sender.close)
+
+    def receive(self, count):
+        return [self.receiver.recv(65536) for _ in range(count)]
+
+    def send(self, sender, payload, sequence=1, **pacing):
+        packets = sender.packetize(payload)
+        syscalls = asyncio.run(sender.send_frame(sequence, 2.5, packets, len(payload), len(packets), **pacing))
+        return packets, syscalls
+
+    def reassemble(self, datagrams):
+        reassembler = Reassembler()
+        for datagram in datagrams:
+            slot = reassembler.add(unpack_header(datagram), datagram[HEADER_SIZE:], now=0.0)
+        return slot
+
+    def test_packet_by_packet(self):
+        sender = FrameSender(self.sender, self.receiver.getsockname(), PACKET_SIZE, use_gso=False)
+        payload = os.urandom(1050)
+        packets, syscalls = self.send(sender, payload)
+        self.assertEqual(syscalls, len(packets))
+        datagrams = self.receive(len(packets))
+        self.assertTrue(all(len(d) == HEADER_SIZE + PACKET_SIZE for d in datagrams[:-1]))
+        self.assertEqual(bytes(self.reassemble(datagrams).frame()), payload)
+
+    def test_batched_sends(self):
+        # GSO where the kernel has it, otherwise it falls back to one send per packet
+        sender = FrameSender(self.sender, self.receiver.getsockname(), PACKET_SIZE, use_gso=True)
+        payload = os.urandom(40 * PACKET_SIZE + 7)
+        packets, syscalls = self.send(sender, payload)
+        if sender.use_gso:
+            self.assertEqual(syscalls, -(-len(packets) // sender.batch_packets))
+        slot = self.reassemble(self.receive(len(packets)))
+        self.assertEqual(bytes(slot.frame()), payload)
+
+    def test_paced(self):
+        sender = FrameSender(self.sender, self.receiver.getsockname(), PACKET_SIZE, use_gso=False)
+        payload = os.urandom(50 * PACKET_SIZE)
+        start = time.perf_counter()
+        packets, _ = self.send(sender, payload, duration=0.02)
+        # Spread over the duration instead of going out at once
+        self.assertGreater(time.perf_counter() - start, 0.015)
+        self.assertGreater(sender.pacer.waited, 0)
+        self.receive(len(packets))
+
+    def test_resend_is_flagged(self):
+        sender = FrameSender(self.sender, self.receiver.getsockname(), PACKET_SIZE, use_gso=False)
+        packets = sender.packetize(os.urandom(300))
+        self.assertEqual(sender.resend(4, 2.5, 300, 3, 0, [(1, packets[1])]), 1)
+        datagram, = self.receive(1)
+        self.assertEqual(unpack_header(datagram)[:3], (FLAG_RETRANSMIT, 1, 4))
+        self.assertEqual(datagram[HEADER_SIZE:], bytes(packets[1]))
@@ -0,0 +1,92 @@
+import json
+import os
+import struct
+import tempfile
+from multiprocessing import shared_memory
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from socket_test.frame_sources import (PIXEL_FORMAT, SHM_METADATA_FORMAT, SharedMemorySource, SyntheticSource,
+                                       VideoFileSource, create_frame_source)
+
+METADATA_SIZE = 64
+
+
+class SyntheticSourceTests(SimpleTestCase):
+    def test_frames(self):
+        source = create_frame_source('synthetic', 64, 48, fps=1000)
+        self.assertIsInstance(source, SyntheticSource)
+        self.assertEqual(source.pixel_format, PIXEL_FORMAT)
+        self.assertTrue(source.start())
+        ok, first, timestamp = source.read()
+        self.assertTrue(ok)
+        self.assertEqual(first.shape, (48, 64, 3))
+        self.assertEqual(source.latest_frame(), (first, timestamp))
+        _, second, _ = source.read()
+        self.assertFalse(np.array_equal(first, second))
+        source.stop()
+        self.assertEqual(source.read(), (False, None, 0.0))
+        self.assertIsNone(source.latest_frame())
+
+
+class CreateFrameSourceTests(SimpleTestCase):
+    def test_options_go_to_the_source(self):
+        source = create_frame_source('file', 320, 240, 25, path="clip.mp4", loop=False)
+        self.assertEqual((source.path, source.loop, source.width, source.height, source.fps),
+                         ("clip.mp4", False, 320, 240, 25))
+
+    def test_unknown_type(self):
+        with self.assertRaises(ValueError):
+            create_frame_source('webcam')
+
+    def test_missing_video_file(self):
+        source = VideoFileSource(path=os.path.join(tempfile.gettempdir(), "no_such_clip.mp4"))
+        with self.assertLogs("socket_test.frame_sources", "ERROR"):
+            self.assertFalse(source.start())
+
+
+class SharedMemorySourceTests(SimpleTestCase):
+    def setUp(self):
+        self.width, self.height, self.channels, self.slots = 8, 4, 4, 3
+        self.frame_size = self.width * self.height * self.channels
+        self.shm = shared_memory.SharedMemory(create=True, size=METADATA_SIZE + self.slots * self.frame_size)
+        self.addCleanup(self.shm.unlink)
+        self.addCleanup(self.shm.close)
+
+        info = {'shm_name': self.shm.name, 'width': self.width, 'height': self.height, 'channels': self.channels,
+                'buffer_size': self.slots, 'metadata_size': METADATA_SIZE, 'frame_size': self.frame_size}
+        fd, self.info_file = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(info, f)
+        self.addCleanup(os.remove, self.info_file)
+
+    def write(self, index, value):
+        # What the writer process does: fill the slot, then publish its index
+        offset = METADATA_SIZE + (index - 1) % self.slots * self.frame_size
+        self.shm.buf[offset:offset + self.frame_size] = bytes([value]) * self.frame_size
+        struct.pack_into(SHM_METADATA_FORMAT, self.shm.buf, 0, index, 0.0, self.width, self.height, self.channels)
+
+    def test_reads_each_new_frame_once(self):
+        source = SharedMemorySource(buffer_info_file=self.info_file, timeout=0.05)
+        self.assertTrue(source.start())
+        self.addCleanup(source.stop)
+
+        self.write(1, 10)
+        ok, frame, _ = source.read()
+        self.assertTrue(ok)
+        # BGRA from the writer comes out as BGR
+        self.assertEqual(frame.shape, (self.height, self.width, 3))
+        self.assertTrue((frame == 10).all())
+
+        self.write(4, 20)  # wrapped around the ring
+        self.assertTrue((source.read()[1] == 20).all())
+
+        # Nothing new before the timeout
+        with self.assertLogs("socket_test.frame_sources", "ERROR"):
+            self.assertFalse(source.read()[0])
+
+    def test_missing_buffer(self):
+        source = SharedMemorySource(buffer_info_file=self.info_file + ".missing")
+        with self.assertLogs("socket_test.frame_sources", "ERROR"):
+            self.assertFalse(source.start())
@@ -0,0 +1,159 @@
+import asyncio
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from socket_test.h264_encoder import (
+    CALIBRATION_PICTURES,
+    START_CODE,
+    START_CODE_4,
+    AccessUnit,
+    AccessUnitSplitter,
+    H264EncoderSession,
+    split_nal_units,
+)
+
+AUD = b"\x09\xf0"
+SPS = b"\x67\x42\xc0\x1f"
+PPS = b"\x68\xce\x3c\x80"
+IDR_FIRST = b"\x65\x88\x84"     # first_mb_in_slice 0
+IDR_SECOND = b"\x65\x40\x11"    # first_mb_in_slice 1, a second slice of the same picture
+P_FIRST = b"\x41\x9a\x02"
+P_SECOND = b"\x41\x40\x22"
+
+
+def annex_b(*nal_units):
+    return b"".join(START_CODE_4 + nal for nal in nal_units)
+
+
+class SplitNalUnitsTests(SimpleTestCase):
+    def test_keeps_the_unfinished_tail(self):
+        nal_units, remainder = split_nal_units(annex_b(SPS, PPS, IDR_FIRST))
+        self.assertEqual(nal_units, [SPS, PPS])
+        self.assertEqual(remainder, START_CODE + IDR_FIRST)
+
+    def test_three_and_four_byte_start_codes(self):
+        nal_units, _ = split_nal_units(START_CODE + SPS + START_CODE_4 + PPS + START_CODE)
+        self.assertEqual(nal_units, [SPS, PPS])
+
+    def test_split_across_reads(self):
+        stream = annex_b(AUD, SPS, PPS, IDR_FIRST, AUD) + START_CODE
+        nal_units, buffer = [], b""
+        for i in range(0, len(stream), 3):
+            found, buffer = split_nal_units(buffer + stream[i:i + 3])
+            nal_units += found
+        self.assertEqual(nal_units, [AUD, SPS, PPS, IDR_FIRST, AUD])
+
+    def test_no_start_code(self):
+        self.assertEqual(split_nal_units(b"\x00\x00"), ([], b"\x00\x00"))
+
+
+class AccessUnitSplitterTests(SimpleTestCase):
+    def feed(self, splitter, *nal_units):
+        return [unit for nal in nal_units for unit in splitter.feed(nal)]
+
+    def test_delimiter_ends_a_picture(self):
+        splitter = AccessUnitSplitter()
+        units = self.feed(splitter, AUD, SPS, PPS, IDR_FIRST, IDR_SECOND, AUD, P_FIRST)
+        self.assertEqual(len(units), 1)
+        self.assertTrue(units[0].keyframe)
+        self.assertEqual(units[0].data, annex_b(SPS, PPS, IDR_FIRST, IDR_SECOND))
+        last = splitter.flush()
+        self.assertFalse(last.keyframe)
+        self.assertEqual(last.data, annex_b(P_FIRST))
+
+    def test_slices_of_one_picture_stay_together(self):
+        # A pause between the two slices used to publish them as two pictures
+        splitter = AccessUnitSplitter()
+        self.assertEqual(self.feed(splitter, P_FIRST, P_SECOND), [])
+        self.assertEqual(splitter.flush().data, annex_b(P_FIRST, P_SECOND))
+
+    def test_next_picture_without_delimiter(self):
+        splitter = AccessUnitSplitter()
+        units = self.feed(splitter, SPS, PPS, IDR_FIRST, P_FIRST, P_SECOND, SPS, PPS, IDR_FIRST)
+        self.assertEqual([unit.data for unit in units],
+                         [annex_b(SPS, PPS, IDR_FIRST), annex_b(P_FIRST, P_SECOND)])
+        self.assertEqual(splitter.flush().data, annex_b(SPS, PPS, IDR_FIRST))
+
+    def test_flush_empty(self):
+        self.assertIsNone(AccessUnitSplitter().flush())
+
+    def test_learned_slice_count_ends_pictures_right_away(self):
+        splitter = AccessUnitSplitter()
+        for _ in range(CALIBRATION_PICTURES):
+            self.feed(splitter, AUD, P_FIRST, P_SECOND)
+        # The last calibration picture only ends with the next delimiter
+        self.assertEqual(len(self.feed(splitter, AUD)), 1)
+        units = self.feed(splitter, P_FIRST, P_SECOND)
+        self.assertEqual([unit.data for unit in units], [annex_b(P_FIRST, P_SECOND)])
+        self.assertEqual(self.feed(splitter, AUD), [])
+
+    def test_slice_count_change_recalibrates(self):
+        splitter = AccessUnitSplitter()
+        for _ in range(CALIBRATION_PICTURES + 1):
+            self.feed(splitter, AUD, P_FIRST)
+        self.assertEqual(splitter.slices_per_picture, 1)
+        # A picture with a second slice has already gone out without it
+        with self.assertLogs("socket_test.h264_encoder", "WARNING"):
+            units = self.feed(splitter, AUD, P_FIRST, P_SECOND)
+        self.assertEqual([unit.data for unit in units], [annex_b(P_FIRST)])
+        self.assertIsNone(splitter.slices_per_picture)
+        self.assertEqual(self.feed(splitter, AUD, P_FIRST, P_SECOND), [])
+        self.assertEqual(splitter.flush().data, annex_b(P_FIRST, P_SECOND))
+
+
+class BrokenStdin:
+    def write(self, data):
+        raise BrokenPipeError("ffmpeg went away")
+
+    async def drain(self):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class FakeProcess:
+    returncode = None
+    stdin = BrokenStdin()
+
+    async def wait(self):
+        self.returncode = 0
+
+
+class EncoderRestartTests(SimpleTestCase):
+    def test_broken_pipe_restarts(self):
+        session = H264EncoderSession(16, 16)
+        starts = []
+
+        async def start():
+            await session.stop()
+            session.failed = False
+            session.process = FakeProcess()
+            starts.append(session.restarts)
+        session.start = start
+
+        async def run():
+            frame = np.zeros((16, 16, 3), dtype=np.uint8)
+            self.assertFalse(await session.encode(frame))
+            self.assertTrue(session.failed)
+            self.assertFalse(await session.encode(frame))
+
+        asyncio.run(run())
+        self.assertEqual(starts, [0, 1])
+        self.assertEqual(session.restarts, 1)
+
+    def test_units_carry_the_tag_of_their_frame(self):
+        session = H264EncoderSession(16, 16)
+        session.tags.extend(["first", "second"])
+        session._publish(AccessUnit([IDR_FIRST]))
+        session._publish(AccessUnit([P_FIRST]))
+        self.assertEqual([unit.tag for unit in session.drain()], ["first", "second"])
+
+    def test_in_flight_never_negative(self):
+        session = H264EncoderSession(16, 16)
+        session._publish(AccessUnit([P_FIRST]))
+        self.assertEqual(session.in_flight, 0)
@@ -0,0 +1,93 @@
+from django.test import SimpleTestCase
+
+from socket_com.jitter_buffer import (INITIAL_PLAYOUT_DELAY, LATE_MARGIN, MAX_BUFFERED_FRAMES, MAX_LATENESS,
+                                      MAX_PLAYOUT_DELAY, PLAYOUT_MARGIN, JitterBuffer)
+
+FRAME_INTERVAL = 1 / 30
+
+
+class JitterBufferTests(SimpleTestCase):
+    def test_steady_network(self):
+        buffer = JitterBuffer()
+        self.assertEqual(buffer.playout_delay, INITIAL_PLAYOUT_DELAY)
+        for sequence in range(100):
+            sent = sequence * FRAME_INTERVAL
+            self.assertTrue(buffer.push(sequence, sent, sequence, sent + 0.02))
+            self.assertEqual(buffer.next_playout(), sent + buffer.playout_delay)
+            self.assertEqual(buffer.pop(buffer.next_playout()), sequence)
+        self.assertAlmostEqual(buffer.playout_delay, 0.02 + PLAYOUT_MARGIN, places=3)
+        self.assertEqual((buffer.played, buffer.late, buffer.dropped), (100, 0, 0))
+
+    def test_uneven_arrival_plays_in_order(self):
+        buffer = JitterBuffer()
+        arrivals = [(0, 0.01), (2, 0.012), (1, 0.025)]
+        for sequence, delay in arrivals:
+            sent = sequence * FRAME_INTERVAL
+            buffer.push(sequence, sent, sequence, sent + delay)
+        played = [buffer.pop(buffer.next_playout()) for _ in range(3)]
+        self.assertEqual(played, [0, 1, 2])
+
+    def test_delay_goes_up_at_once_and_down_slowly(self):
+        buffer = JitterBuffer(window=10)
+        for sequence in range(10):
+            buffer.push(sequence, sequence, None, sequence + 0.01)
+        buffer.push(10, 10, None, 10.06)
+        self.assertAlmostEqual(buffer.playout_delay, 0.06 + PLAYOUT_MARGIN)
+        for sequence in range(11, 22):
+            buffer.push(sequence, sequence, None, sequence + 0.01)
+        self.assertGreater(buffer.playout_delay, 0.03)
+
+    def test_late_frames(self):
+        buffer = JitterBuffer()
+        buffer.push(1, 0.0, "one", 0.01)
+        self.assertEqual(buffer.pop(1.0), "one")
+        # Older than what was played
+        self.assertFalse(buffer.push(0, 0.0, "zero", 1.0))
+        # Too far past its playout time, it still moves the delay up though
+        self.assertFalse(buffer.push(2, 1.0, "two", 1.0 + buffer.playout_delay + MAX_LATENESS + 0.01))
+        self.assertEqual(buffer.late, 2)
+        self.assertGreater(buffer.playout_delay, INITIAL_PLAYOUT_DELAY)
+
+    def test_only_the_newest_due_frame_plays(self):
+        buffer = JitterBuffer()
+        for sequence in range(3):
+            buffer.push(sequence, 0.0, sequence, 0.001)
+        self.assertIsNone(buffer.pop(0.0))
+        self.assertEqual(buffer.pop(1.0), 2)
+        self.assertEqual(buffer.dropped, 2)
+        self.assertIsNone(buffer.next_playout())
+
+    def test_bounded(self):
+        buffer = JitterBuffer()
+        for sequence in range(MAX_BUFFERED_FRAMES + 4):
+            buffer.push(sequence, 0.0, sequence, 0.001)
+        self.assertEqual(buffer.get_stats()["buffered"], MAX_BUFFERED_FRAMES)
+        self.assertEqual(buffer.dropped, 4)
+
+    def test_max_frame_age_follows_the_delay(self):
+        buffer = JitterBuffer()
+        self.assertAlmostEqual(buffer.max_frame_age, INITIAL_PLAYOUT_DELAY + MAX_LATENESS + LATE_MARGIN)
+        for sequence in range(20):
+            buffer.push(sequence, sequence, None, sequence + 0.08)
+        self.assertAlmostEqual(buffer.max_frame_age, 0.08 + PLAYOUT_MARGIN + MAX_LATENESS + LATE_MARGIN)
+        for sequence in range(20, 40):
+            buffer.push(sequence, sequence, None, sequence + 0.5)
+        self.assertAlmostEqual(buffer.max_frame_age, MAX_PLAYOUT_DELAY + MAX_LATENESS + LATE_MARGIN)
+
+    def test_step_increase_in_delay(self):
+        # What the client does with every frame: drop it once it's past max_frame_age, or finish it
+        buffer = JitterBuffer()
+        played = []
+        for sequence in range(120):
+            sent = sequence * FRAME_INTERVAL
+            arrived = sent + (0.01 if sequence < 60 else 0.09)  # well past the delay plus LATE_MARGIN
+            if arrived - sent > buffer.max_frame_age:
+                buffer.too_old(sequence, sent, arrived)
+                buffer.too_old(sequence, sent, arrived)  # more packets of the same frame
+            elif buffer.push(sequence, sent, sequence, arrived):
+                played.append(buffer.pop(buffer.next_playout()))
+        self.assertAlmostEqual(buffer.playout_delay, 0.09 + PLAYOUT_MARGIN)
+        # Lost until enough of the recent delays are high for the percentile, then it plays again
+        self.assertLessEqual(buffer.late, 5)
+        self.assertEqual(len(played), 120 - buffer.late)
+        self.assertEqual(played[-50:], list(range(70, 120)))
@@ -0,0 +1,49 @@
+import asyncio
+import threading
+
+from django.test import SimpleTestCase
+
+from socket_test.mailbox import LatestValueMailbox
+
+
+class LatestValueMailboxTests(SimpleTestCase):
+    def test_newest_value_wins(self):
+        async def run():
+            mailbox = LatestValueMailbox()
+            for frame_id in (1, 2, 3):
+                mailbox.put(frame_id)
+            self.assertEqual(await mailbox.get(timeout=1.0), 3)
+            self.assertIsNone(mailbox.take())
+            self.assertEqual((mailbox.delivered, mailbox.overwritten), (1, 2))
+        asyncio.run(run())
+
+    def test_put_from_another_thread_wakes_get(self):
+        async def run():
+            mailbox = LatestValueMailbox()
+            waiter = asyncio.ensure_future(mailbox.get(timeout=5.0))
+            await asyncio.sleep(0)
+            threading.Thread(target=mailbox.put, args=("frame",)).start()
+            return await waiter
+        self.assertEqual(asyncio.run(run()), "frame")
+
+    def test_timeout(self):
+        async def run():
+            return await LatestValueMailbox().get(timeout=0.01)
+        self.assertIsNone(asyncio.run(run()))
+
+    def test_close_wakes_get(self):
+        async def run():
+            mailbox = LatestValueMailbox()
+            waiter = asyncio.ensure_future(mailbox.get(timeout=5.0))
+            await asyncio.sleep(0)
+            mailbox.close()
+            self.assertIsNone(await waiter)
+            self.assertFalse(mailbox.put("late"))
+            self.assertIsNone(mailbox.take())
+        asyncio.run(run())
+
+    def test_put_after_the_loop_closed(self):
+        async def create():
+            return LatestValueMailbox()
+        mailbox = asyncio.run(create())
+        self.assertFalse(mailbox.put("frame"))
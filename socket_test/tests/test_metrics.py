@@ -0,0 +1,48 @@
+from django.test import SimpleTestCase
+
+from socket_com.metrics import GROWTH, LatencyHistogram, StageMetrics
+
+
+class LatencyHistogramTests(SimpleTestCase):
+    def test_empty(self):
+        histogram = LatencyHistogram()
+        self.assertIsNone(histogram.percentile(50))
+        self.assertEqual(histogram.snapshot(), {"count": 0})
+
+    def test_percentiles_within_a_bucket(self):
+        histogram = LatencyHistogram()
+        for ms in range(1, 101):
+            histogram.record(ms / 1000)
+        for p in (50, 95, 99):
+            expected = p / 1000
+            self.assertGreaterEqual(histogram.percentile(p), expected / GROWTH)
+            self.assertLessEqual(histogram.percentile(p), expected * GROWTH)
+        self.assertEqual(histogram.percentile(100), 0.1)
+
+    def test_merge(self):
+        # loadtest merges every viewer's histogram into one report
+        a, b = LatencyHistogram(), LatencyHistogram()
+        for _ in range(10):
+            a.record(0.001)
+            b.record(0.5)
+        a.merge(b)
+        self.assertEqual(a.count, 20)
+        self.assertEqual(a.max, 0.5)
+        self.assertAlmostEqual(a.total, 5.01)
+        self.assertLess(a.percentile(50), 0.002)
+        self.assertEqual(a.percentile(99), 0.5)
+
+
+class StageMetricsTests(SimpleTestCase):
+    def test_snapshot_keeps_pipeline_order(self):
+        registry = StageMetrics()
+        for stage in ("zz_custom", "send", "capture", "encode"):
+            registry.record(stage, 0.01)
+        self.assertEqual(list(registry.snapshot()["stages"]), ["capture", "encode", "send", "zz_custom"])
+
+    def test_reset(self):
+        registry = StageMetrics()
+        with registry.time("encode"):
+            pass
+        registry.reset()
+        self.assertEqual(registry.snapshot()["stages"]["encode"], {"count": 0})
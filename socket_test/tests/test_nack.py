@@ -0,0 +1,46 @@
+from django.test import SimpleTestCase
+
+from socket_com.frame_packets import FrameSlot
+from socket_com.nack import NACK_DELAY, NackTracker, pack_nack, unpack_nack
+
+
+def slot(data_packets):
+    return FrameSlot(1, 0.0, data_packets * 10, data_packets, 0, 10, now=0.0)
+
+
+class NackTrackerTests(SimpleTestCase):
+    def test_nacks_after_a_pause(self):
+        tracker, frame = NackTracker(), slot(4)
+        for index, now in ((0, 0.0), (1, 0.0001), (3, 0.0002)):
+            frame.add(index, bytes(10), now)
+            tracker.on_packet(1, 0.0, now)
+        self.assertEqual(tracker.due({1: frame}, 0.001, 0.5, 0.0002 + NACK_DELAY / 2), [])
+        self.assertEqual(tracker.due({1: frame}, 0.001, 0.5, 0.0002 + NACK_DELAY), [(1, [2])])
+
+    def test_waits_for_paced_packets(self):
+        # At a low bitrate single packets come 10 ms apart, that's no loss
+        tracker, frame = NackTracker(), slot(10)
+        for index in range(5):
+            frame.add(index, bytes(10), index * 0.01)
+            tracker.on_packet(1, 0.0, index * 0.01)
+        self.assertGreater(tracker.nack_delay, 0.01)
+        self.assertEqual(tracker.due({1: frame}, 0.001, 0.5, 0.055), [])
+        self.assertEqual(tracker.due({1: frame}, 0.001, 0.5, 0.041 + tracker.nack_delay), [(1, [5, 6, 7, 8, 9])])
+
+    def test_retransmissions_dont_count_as_pacing(self):
+        tracker = NackTracker()
+        tracker.on_packet(1, 0.0, 0.0)
+        tracker.on_packet(1, 0.0, 0.0001)
+        tracker.on_packet(1, 0.0, 0.015, retransmit=True)
+        self.assertEqual(tracker.nack_delay, NACK_DELAY)
+
+
+    def test_no_nack_that_cant_arrive_in_time(self):
+        tracker, frame = NackTracker(), slot(4)
+        frame.add(0, bytes(10), 0.0)
+        tracker.on_packet(1, 0.0, 0.0)
+        self.assertEqual(tracker.due({1: frame}, 0.01, 0.05, 0.045), [])
+        self.assertEqual(tracker.due({1: frame}, 0.01, 0.1, 0.045), [(1, [1, 2, 3])])
+
+    def test_packet(self):
+        self.assertEqual(unpack_nack(pack_nack(70000, [0, 5, 300])), (70000, [0, 5, 300]))
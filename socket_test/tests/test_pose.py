@@ -0,0 +1,59 @@
+import struct
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from socket_test.pose import (BATCH_HEADER_FORMAT, FLAG_ACCELERATION, FLAG_SERVER_TIME, SENSOR_BATCH,
+                              PoseRingBuffer, is_sensor_batch, parse_sensor_batch)
+
+
+def batch(rows, flags=0, base_time=1000.0):
+    values = [value for row in rows for value in row]
+    return (struct.pack(BATCH_HEADER_FORMAT, SENSOR_BATCH, flags, len(rows), base_time)
+            + struct.pack(f"<{len(values)}f", *values))
+
+
+class ParseSensorBatchTests(SimpleTestCase):
+    def test_orientation_only(self):
+        data = batch([(0.0, 10.0, 20.0, 30.0), (0.01, 11.0, 21.0, 31.0)])
+        self.assertTrue(is_sensor_batch(data))
+        base_time, samples, server_time = parse_sensor_batch(data)
+        self.assertEqual(base_time, 1000.0)
+        self.assertFalse(server_time)
+        self.assertEqual(samples.shape, (2, 7))
+        np.testing.assert_allclose(samples[:, :4], [(0.0, 10.0, 20.0, 30.0), (0.01, 11.0, 21.0, 31.0)], rtol=1e-6)
+        self.assertTrue(np.isnan(samples[:, 4:]).all())
+
+    def test_acceleration_and_server_time(self):
+        data = batch([(0.0, 1.0, 2.0, 3.0, 0.1, 9.8, -0.2)], flags=FLAG_ACCELERATION | FLAG_SERVER_TIME)
+        _, samples, server_time = parse_sensor_batch(data)
+        self.assertTrue(server_time)
+        np.testing.assert_allclose(samples[0], (0.0, 1.0, 2.0, 3.0, 0.1, 9.8, -0.2), rtol=1e-6)
+
+    def test_malformed(self):
+        data = batch([(0.0, 1.0, 2.0, 3.0)])
+        with self.assertRaises(ValueError):
+            parse_sensor_batch(data[:-1])
+        with self.assertRaises(ValueError):
+            # Says it has acceleration but doesn't
+            parse_sensor_batch(batch([(0.0, 1.0, 2.0, 3.0)], flags=FLAG_ACCELERATION))
+        with self.assertRaises(ValueError):
+            parse_sensor_batch(b"\x02" + data[1:])
+        self.assertFalse(is_sensor_batch(b'{"type": "gyro"}'))
+
+
+class PoseRingBufferTests(SimpleTestCase):
+    def test_server_time_batch_and_interpolation(self):
+        poses = PoseRingBuffer()
+        _, samples, _ = parse_sensor_batch(batch([(0.0, 350.0, 0.0, 0.0), (0.1, 10.0, 20.0, 0.0)],
+                                                 flags=FLAG_SERVER_TIME))
+        poses.add_batch(1000.0, samples, server_time=True)
+        # Across north, not back round through 180
+        np.testing.assert_allclose(poses.pose_at(1000.075), (5.0, 15.0, 0.0), atol=1e-3)
+
+    def test_out_of_order_batches_and_wrap_around(self):
+        poses = PoseRingBuffer(capacity=4)
+        for t in range(6):
+            poses.add(float(t), 0.0, timestamp=100.0 + t)
+        poses.add(1.0, 0.0, timestamp=101.5)  # older than the newest sample
+        self.assertEqual(poses.history()[:, 0].tolist(), [102.0, 103.0, 104.0, 105.0])
@@ -0,0 +1,27 @@
+from django.test import SimpleTestCase
+
+from socket_test.rate_control import AdaptiveStreamController
+
+
+def acked_controller(latency, send_time):
+    controller = AdaptiveStreamController(target_latency=0.1, start_level=3)
+    for sequence in range(30):
+        sent = sequence / 30
+        controller.on_frame_sent(sequence, 20000, sent - send_time, sent)
+        controller.on_ack(sequence, now=sent + latency)
+    return controller
+
+
+class AdaptiveStreamControllerTests(SimpleTestCase):
+    def test_fast_sends_low_latency_steps_up(self):
+        controller = acked_controller(latency=0.02, send_time=0.001)
+        self.assertFalse(controller.sending_slow)
+        self.assertIsNotNone(controller.update(now=10.0))
+        self.assertEqual(controller.level, 2)
+
+    def test_blocking_sends_step_down(self):
+        # Acks still look fine, but send() is eating most of the frame interval
+        controller = acked_controller(latency=0.02, send_time=0.03)
+        self.assertTrue(controller.sending_slow)
+        self.assertIsNotNone(controller.update(now=10.0))
+        self.assertEqual(controller.level, 4)
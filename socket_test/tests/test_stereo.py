@@ -0,0 +1,43 @@
+import numpy as np
+from django.test import SimpleTestCase
+
+from socket_test.stereo import LENS_PROFILES, StereoView, get_remap_tables
+
+
+def make_frame(width, height):
+    y, x = np.mgrid[0:height, 0:width]
+    return np.stack((x % 256, y % 256, (x + y) % 256), axis=2).astype(np.uint8)
+
+
+class StereoViewTests(SimpleTestCase):
+    def test_flat_profile_is_side_by_side_centre_crops(self):
+        frame = make_frame(160, 60)
+        output = StereoView('flat').render(frame)
+        self.assertEqual(output.shape, frame.shape)
+        # Each eye shows the middle of the source at the eye's aspect ratio
+        np.testing.assert_array_equal(output[:, :80], frame[:, 40:120])
+        np.testing.assert_array_equal(output[:, 80:], frame[:, 40:120])
+
+    def test_lens_distortion(self):
+        frame = np.full((120, 320, 3), 200, dtype=np.uint8)
+        output = StereoView('cardboard').render(frame, resolution=(160, 60))
+        self.assertEqual(output.shape, (60, 160, 3))
+        # Barrel distortion pulls in from outside the source towards the corners, those stay black
+        self.assertTrue((output[0, 0] == 0).all())
+        # Around the lens centres the image is still there, chromatic correction only shifts colours
+        left_centre = round(160 / 2 - LENS_PROFILES['cardboard'].lens_separation * 160 / 2)
+        self.assertTrue((output[30, left_centre] == 200).all())
+        self.assertTrue((output[30, 160 - left_centre] == 200).all())
+
+    def test_tables_per_channel_only_with_chroma_correction(self):
+        self.assertEqual(len(get_remap_tables((64, 32), (64, 32), 'flat')), 1)
+        tables = get_remap_tables((64, 32), (64, 32), 'cardboard')
+        self.assertEqual(len(tables), 3)
+        self.assertIs(get_remap_tables((64, 32), (64, 32), 'cardboard'), tables)
+
+    def test_view(self):
+        view = StereoView('generic')
+        self.assertEqual(view.key, ('stereo', 'generic'))
+        self.assertIsNone(view.pose)
+        with self.assertRaises(ValueError):
+            StereoView('oculus')
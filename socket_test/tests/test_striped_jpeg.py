@@ -0,0 +1,75 @@
+import cv2
+import numpy as np
+from django.test import SimpleTestCase
+
+from socket_com.striped_jpeg import (MCU_HEIGHT, encode_striped_jpeg, encode_stripes, pack_stripes,
+                                     stitch_stripes, stripe_bounds, unpack_stripes)
+
+
+def make_frame(width, height):
+    y, x = np.mgrid[0:height, 0:width]
+    frame = np.stack(((x * 255 // width), (y * 255 // height), ((x + y) % 256)), axis=2).astype(np.uint8)
+    cv2.putText(frame, "stripes", (width // 4, height // 2), cv2.FONT_HERSHEY_SIMPLEX, 4, (255, 255, 255), 8)
+    return frame
+
+
+def decode(jpeg):
+    return cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+
+
+class StripeBoundsTests(SimpleTestCase):
+    def test_whole_mcu_rows(self):
+        bounds = stripe_bounds(1080, 4)
+        self.assertEqual(bounds, [(0, 272), (272, 272), (544, 272), (816, 264)])
+        self.assertTrue(all(h % MCU_HEIGHT == 0 for _, h in bounds[:-1]))
+
+    def test_more_stripes_than_rows(self):
+        self.assertEqual(stripe_bounds(40, 8), [(0, 16), (16, 16), (32, 8)])
+
+
+class StitchStripesTests(SimpleTestCase):
+    def assert_stitched(self, width, height, stripes):
+        frame = make_frame(width, height)
+        encoded = encode_stripes(frame, 80, stripes)
+        self.assertEqual(len(encoded), stripes)
+        stitched = decode(stitch_stripes(encoded, width, height))
+        self.assertEqual(stitched.shape, frame.shape)
+        # Every restart interval decodes like its stripe did on its own, except the pixel rows
+        # on either side of a seam where chroma upsampling now sees the neighbouring stripe
+        separately = np.concatenate([decode(jpeg) for _, _, jpeg in encoded])
+        seams = [row for y, _, _ in encoded[1:] for row in (y - 1, y)]
+        inside = np.ones(height, dtype=bool)
+        inside[seams] = False
+        np.testing.assert_array_equal(stitched[inside], separately[inside])
+        self.assertLess(np.abs(stitched[seams].astype(int) - separately[seams]).mean(), 3)
+
+    def test_1080p(self):
+        # 1080 isn't a multiple of 16, the last stripe is shorter
+        self.assert_stitched(1920, 1080, 4)
+
+    def test_restart_markers_wrap(self):
+        # More than the 8 RSTn markers
+        self.assert_stitched(640, 16 * 12, 12)
+
+    def test_single_stripe_is_unchanged(self):
+        frame = make_frame(320, 240)
+        encoded = encode_stripes(frame, 80, 1)
+        self.assertIs(stitch_stripes(encoded, 320, 240), encoded[0][2])
+
+    def test_encode_striped_jpeg(self):
+        frame = make_frame(1280, 720)
+        image = decode(encode_striped_jpeg(frame, 90, stripes=3))
+        self.assertEqual(image.shape, frame.shape)
+        self.assertLess(np.abs(image.astype(int) - frame).mean(), 3)
+
+
+class StripesMessageTests(SimpleTestCase):
+    def test_round_trip(self):
+        stripes = [(0, 16, b"\xff\xd8first"), (16, 8, b"\xff\xd8second stripe")]
+        self.assertEqual(unpack_stripes(pack_stripes(640, 24, stripes)), (640, 24, stripes))
+
+    def test_unknown_version(self):
+        message = bytearray(pack_stripes(640, 24, []))
+        message[0] = 9
+        with self.assertRaises(ValueError):
+            unpack_stripes(bytes(message))
@@ -0,0 +1,62 @@
+import numpy as np
+from django.test import SimpleTestCase
+
+from socket_test.tile_delta import find_dirty_tiles, merge_dirty_runs
+
+
+def dirty_per_tile(frame, previous, tile_size, threshold):
+    # The slow way find_dirty_tiles replaces, one tile at a time
+    height, width = frame.shape[:2]
+    rows, cols = -(-height // tile_size), -(-width // tile_size)
+    diff = np.abs(frame.astype(int) - previous.astype(int))
+    dirty = np.zeros((rows, cols), dtype=bool)
+    for row in range(rows):
+        for col in range(cols):
+            tile = diff[row * tile_size:(row + 1) * tile_size, col * tile_size:(col + 1) * tile_size]
+            dirty[row, col] = tile.max() > threshold
+    return dirty
+
+
+class FindDirtyTilesTests(SimpleTestCase):
+    def test_unchanged_frame_is_clean(self):
+        frame = np.full((128, 192, 3), 100, dtype=np.uint8)
+        dirty = find_dirty_tiles(frame, frame.copy(), 64, 8)
+        self.assertEqual(dirty.shape, (2, 3))
+        self.assertFalse(dirty.any())
+
+    def test_threshold(self):
+        previous = np.full((128, 128, 3), 100, dtype=np.uint8)
+        frame = previous.copy()
+        frame[10, 10, 2] = 108  # camera noise, not a change
+        frame[70, 100, 0] = 109
+        dirty = find_dirty_tiles(frame, previous, 64, 8)
+        self.assertEqual(dirty.tolist(), [[False, False], [False, True]])
+
+    def test_partial_edge_tiles(self):
+        # Neither side a multiple of the tile size, the last row and column are partial tiles
+        previous = np.zeros((100, 150, 3), dtype=np.uint8)
+        frame = previous.copy()
+        frame[99, 149] = 255
+        frame[0, 64] = 255
+        dirty = find_dirty_tiles(frame, previous, 64, 8)
+        self.assertEqual(dirty.tolist(), [[False, True, False], [False, False, True]])
+
+    def test_matches_per_tile_comparison(self):
+        rng = np.random.default_rng(7)
+        for shape, tile_size in (((240, 320, 3), 64), ((97, 131, 3), 32), ((50, 70), 16)):
+            previous = rng.integers(0, 256, shape, dtype=np.uint8)
+            frame = previous.copy()
+            mask = rng.random(shape[:2]) < 0.002
+            frame[mask] = 255 - frame[mask]
+            np.testing.assert_array_equal(find_dirty_tiles(frame, previous, tile_size, 8),
+                                          dirty_per_tile(frame, previous, tile_size, 8))
+
+
+class MergeDirtyRunsTests(SimpleTestCase):
+    def test_runs(self):
+        dirty = np.array([
+            [True, True, False, True],
+            [False, False, False, False],
+            [False, True, True, True],
+        ])
+        self.assertEqual(merge_dirty_runs(dirty), [(0, 0, 2), (0, 3, 1), (2, 1, 3)])
@@ -0,0 +1,56 @@
+import math
+import struct
+
+import numpy as np
+from django.test import SimpleTestCase
+
+from socket_test.encode_pipeline import with_pose
+from socket_test.foveation import FIELD_OF_VIEW, GazePredictor
+from socket_test.pose import PoseRingBuffer
+from socket_test.viewport import POSE_FORMAT, POSE_SIZE, VIEWPORT_SIZE, ViewportView
+
+
+def gaze_at(alpha, beta):
+    poses = PoseRingBuffer()
+    poses.add(alpha, beta, timestamp=100.0)
+    return GazePredictor(poses=poses)
+
+
+class ViewportViewTests(SimpleTestCase):
+    def test_crop_and_pose(self):
+        gaze = gaze_at(40.0, 10.0)
+        view = ViewportView(gaze, (0.5, 0.5), (200, 100))
+        self.assertEqual(view.rect, (50, 24, 100, 50))
+        self.assertEqual(view.key, ('viewport', view.rect))
+        self.assertEqual(len(view.pose), POSE_SIZE)
+        alpha, beta = struct.unpack(POSE_FORMAT, view.pose)
+        self.assertAlmostEqual(alpha, 40.0)
+        self.assertAlmostEqual(beta, 10.0 + FIELD_OF_VIEW[1] / 100, places=5)  # the rect is rounded to even rows
+
+    def test_clamped_crop_sends_where_it_ended_up(self):
+        gaze = gaze_at(40.0, 0.0)
+        view = ViewportView(gaze, (0.0, 0.5), (200, 100))
+        self.assertEqual(view.rect[0], 0)
+        alpha, _ = struct.unpack(POSE_FORMAT, view.pose)
+        # The crop centre is a quarter of the frame from the middle, not half
+        self.assertAlmostEqual(alpha, 40.0 + FIELD_OF_VIEW[0] / 4)
+
+    def test_no_orientation_yet(self):
+        view = ViewportView(GazePredictor(), (0.5, 0.5), (200, 100))
+        self.assertTrue(all(math.isnan(value) for value in struct.unpack(POSE_FORMAT, view.pose)))
+
+    def test_render(self):
+        frame = np.arange(100 * 200 * 3, dtype=np.uint32).astype(np.uint8).reshape(100, 200, 3)
+        view = ViewportView(gaze_at(0.0, 0.0), (0.5, 0.5), (200, 100))
+        np.testing.assert_array_equal(view.render(frame), frame[24:74, 50:150])
+        # A lower stream resolution scales the crop by the same factor
+        self.assertEqual(view.render(frame, (100, 50)).shape, (24, 50, 3))
+
+    def test_pose_goes_in_front_of_the_payload(self):
+        view = ViewportView(gaze_at(0.0, 0.0), (0.5, 0.5), (200, 100))
+        self.assertEqual(with_pose(view, b"jpeg"), view.pose + b"jpeg")
+        self.assertEqual(with_pose(None, b"jpeg"), b"jpeg")
+
+    def test_field_of_view(self):
+        self.assertEqual(ViewportView.field_of_view(GazePredictor()),
+                         (FIELD_OF_VIEW[0] * VIEWPORT_SIZE, FIELD_OF_VIEW[1] * VIEWPORT_SIZE))
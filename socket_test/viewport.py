@@ -0,0 +1,57 @@
+import math
+import struct
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+
+from socket_com.metrics import metrics
+
+from .foveation import GazePredictor, fovea_rect
+
+# Pose-cropped payloads start with the orientation they were cropped for, so the browser can
+# reproject them to the newest orientation: [4 bytes float alpha][4 bytes float beta], NaN
+# before the server has an orientation sample. The codec payload follows.
+POSE_FORMAT = "<ff"
+POSE_SIZE = struct.calcsize(POSE_FORMAT)
+
+VIEWPORT_SIZE = 0.5  # Viewport width and height as a fraction of the source frame
+
+
+class ViewportView:
+    '''
+    Pose-cropped view: crops the part of the source the viewer is predicted to look at,
+    like a virtual camera panning over a wide frame. One instance per frame, the crop is
+    fixed when it is created so the cache key and the pose sent along match the pixels.
+    '''
+
+    def __init__(self, gaze: GazePredictor, centre: Tuple[float, float], frame_size: Tuple[int, int]):
+        width, height = frame_size
+        self.rect = fovea_rect(width, height, centre, VIEWPORT_SIZE)
+        x, y, w, h = self.rect
+        # The crop is clamped to the frame, send the orientation of where it really ended up
+        orientation = gaze.orientation_at(((x + w / 2) / width, (y + h / 2) / height))
+        self.pose = struct.pack(POSE_FORMAT, *(orientation or (math.nan, math.nan)))
+
+    @staticmethod
+    def field_of_view(gaze: GazePredictor) -> Tuple[float, float]:
+        '''Degrees of head rotation the viewport spans, the browser needs it to reproject'''
+        return gaze.field_of_view[0] * VIEWPORT_SIZE, gaze.field_of_view[1] * VIEWPORT_SIZE
+
+    @property
+    def key(self):
+        '''Identifies the output for the broker's encode cache'''
+        return ('viewport', self.rect)
+
+    def render(self, frame: np.ndarray, resolution: Optional[Tuple[int, int]] = None) -> np.ndarray:
+        '''
+        Crops the viewport. resolution is the size asked for the whole frame,
+        the crop is scaled by the same factor.
+        '''
+        x, y, w, h = self.rect
+        crop = frame[y:y + h, x:x + w]
+        if resolution and (frame.shape[1], frame.shape[0]) != resolution:
+            size = (int(w * resolution[0] / frame.shape[1]) // 2 * 2, int(h * resolution[1] / frame.shape[0]) // 2 * 2)
+            with metrics.time("convert"):
+                return cv2.resize(crop, size, interpolation=cv2.INTER_AREA)
+        return np.ascontiguousarray(crop)
@@ -1,5 +1,14 @@
+from django.http import JsonResponse
 from django.shortcuts import render
 
+from socket_com.metrics import metrics
+
 # Create your views here.
 def index(request, *args, **kwargs):
-    return render(request, 'socket_test/stream.html')
\ No newline at end of file
+    return render(request, 'socket_test/stream.html')
+
+def stream_metrics(request, *args, **kwargs):
+    '''
+    Per stage latency percentiles of this worker process as JSON.
+    '''
+    return JsonResponse(metrics.snapshot())
@@ -2,6 +2,10 @@ import cv2
 from django.http import StreamingHttpResponse
 from django.shortcuts import render
 
+from socket_com.striped_jpeg import encode_striped_jpeg
+
+JPEG_QUALITY = 95  # what cv2.imencode used by default
+
 def generate_camera_stream():
     cap = cv2.VideoCapture(0)  # 0 = default webcam
 
@@ -10,8 +14,10 @@ def generate_camera_stream():
         if not success:
             break
 
-        ret, buffer = cv2.imencode('.jpg', frame)
-        frame_bytes = buffer.tobytes()
+        # Encoded in stripes on all cores, still one plain JPEG for the <img> tag
+        frame_bytes = encode_striped_jpeg(frame, JPEG_QUALITY)
+        if frame_bytes is None:
+            continue
 
         yield (b'--frame\r\n'
                b'Content-Type: image/jpeg\r\n\r\n' + frame_bytes + b'\r\n')